@@ -218,6 +218,7 @@ class DatasetSerializer(serializers.ModelSerializer):
             "quantile_normalize",
             "quant_sf_only",
             "svd_algorithm",
+            "file_format",
             "worker_version",
         )
         extra_kwargs = {
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.4 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("data_refinery_common", "0067_dataset_notify_me"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="dataset",
+            name="file_format",
+            field=models.CharField(
+                choices=[("TSV", "TSV"), ("NPY", "NumPy")],
+                default="TSV",
+                help_text="The format the gene expression matrices are written in. NPY writes each matrix as a float32 NumPy array, with its genes and samples listed in separate TSV files.",
+                max_length=255,
+            ),
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 3.2.4 on 2026-10-17 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("data_refinery_common", "0068_dataset_file_format"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="compendiumresult",
+            name="svd_algorithm",
+            field=models.CharField(
+                choices=[
+                    ("NONE", "None"),
+                    ("RANDOMIZED", "randomized"),
+                    ("ARPACK", "arpack"),
+                    ("CHUNKED", "chunked randomized"),
+                ],
+                default="NONE",
+                help_text="The SVD algorithm that was used to impute the compendium result.",
+                max_length=255,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="computedfile",
+            name="svd_algorithm",
+            field=models.CharField(
+                choices=[
+                    ("NONE", "None"),
+                    ("RANDOMIZED", "randomized"),
+                    ("ARPACK", "arpack"),
+                    ("CHUNKED", "chunked randomized"),
+                ],
+                default="NONE",
+                help_text="The SVD algorithm that was used to generate the file.",
+                max_length=255,
+            ),
+        ),
+        migrations.AlterField(
+            model_name="dataset",
+            name="svd_algorithm",
+            field=models.CharField(
+                choices=[
+                    ("NONE", "None"),
+                    ("RANDOMIZED", "randomized"),
+                    ("ARPACK", "arpack"),
+                    ("CHUNKED", "chunked randomized"),
+                ],
+                default="NONE",
+                help_text="Specifies choice of SVD algorithm",
+                max_length=255,
+            ),
+        ),
+    ]
@@ -20,6 +20,7 @@ class CompendiumResult(models.Model):
         ("NONE", "None"),
         ("RANDOMIZED", "randomized"),
         ("ARPACK", "arpack"),
+        ("CHUNKED", "chunked randomized"),
     )
 
     # Managers
@@ -1,20 +1,36 @@
 import os
 import shutil
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple
 
 from django.conf import settings
 from django.db import models
 from django.utils import timezone
 
 import boto3
+from boto3.s3.transfer import TransferConfig
 from botocore.client import Config
+from retrying import retry
 
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.models.managers import PublicObjectsManager
-from data_refinery_common.utils import calculate_file_size, calculate_sha1
+from data_refinery_common.utils import (
+    calculate_file_size,
+    calculate_sha1,
+    get_env_variable_gracefully,
+)
 
 # We have to set the signature_version to v4 since us-east-1 buckets require
 # v4 authentication.
 S3 = boto3.client("s3", config=Config(signature_version="s3v4"))
+S3_UPLOAD_EXTRA_ARGS = {"ACL": "public-read", "StorageClass": "STANDARD_IA"}
+# How many files `bulk_sync_to_s3` uploads at once, and how big a file
+# has to be before it's uploaded in parts (boto3 defaults to 8MB).
+S3_UPLOAD_MAX_WORKERS = int(get_env_variable_gracefully("S3_UPLOAD_MAX_WORKERS", "8"))
+S3_MULTIPART_THRESHOLD = int(
+    get_env_variable_gracefully("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024))
+)
+S3_UPLOAD_ATTEMPTS = 3
 
 logger = get_and_configure_logger(__name__)
 
@@ -37,6 +53,7 @@ class ComputedFile(models.Model):
         ("NONE", "None"),
         ("RANDOMIZED", "randomized"),
         ("ARPACK", "arpack"),
+        ("CHUNKED", "chunked randomized"),
     )
 
     # Managers
@@ -103,10 +120,7 @@ class ComputedFile(models.Model):
 
         try:
             S3.upload_file(
-                self.absolute_file_path,
-                s3_bucket,
-                s3_key,
-                ExtraArgs={"ACL": "public-read", "StorageClass": "STANDARD_IA"},
+                self.absolute_file_path, s3_bucket, s3_key, ExtraArgs=S3_UPLOAD_EXTRA_ARGS,
             )
         except Exception:
             logger.exception(
@@ -123,6 +137,76 @@ class ComputedFile(models.Model):
 
         return True
 
+    @staticmethod
+    def bulk_sync_to_s3(
+        computed_files_and_keys: List[Tuple["ComputedFile", str]],
+        s3_bucket: str,
+        max_workers: int = S3_UPLOAD_MAX_WORKERS,
+        multipart_threshold: int = S3_MULTIPART_THRESHOLD,
+        num_attempts: int = S3_UPLOAD_ATTEMPTS,
+    ) -> bool:
+        """Syncs many files to AWS S3 concurrently.
+
+        `computed_files_and_keys` is a list of (ComputedFile, s3_key)
+        tuples. Each upload is retried up to `num_attempts` times, and
+        files bigger than `multipart_threshold` bytes are uploaded in
+        parts. Once every file is uploaded their locations are saved with a
+        single query. Returns False without saving anything if any file
+        could not be uploaded.
+        """
+        if not settings.RUNNING_IN_CLOUD or not computed_files_and_keys:
+            return True
+
+        transfer_config = TransferConfig(multipart_threshold=multipart_threshold)
+
+        @retry(stop_max_attempt_number=num_attempts, wait_exponential_multiplier=1000)
+        def upload_file(computed_file: ComputedFile, s3_key: str) -> None:
+            S3.upload_file(
+                computed_file.absolute_file_path,
+                s3_bucket,
+                s3_key,
+                ExtraArgs=S3_UPLOAD_EXTRA_ARGS,
+                Config=transfer_config,
+            )
+
+        def try_upload_file(computed_file_and_key: Tuple[ComputedFile, str]) -> bool:
+            computed_file, s3_key = computed_file_and_key
+            try:
+                upload_file(computed_file, s3_key)
+            except Exception:
+                logger.exception(
+                    "Error uploading computed file to S3",
+                    computed_file_id=computed_file.pk,
+                    s3_key=s3_key,
+                    s3_bucket=s3_bucket,
+                )
+                return False
+
+            return True
+
+        # Only the uploads happen in the worker threads, the database
+        # is updated from this one once they're all done.
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            uploaded = list(executor.map(try_upload_file, computed_files_and_keys))
+
+        if not all(uploaded):
+            return False
+
+        current_time = timezone.now()
+        saved_files = []
+        for computed_file, s3_key in computed_files_and_keys:
+            computed_file.s3_bucket = s3_bucket
+            computed_file.s3_key = s3_key
+            if computed_file.pk:
+                computed_file.last_modified = current_time
+                saved_files.append(computed_file)
+            else:
+                computed_file.save()
+
+        ComputedFile.objects.bulk_update(saved_files, ["s3_bucket", "s3_key", "last_modified"])
+
+        return True
+
     def sync_from_s3(self, force=False, path=None):
         """ Downloads a file from S3 to the local file system.
         Returns the absolute file path.
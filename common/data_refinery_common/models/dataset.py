@@ -77,8 +77,11 @@ class Dataset(models.Model):
         ("NONE", "None"),
         ("RANDOMIZED", "randomized"),
         ("ARPACK", "arpack"),
+        ("CHUNKED", "chunked randomized"),
     )
 
+    FILE_FORMAT_CHOICES = (("TSV", "TSV"), ("NPY", "NumPy"))
+
     # ID
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
 
@@ -129,6 +132,15 @@ class Dataset(models.Model):
         default="NONE",
         help_text="Specifies choice of SVD algorithm",
     )
+    file_format = models.CharField(
+        max_length=255,
+        choices=FILE_FORMAT_CHOICES,
+        default="TSV",
+        help_text=(
+            "The format the gene expression matrices are written in. NPY writes each matrix as a"
+            " float32 NumPy array, with its genes and samples listed in separate TSV files."
+        ),
+    )
 
     # State properties
     is_processing = models.BooleanField(default=False)  # Data is still editable when False
@@ -182,6 +194,20 @@ class Dataset(models.Model):
 
         return Sample.objects.filter(accession_code__in=all_samples)
 
+    def get_samples_metadata(self, exclude=()):
+        """Returns a dict mapping the accession code of each Sample in this
+        Dataset, except the ones in `exclude`, to its metadata.
+
+        Uses a fixed number of queries no matter how many samples there are."""
+        samples = [sample for sample in self.get_samples() if sample.accession_code not in exclude]
+
+        if self.quant_sf_only:
+            computed_files = Sample.get_most_recent_quant_sf_files(samples)
+        else:
+            computed_files = Sample.get_most_recent_smashable_result_files(samples)
+
+        return Sample.get_metadata_dicts(samples, computed_files)
+
     def get_total_samples(self):
         """Returns the total number of samples, this counts the number of unique
         accession codes in `data`."""
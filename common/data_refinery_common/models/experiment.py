@@ -1,3 +1,5 @@
+from typing import Iterable, Union
+
 from django.contrib.postgres.fields import ArrayField
 from django.db import models
 from django.db.models import Count
@@ -94,6 +96,75 @@ class Experiment(models.Model):
         self.num_downloadable_samples = aggregates["num_downloadable_samples"]
         self.save()
 
+    @staticmethod
+    def bulk_update_num_samples(
+        experiments: Union[models.QuerySet, Iterable["Experiment"]], batch_size: int = 1000
+    ) -> int:
+        """Batched version of `update_num_samples`.
+
+        The counts for all of `experiments` are computed with a single
+        annotated query and only the experiments whose counts changed are
+        written back, with `bulk_update`. `experiments` can be a QuerySet
+        or a list of Experiments, which get their new counts set too.
+        Returns the number of experiments that were updated.
+        """
+        if isinstance(experiments, models.QuerySet):
+            instances = {}
+            experiment_ids = experiments.values("pk")
+        else:
+            instances = {experiment.pk: experiment for experiment in experiments}
+            experiment_ids = list(instances.keys())
+
+        # Filtering on the ids instead of annotating `experiments` itself
+        # keeps any joins it was filtered with from inflating the counts.
+        counts = (
+            Experiment.objects.filter(pk__in=experiment_ids)
+            .annotate(
+                new_num_total_samples=Count("samples"),
+                new_num_processed_samples=Count("samples", filter=Q(samples__is_processed=True)),
+                new_num_downloadable_samples=Count(
+                    "samples",
+                    filter=Q(
+                        samples__is_processed=True, samples__organism__qn_target__isnull=False
+                    ),
+                ),
+            )
+            .values_list(
+                "pk",
+                "num_total_samples",
+                "num_processed_samples",
+                "num_downloadable_samples",
+                "new_num_total_samples",
+                "new_num_processed_samples",
+                "new_num_downloadable_samples",
+            )
+        )
+
+        current_time = timezone.now()
+        changed_experiments = []
+        for pk, *old_counts, total, processed, downloadable in counts.iterator():
+            experiment = instances.get(pk, Experiment(pk=pk))
+            experiment.num_total_samples = total
+            experiment.num_processed_samples = processed
+            experiment.num_downloadable_samples = downloadable
+
+            if old_counts != [total, processed, downloadable]:
+                experiment.last_modified = current_time
+                changed_experiments.append(experiment)
+
+        Experiment.objects.bulk_update(
+            changed_experiments,
+            [
+                "num_total_samples",
+                "num_processed_samples",
+                "num_downloadable_samples",
+                "last_modified",
+            ],
+            batch_size=batch_size,
+        )
+
+        return len(changed_experiments)
+
     def to_metadata_dict(self):
         """ Render this Experiment as a dict """
 
@@ -1,6 +1,7 @@
-from typing import Set
+from typing import Dict, Iterable, List, Set
 
 from django.db import models
+from django.db.models import prefetch_related_objects
 from django.utils import timezone
 
 from data_refinery_common.models.computed_file import ComputedFile
@@ -109,8 +110,10 @@ class Sample(models.Model):
         metadata["refinebio_time"] = self.time
         metadata["refinebio_platform"] = self.pretty_platform
         metadata["refinebio_processed"] = self.has_raw
+        # Iterate the related manager instead of using values_list so
+        # that annotations fetched by `prefetch_metadata` are reused.
         metadata["refinebio_annotations"] = [
-            data for data in self.sampleannotation_set.all().values_list("data", flat=True)
+            annotation.data for annotation in self.sampleannotation_set.all()
         ]
 
         if computed_file and computed_file.result and computed_file.result.processor:
@@ -125,6 +128,41 @@ class Sample(models.Model):
 
         return metadata
 
+    @staticmethod
+    def prefetch_metadata(samples: Iterable["Sample"]) -> List["Sample"]:
+        """Fetches everything `to_metadata_dict` needs for all of `samples` using a
+        fixed number of queries, rather than a few queries per sample.
+
+        `samples` can be a QuerySet or a list of Samples. Returns a list."""
+        samples = list(samples)
+        prefetch_related_objects(
+            samples,
+            "organism",
+            "sampleannotation_set",
+            "attributes__name",
+            "attributes__unit",
+            "attributes__source",
+        )
+        return samples
+
+    @staticmethod
+    def get_metadata_dicts(
+        samples: Iterable["Sample"], computed_files: Dict[int, ComputedFile] = None
+    ) -> Dict[str, Dict]:
+        """Batched version of `to_metadata_dict`.
+
+        Returns a dict mapping the accession code of each of `samples` to its
+        metadata. `computed_files` maps sample ids to the ComputedFile whose
+        processor should be included, like the ones returned by
+        `get_most_recent_smashable_result_files`."""
+        if computed_files is None:
+            computed_files = {}
+
+        return {
+            sample.accession_code: sample.to_metadata_dict(computed_files.get(sample.id))
+            for sample in Sample.prefetch_metadata(samples)
+        }
+
     # Returns a set of ProcessorJob objects but we cannot specify
     # that in type hints because it hasn't been declared yet.
     def get_processor_jobs(self) -> Set:
@@ -175,6 +213,61 @@ class Sample(models.Model):
             .first()
         )
 
+    @staticmethod
+    def get_most_recent_smashable_result_files(
+        samples: Iterable["Sample"],
+    ) -> Dict[int, ComputedFile]:
+        """Batched version of `get_most_recent_smashable_result_file`.
+
+        Returns a dict mapping sample ids to their most recent smashable
+        ComputedFile using a single query. Samples without one are left out."""
+        associations = (
+            Sample.computed_files.through.objects.filter(
+                sample_id__in=[sample.id for sample in samples],
+                computed_file__is_public=True,
+                computed_file__is_smashable=True,
+            )
+            .select_related("computed_file__result__processor")
+            .order_by("sample_id", "-computed_file__created_at")
+        )
+
+        latest_computed_files = {}
+        for association in associations:
+            # Ordered newest first, so the first file we see for a sample is its latest.
+            latest_computed_files.setdefault(association.sample_id, association.computed_file)
+
+        return latest_computed_files
+
+    @staticmethod
+    def get_most_recent_quant_sf_files(samples: Iterable["Sample"]) -> Dict[int, ComputedFile]:
+        """Batched version of `get_most_recent_quant_sf_file`.
+
+        Returns a dict mapping sample ids to their most recent quant.sf file
+        using two queries. Samples without one are left out."""
+        sample_ids_by_result = {}
+        for sample_id, result_id in Sample.results.through.objects.filter(
+            sample_id__in=[sample.id for sample in samples]
+        ).values_list("sample_id", "result_id"):
+            sample_ids_by_result.setdefault(result_id, []).append(sample_id)
+
+        computed_files = (
+            ComputedFile.objects.filter(
+                result_id__in=sample_ids_by_result.keys(),
+                filename="quant.sf",
+                s3_key__isnull=False,
+                s3_bucket__isnull=False,
+            )
+            .select_related("result__processor")
+            .order_by("-created_at")
+        )
+
+        latest_computed_files = {}
+        for computed_file in computed_files:
+            for sample_id in sample_ids_by_result[computed_file.result_id]:
+                latest_computed_files.setdefault(sample_id, computed_file)
+
+        return latest_computed_files
+
     @property
     def pretty_platform(self):
         """ Turns
@@ -1,12 +1,23 @@
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
 from data_refinery_common.models import (
+    ComputationalResult,
+    ComputedFile,
     Contribution,
+    Dataset,
     Experiment,
     ExperimentSampleAssociation,
     OntologyTerm,
+    Organism,
+    Processor,
     Sample,
+    SampleAnnotation,
+    SampleAttribute,
+    SampleComputedFileAssociation,
     SampleKeyword,
+    SampleResultAssociation,
 )
 
 
@@ -100,3 +111,175 @@ class ExperimentModelTestCase(TestCase):
         sk.save()
 
         self.assertEqual(set(experiment.get_sample_keywords()), set(["medulloblastoma"]))
+
+    def test_bulk_update_num_samples(self):
+        with_target = Organism.objects.create(
+            name="HOMO_SAPIENS", taxonomy_id=9606, qn_target=ComputationalResult.objects.create()
+        )
+        without_target = Organism.objects.create(name="DANIO_RERIO", taxonomy_id=7955)
+
+        experiments = []
+        for i in range(4):
+            experiment = Experiment.objects.create(accession_code="E-MTAB-{}".format(i))
+            experiments.append(experiment)
+            for j in range(i * 2):
+                sample = Sample.objects.create(
+                    accession_code="{}-{}".format(i, j),
+                    is_processed=j % 2 == 0,
+                    organism=with_target if j < 3 else without_target,
+                )
+                ExperimentSampleAssociation.objects.create(experiment=experiment, sample=sample)
+
+        expected_counts = []
+        for experiment in experiments:
+            experiment.update_num_samples()
+            expected_counts.append(
+                (
+                    experiment.num_total_samples,
+                    experiment.num_processed_samples,
+                    experiment.num_downloadable_samples,
+                )
+            )
+        self.assertEqual(expected_counts, [(0, 0, 0), (2, 1, 1), (4, 2, 2), (6, 3, 2)])
+
+        # Nothing changed, so nothing is written.
+        with self.assertNumQueries(1):
+            self.assertEqual(Experiment.bulk_update_num_samples(Experiment.objects.all()), 0)
+
+        Experiment.objects.update(
+            num_total_samples=0, num_processed_samples=0, num_downloadable_samples=0
+        )
+        with self.assertNumQueries(2):
+            self.assertEqual(Experiment.bulk_update_num_samples(Experiment.objects.all()), 3)
+
+        for experiment, counts in zip(experiments, expected_counts):
+            experiment.refresh_from_db()
+            self.assertEqual(
+                (
+                    experiment.num_total_samples,
+                    experiment.num_processed_samples,
+                    experiment.num_downloadable_samples,
+                ),
+                counts,
+            )
+
+        # Experiments that are passed in get their new counts too.
+        experiments[3].samples.update(is_processed=True)
+        self.assertEqual(Experiment.bulk_update_num_samples(experiments), 1)
+        self.assertEqual(experiments[3].num_processed_samples, 6)
+        experiments[3].update_num_samples()
+        self.assertEqual(experiments[3].num_processed_samples, 6)
+
+
+class SampleModelTestCase(TestCase):
+    def setUp(self):
+        self.organism = Organism.objects.create(
+            name="HOMO_SAPIENS", taxonomy_id=9606, is_scientific_name=True
+        )
+        self.processor = Processor.objects.create(
+            name="Salmon Quant", version="v1.0.0", docker_image="dr_salmon"
+        )
+        self.source, _ = Contribution.objects.get_or_create(
+            source_name="Refinebio Tests", methods_url="ccdatalab.org"
+        )
+        self.length = OntologyTerm.objects.create(
+            ontology_term="EFO:0002939", human_readable_name="length"
+        )
+
+    def make_sample(self, accession_code, has_files=True):
+        sample = Sample.objects.create(
+            accession_code=accession_code,
+            title=accession_code,
+            organism=self.organism,
+            platform_name="[HT_HG-U133_Plus_PM] Affymetrix HT HG-U133+ PM Array Plate",
+            platform_accession_code="hthgu133pluspm",
+        )
+        SampleAnnotation.objects.create(sample=sample, data={"accession": accession_code})
+
+        attribute = SampleAttribute(sample=sample, name=self.length, source=self.source)
+        attribute.set_value(23)
+        attribute.save()
+
+        if not has_files:
+            return sample
+
+        result = ComputationalResult.objects.create(processor=self.processor)
+        SampleResultAssociation.objects.create(sample=sample, result=result)
+
+        # Make two of each file so we know the most recent one is picked.
+        for _ in range(2):
+            computed_file = ComputedFile.objects.create(
+                filename=accession_code + ".PCL",
+                size_in_bytes=123,
+                sha1="abc",
+                result=result,
+                is_smashable=True,
+                is_public=True,
+            )
+            SampleComputedFileAssociation.objects.create(sample=sample, computed_file=computed_file)
+
+            ComputedFile.objects.create(
+                filename="quant.sf",
+                size_in_bytes=123,
+                sha1="abc",
+                result=result,
+                s3_bucket="bucket",
+                s3_key=accession_code + "_quant.sf",
+            )
+
+        return sample
+
+    def test_batched_most_recent_files(self):
+        samples = [self.make_sample(str(i)) for i in range(3)]
+        samples.append(self.make_sample("no_files", has_files=False))
+
+        with self.assertNumQueries(1):
+            smashable_files = Sample.get_most_recent_smashable_result_files(samples)
+        with self.assertNumQueries(2):
+            quant_files = Sample.get_most_recent_quant_sf_files(samples)
+
+        for sample in samples:
+            self.assertEqual(
+                smashable_files.get(sample.id), sample.get_most_recent_smashable_result_file()
+            )
+            self.assertEqual(quant_files.get(sample.id), sample.get_most_recent_quant_sf_file())
+
+        self.assertNotIn(samples[-1].id, smashable_files)
+        self.assertNotIn(samples[-1].id, quant_files)
+
+    def test_batched_metadata_dicts(self):
+        samples = [self.make_sample(str(i)) for i in range(4)]
+        computed_files = Sample.get_most_recent_smashable_result_files(samples)
+
+        metadata = Sample.get_metadata_dicts(
+            Sample.objects.filter(accession_code__in=["0", "1", "2", "3"]), computed_files
+        )
+
+        self.assertEqual(len(metadata), 4)
+        for sample in samples:
+            self.assertEqual(
+                metadata[sample.accession_code],
+                sample.to_metadata_dict(sample.get_most_recent_smashable_result_file()),
+            )
+            self.assertEqual(
+                metadata[sample.accession_code]["refinebio_processor_name"], "Salmon Quant"
+            )
+
+        # The number of queries shouldn't depend on the number of samples.
+        with CaptureQueriesContext(connection) as two_samples:
+            Sample.get_metadata_dicts(samples[:2], computed_files)
+        with CaptureQueriesContext(connection) as four_samples:
+            Sample.get_metadata_dicts(samples, computed_files)
+        self.assertEqual(len(two_samples), len(four_samples))
+
+    def test_dataset_samples_metadata(self):
+        samples = [self.make_sample(str(i)) for i in range(3)]
+        dataset = Dataset.objects.create(data={"GSE123": ["0", "1", "2"]})
+
+        metadata = dataset.get_samples_metadata(exclude={"1": {}})
+
+        self.assertEqual(set(metadata.keys()), {"0", "2"})
+        self.assertEqual(
+            metadata["0"],
+            samples[0].to_metadata_dict(samples[0].get_most_recent_smashable_result_file()),
+        )
@@ -30,7 +30,8 @@ class Command(BaseCommand):
             type=str,
             help=(
                 "Specify SVD algorithm applied during imputation "
-                "ARPACK, RANDOMIZED or NONE to skip."
+                "ARPACK, RANDOMIZED, CHUNKED to keep the matrix on disk while imputing,"
+                " or NONE to skip."
             ),
         )
 
@@ -41,7 +42,7 @@ class Command(BaseCommand):
 def create_compendia(svd_algorithm, organisms):
     """Create a compendium for one or more organisms."""
 
-    svd_algorithm_choices = ["ARPACK", "RANDOMIZED", "NONE"]
+    svd_algorithm_choices = ["ARPACK", "RANDOMIZED", "CHUNKED", "NONE"]
     if svd_algorithm and svd_algorithm not in svd_algorithm_choices:
         raise Exception(
             "Invalid svd_algorithm option provided. Possible values are "
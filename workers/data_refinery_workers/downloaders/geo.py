@@ -202,24 +202,45 @@ class ArchivedFile:
     def is_archive(self):
         return self.extension.lower() in [".tar", ".tgz", ".gz"]
 
-    def get_files(self):
+    def is_tarball(self):
+        """ Returns true if this is an archive that can contain several files """
+        return self.extension.lower() in [".tar", ".tgz"] or self.filename.lower().endswith(
+            ".tar.gz"
+        )
+
+    def is_needed_for_experiment(self, accession_code: str) -> bool:
+        """ Returns false for the files that download_geo would skip for the experiment
+        `accession_code` without having to look for their sample: the ones that don't
+        mention a sample and either aren't processable or mention a different experiment. """
+        if self.sample_accession_code():
+            return True
+
+        return self.is_processable() and self.experiment_accession_code() == accession_code
+
+    def get_files(self, accession_code: str = None):
+        """ Enumerates the files in this archive, or just this file if it isn't one.
+
+        If `accession_code` is set, the files inside tarballs that aren't needed for that
+        experiment aren't extracted. """
         if not self.is_archive():
             yield self
         else:
             # for archives extract them and enumerate all the files inside
-            for path in self._extract_files():
+            for path in self._extract_files(accession_code):
                 archived_file = ArchivedFile(path, self)
-                for file in archived_file.get_files():
+                for file in archived_file.get_files(accession_code):
                     yield file
 
-    def _extract_files(self):
+    def _extract_files(self, accession_code: str = None):
         logger.debug("Extracting %s!", self.file_path, file_path=self.file_path)
 
         try:
             if ".tar" == self.extension:
-                return self._extract_tar()
-            elif ".tgz" == self.extension:
-                return self._extract_tgz()
+                return self._extract_tar("r", accession_code)
+            elif self.is_tarball():
+                # Decompress and extract the tarball in a single pass, instead
+                # of writing the decompressed tarball to disk first.
+                return self._extract_tar("r:gz", accession_code)
             elif ".gz" == self.extension:
                 return self._extract_gz()
         except Exception as e:
@@ -242,37 +263,31 @@ class ArchivedFile:
         else:
             return LOCAL_ROOT_DIR + "/" + self.filename + "/raw/"
 
-    def _extract_tar(self) -> List[str]:
-        """ Extract tar and return a list of the raw files. """
+    def _extract_tar(self, mode: str, accession_code: str = None) -> List[str]:
+        """ Extract tar and return a list of the raw files.
+
+        The members are extracted one at a time as they're read from the
+        tarball, skipping the ones that aren't needed for `accession_code`. """
         # This is technically an unsafe operation.
         # However, we're trusting GEO as a data source.
         abs_with_code_raw = self._get_absolute_path()
 
-        with tarfile.TarFile(self.file_path, "r") as zip_ref:
-            zip_ref.extractall(abs_with_code_raw)
-            extracted_files = (
-                zip_ref.getnames()
-            )  # https://docs.python.org/3/library/tarfile.html#tarfile.TarFile.getnames
-
-        return [(abs_with_code_raw + f) for f in extracted_files]
-
-    def _extract_tgz(self) -> List[str]:
-        """Extract tgz and return a list of the raw files."""
-        abs_with_code_raw = self._get_absolute_path()
-
-        extracted_filepath = self.file_path.replace(".tgz", ".tar")
-
-        with gzip.open(self.file_path, "rb") as f_in:
-            with open(extracted_filepath, "wb") as f_out:
-                shutil.copyfileobj(f_in, f_out)
+        extracted_files = []
+        with tarfile.open(self.file_path, mode) as zip_ref:
+            for member in zip_ref:
+                member_file = ArchivedFile(abs_with_code_raw + member.name, self)
+                if (
+                    accession_code
+                    and member.isfile()
+                    and not member_file.is_tarball()
+                    and not member_file.is_needed_for_experiment(accession_code)
+                ):
+                    continue
 
-        with tarfile.TarFile(extracted_filepath, "r") as zip_ref:
-            zip_ref.extractall(abs_with_code_raw)
-            extracted_files = (
-                zip_ref.getnames()
-            )  # https://docs.python.org/3/library/tarfile.html#tarfile.TarFile.getnames
+                zip_ref.extract(member, abs_with_code_raw)
+                extracted_files.append(member_file.file_path)
 
-        return [(abs_with_code_raw + f) for f in extracted_files]
+        return extracted_files
 
     def _extract_gz(self) -> List[str]:
         """Extract gz and return a list of the raw files."""
@@ -322,7 +337,7 @@ def download_geo(job_id: int) -> None:
 
     try:
         # enumerate all files inside the archive
-        archived_files = list(ArchivedFile(dl_file_path).get_files())
+        archived_files = list(ArchivedFile(dl_file_path).get_files(accession_code))
     except FileExtractionError as e:
         job.failure_reason = e
         logger.exception(
@@ -0,0 +1,195 @@
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Dict
+
+from django.core.management.base import BaseCommand
+
+from data_refinery_workers.downloaders import sra
+
+BYTES_IN_MB = 1024 * 1024
+WRITE_SIZE = 64 * 1024
+
+
+class LocalFileServer(ThreadingMixIn, HTTPServer):
+    """An HTTP server for the files in `files`, a dictionary of paths to
+    their contents, which supports range requests unless `accept_ranges`
+    is False and can limit how fast it sends to each connection.
+
+    To test how downloads recover, it can also say it supports range
+    requests but send the whole file anyway if `ignore_ranges` is True,
+    and close the connection halfway through the first
+    `num_incomplete_responses` responses.
+
+    It keeps count of the requests it gets and the bytes it sends.
+    """
+
+    daemon_threads = True
+
+    def __init__(
+        self,
+        files: Dict[str, bytes],
+        accept_ranges: bool = True,
+        bytes_per_second_per_connection: int = None,
+        ignore_ranges: bool = False,
+        num_incomplete_responses: int = 0,
+    ):
+        super().__init__(("127.0.0.1", 0), LocalFileRequestHandler)
+        self.files = files
+        self.accept_ranges = accept_ranges
+        self.bytes_per_second_per_connection = bytes_per_second_per_connection
+        self.ignore_ranges = ignore_ranges
+        self.num_incomplete_responses = num_incomplete_responses
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.bytes_sent = 0
+        self.thread = None
+
+    @property
+    def url(self) -> str:
+        return "http://127.0.0.1:{}".format(self.server_address[1])
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def handle_error(self, request, client_address):
+        # Clients close connections to stop downloads they don't want.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+class LocalFileRequestHandler(BaseHTTPRequestHandler):
+    # Keep-alive, like the servers we download from.
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_file_headers(self):
+        """Sends the headers for the requested file, or its requested
+        range, and returns the bytes to send."""
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return None
+
+        data = self.server.files[self.path]
+        range_match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if self.server.accept_ranges and not self.server.ignore_ranges and range_match:
+            start = int(range_match.group(1))
+            end = int(range_match.group(2)) if range_match.group(2) else len(data) - 1
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end, len(data)))
+            data = data[start : end + 1]
+        else:
+            self.send_response(200)
+
+        if self.server.accept_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        return data
+
+    def do_HEAD(self):
+        with self.server.lock:
+            self.server.num_requests += 1
+        self.send_file_headers()
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.num_requests += 1
+        data = self.send_file_headers()
+        if data is None:
+            return
+
+        with self.server.lock:
+            if self.server.num_incomplete_responses > 0:
+                self.server.num_incomplete_responses -= 1
+                data = data[: len(data) // 2]
+                self.close_connection = True
+
+        for offset in range(0, len(data), WRITE_SIZE):
+            start = time.time()
+            chunk = data[offset : offset + WRITE_SIZE]
+            self.wfile.write(chunk)
+            with self.server.lock:
+                self.server.bytes_sent += len(chunk)
+
+            if self.server.bytes_per_second_per_connection:
+                seconds = len(chunk) / self.server.bytes_per_second_per_connection
+                time.sleep(max(0, seconds - (time.time() - start)))
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--file-size", type=float, default=64, help="The file's size in MB.")
+        parser.add_argument(
+            "--connections",
+            type=str,
+            default="1,2,4,8",
+            help="Comma separated numbers of connections to download the file with.",
+        )
+        parser.add_argument(
+            "--segment-size", type=float, default=4, help="The size of each segment in MB."
+        )
+        parser.add_argument(
+            "--bandwidth",
+            type=float,
+            default=16,
+            help="How many MB per second the server sends to each connection.",
+        )
+
+    def handle(self, *args, **options):
+        """Measures the throughput of downloading a file from a local
+        HTTP server with each of the numbers of connections.
+
+        The server limits how fast it sends to each connection, the way
+        remote servers and long network paths do, which is what makes
+        several connections faster than one."""
+        connection_counts = [int(count) for count in options["connections"].split(",")]
+        file_size = int(options["file_size"] * BYTES_IN_MB)
+        files = {"/benchmark.fastq.gz": os.urandom(file_size)}
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            with LocalFileServer(
+                files, bytes_per_second_per_connection=options["bandwidth"] * BYTES_IN_MB
+            ) as server:
+                self.stdout.write("connections\tseconds\tMB/s\trequests")
+                for num_connections in connection_counts:
+                    target_file_path = os.path.join(work_dir, "{}.fastq.gz".format(num_connections))
+                    num_requests = server.num_requests
+
+                    start = time.time()
+                    sra._download_http_file(
+                        server.url + "/benchmark.fastq.gz",
+                        target_file_path,
+                        num_connections=num_connections,
+                        segment_size=int(options["segment_size"] * BYTES_IN_MB),
+                        num_attempts=1,
+                    )
+                    seconds = time.time() - start
+
+                    self.stdout.write(
+                        "{}\t{:.2f}\t{:.1f}\t{}".format(
+                            num_connections,
+                            seconds,
+                            file_size / BYTES_IN_MB / seconds,
+                            server.num_requests - num_requests,
+                        )
+                    )
+                    os.remove(target_file_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
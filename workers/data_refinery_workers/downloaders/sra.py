@@ -1,15 +1,20 @@
 import ftplib
+import hashlib
+import json
+import math
 import os
-import shutil
 import subprocess
 import time
-import urllib.request
-from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from ftplib import FTP
-from typing import List
+from typing import List, Optional, Set, Tuple
+from urllib.parse import urlparse
 
 from django.utils import timezone
 
+import requests
+from retrying import retry
+
 from data_refinery_common.job_management import create_processor_job_for_original_files
 from data_refinery_common.logging import get_and_configure_logger
 from data_refinery_common.models import (
@@ -20,13 +25,44 @@ from data_refinery_common.models import (
     Sample,
 )
 from data_refinery_common.rna_seq import _build_ena_file_url
-from data_refinery_common.utils import download_file, get_env_variable, get_https_sra_download
+from data_refinery_common.utils import get_env_variable, get_https_sra_download
 from data_refinery_workers.downloaders import utils
 
 logger = get_and_configure_logger(__name__)
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
 # chunk_size is in bytes
 CHUNK_SIZE = 1024 * 256
+# Files are downloaded over HTTP in segments of this many bytes, several
+# at a time. The finished segments are recorded next to the partially
+# downloaded file, so a failed download can be resumed where it stopped.
+DOWNLOAD_SEGMENT_SIZE = 32 * 1024 * 1024
+DOWNLOAD_CONNECTIONS = int(get_env_variable("SRA_DOWNLOAD_CONNECTIONS", "4"))
+DOWNLOAD_ATTEMPTS = 10
+DOWNLOAD_TIMEOUT = 60
+# Byte ranges have to be of the file itself, not of a compressed version of it.
+DOWNLOAD_HEADERS = {"Accept-Encoding": "identity"}
+ENA_FILE_REPORT_URL_TEMPLATE = (
+    "https://www.ebi.ac.uk/ena/portal/api/filereport"
+    "?accession={}&result=read_run&fields=fastq_ftp,fastq_bytes,fastq_md5"
+)
+
+
+class DownloadVerificationError(Exception):
+    pass
+
+
+class IncompleteSegmentError(Exception):
+    pass
+
+
+class RangeRequestIgnoredError(Exception):
+    pass
+
+
+def _should_retry_download(exception: Exception) -> bool:
+    # Downloading the file again won't change its size or MD5, so there's
+    # no point in retrying when they don't match.
+    return not isinstance(exception, DownloadVerificationError)
 
 
 def _download_file(
@@ -35,13 +71,29 @@ def _download_file(
     """ Download file dispatcher. Dispatches to the FTP or Aspera downloader """
 
     # SRA files have Apsera downloads.
-    if "ftp.sra.ebi.ac.uk" in download_url and not force_ftp:
+    if "ftp.sra.ebi.ac.uk" in download_url:
+        expected_size, expected_md5 = _get_ena_file_metadata(download_url)
+        if force_ftp:
+            return _download_file_ftp(
+                download_url, downloader_job, target_file_path, expected_size, expected_md5
+            )
+
         # From: ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036000/ERR036000_1.fastq.gz
         # To: era-fasp@fasp.sra.ebi.ac.uk:/vol1/fastq/ERR036/ERR036000/ERR036000_1.fastq.gz
         download_url = download_url.replace("ftp://", "era-fasp@")
         download_url = download_url.replace("ftp", "fasp")
         download_url = download_url.replace(".uk/", ".uk:/")
-        return _download_file_aspera(download_url, downloader_job, target_file_path, source="ENA")
+        if not _download_file_aspera(download_url, downloader_job, target_file_path, source="ENA"):
+            return False
+
+        try:
+            _verify_download(target_file_path, expected_size, expected_md5)
+        except DownloadVerificationError as e:
+            logger.error(str(e), downloader_job=downloader_job.id)
+            downloader_job.failure_reason = str(e)
+            return False
+
+        return True
     elif "ncbi.nlm.nih.gov" in download_url and not force_ftp:
         # Try to convert old-style endpoints into new-style endpoints if possible
         try:
@@ -57,10 +109,360 @@ def _download_file(
         return _download_file_ftp(download_url, downloader_job, target_file_path)
 
 
+def _get_ena_file_metadata(download_url: str) -> Tuple[Optional[int], Optional[str]]:
+    """Looks up the size and MD5 that ENA lists for the fastq file at
+    `download_url`. Returns None for both if ENA can't be reached or
+    doesn't list the file, in which case the download isn't verified."""
+    # ex: ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036000/ERR036000_1.fastq.gz
+    run_accession = download_url.split("/")[-2]
+    filename = download_url.split("/")[-1]
+
+    try:
+        response = requests.get(
+            ENA_FILE_REPORT_URL_TEMPLATE.format(run_accession), timeout=DOWNLOAD_TIMEOUT
+        )
+        response.raise_for_status()
+
+        # The report is a tsv with a header, and each field lists the
+        # values for all of the run's files separated by semicolons.
+        lines = response.text.strip().split("\n")
+        header = lines[0].split("\t")
+        for line in lines[1:]:
+            fields = dict(zip(header, line.split("\t")))
+            file_urls = fields["fastq_ftp"].split(";")
+            for file_url, size, md5 in zip(
+                file_urls, fields["fastq_bytes"].split(";"), fields["fastq_md5"].split(";")
+            ):
+                if file_url.split("/")[-1] == filename:
+                    return int(size), md5
+    except Exception:
+        logger.warning(
+            "Failed to get the size and MD5 of the file from ENA.", download_url=download_url
+        )
+
+    return None, None
+
+
+def _calculate_md5(file_path: str) -> str:
+    hash_object = hashlib.md5()
+    with open(file_path, "rb") as open_file:
+        for buf in iter(lambda: open_file.read(CHUNK_SIZE), b""):
+            hash_object.update(buf)
+
+    return hash_object.hexdigest()
+
+
+def _verify_download(
+    file_path: str, expected_size: Optional[int], expected_md5: Optional[str]
+) -> None:
+    """Raises a DownloadVerificationError and deletes the file at
+    `file_path` if its size or MD5 aren't the expected ones."""
+    error = None
+    if expected_size is not None and os.path.getsize(file_path) != expected_size:
+        error = "Downloaded {} bytes instead of {} for {}.".format(
+            os.path.getsize(file_path), expected_size, file_path
+        )
+    elif expected_md5 and _calculate_md5(file_path) != expected_md5:
+        error = "The MD5 of {} is not {}.".format(file_path, expected_md5)
+
+    if error:
+        os.remove(file_path)
+        raise DownloadVerificationError(error)
+
+
+def _get_part_paths(target_file_path: str) -> Tuple[str, str]:
+    """Returns the paths of the partially downloaded file and of the
+    record of which of its segments are finished."""
+    return target_file_path + ".part", target_file_path + ".part.json"
+
+
+def _load_finished_segments(progress_path: str, file_size: int, segment_size: int) -> Set[int]:
+    """Returns the segments that were finished by an earlier attempt at
+    downloading the same file in segments of the same size."""
+    try:
+        with open(progress_path) as progress_file:
+            progress = json.load(progress_file)
+    except (OSError, ValueError):
+        return set()
+
+    if progress.get("size") != file_size or progress.get("segment_size") != segment_size:
+        return set()
+
+    return set(progress.get("finished_segments", []))
+
+
+def _save_finished_segments(
+    progress_path: str, file_size: int, segment_size: int, finished_segments: Set[int]
+) -> None:
+    # Write to a temporary file first so that an interrupted job
+    # never leaves a partially written record.
+    temp_path = "{}.{}.tmp".format(progress_path, os.getpid())
+    with open(temp_path, "w") as progress_file:
+        json.dump(
+            {
+                "size": file_size,
+                "segment_size": segment_size,
+                "finished_segments": sorted(finished_segments),
+            },
+            progress_file,
+        )
+    os.replace(temp_path, progress_path)
+
+
+def _download_segment(download_url: str, part_path: str, start: int, end: int) -> None:
+    """Downloads bytes `start` to `end`, inclusive, of the file at
+    `download_url` into the same place in the file at `part_path`."""
+    with requests.get(
+        download_url,
+        headers={"Range": "bytes={}-{}".format(start, end), **DOWNLOAD_HEADERS},
+        stream=True,
+        timeout=DOWNLOAD_TIMEOUT,
+    ) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            raise RangeRequestIgnoredError(
+                "Range request for {} returned the whole file.".format(download_url)
+            )
+
+        with open(part_path, "r+b") as part_file:
+            part_file.seek(start)
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                part_file.write(chunk)
+
+            # The connection can be closed before the whole segment is
+            # sent without requests raising an error.
+            if part_file.tell() != end + 1:
+                raise IncompleteSegmentError(
+                    "Got {} bytes instead of {} for a segment of {}.".format(
+                        part_file.tell() - start, end + 1 - start, download_url
+                    )
+                )
+
+
+def _download_segments(
+    download_url: str,
+    target_file_path: str,
+    file_size: int,
+    num_connections: int,
+    segment_size: int,
+) -> None:
+    """Downloads the file at `download_url` to its .part file with
+    `num_connections` concurrent range requests, skipping the segments
+    an earlier attempt finished."""
+    part_path, progress_path = _get_part_paths(target_file_path)
+
+    finished_segments = set()
+    if os.path.exists(part_path):
+        finished_segments = _load_finished_segments(progress_path, file_size, segment_size)
+
+    if not finished_segments:
+        with open(part_path, "wb") as part_file:
+            part_file.truncate(file_size)
+
+    remaining_segments = [
+        segment
+        for segment in range(math.ceil(file_size / segment_size))
+        if segment not in finished_segments
+    ]
+    if finished_segments:
+        logger.info(
+            "Resuming download.",
+            download_url=download_url,
+            finished_segments=len(finished_segments),
+            remaining_segments=len(remaining_segments),
+        )
+
+    error = None
+    with ThreadPoolExecutor(max_workers=num_connections) as executor:
+        futures = {
+            executor.submit(
+                _download_segment,
+                download_url,
+                part_path,
+                segment * segment_size,
+                min((segment + 1) * segment_size, file_size) - 1,
+            ): segment
+            for segment in remaining_segments
+        }
+
+        for future in as_completed(futures):
+            if future.cancelled():
+                continue
+
+            try:
+                future.result()
+            except Exception as e:
+                # Keep the segments that are already being downloaded,
+                # but don't start any more.
+                error = error or e
+                for pending_future in futures:
+                    pending_future.cancel()
+                continue
+
+            finished_segments.add(futures[future])
+            _save_finished_segments(progress_path, file_size, segment_size, finished_segments)
+
+    if error:
+        raise error
+
+
+def _download_whole_file(download_url: str, target_file_path: str) -> None:
+    """Downloads the file at `download_url` to its .part file over a
+    single connection, for servers that don't support range requests."""
+    part_path, _ = _get_part_paths(target_file_path)
+    with requests.get(
+        download_url, headers=DOWNLOAD_HEADERS, stream=True, timeout=DOWNLOAD_TIMEOUT
+    ) as response:
+        response.raise_for_status()
+        with open(part_path, "wb") as part_file:
+            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                part_file.write(chunk)
+
+
+def _download_http_file(
+    download_url: str,
+    target_file_path: str,
+    expected_size: int = None,
+    expected_md5: str = None,
+    num_connections: int = DOWNLOAD_CONNECTIONS,
+    segment_size: int = DOWNLOAD_SEGMENT_SIZE,
+    num_attempts: int = DOWNLOAD_ATTEMPTS,
+) -> None:
+    """Downloads the file at `download_url` to `target_file_path` over
+    HTTP, retrying up to `num_attempts` times.
+
+    If the server supports range requests the file is downloaded in
+    segments over `num_connections` connections, and retries only
+    download the segments that haven't been finished yet, including the
+    ones left by an earlier job. The file is only moved to
+    `target_file_path` once its size, and MD5 if `expected_md5` is set,
+    have been checked.
+    """
+    part_path, progress_path = _get_part_paths(target_file_path)
+
+    @retry(
+        stop_max_attempt_number=num_attempts,
+        wait_exponential_multiplier=1000,
+        wait_exponential_max=120000,
+        retry_on_exception=_should_retry_download,
+    )
+    def download():
+        response = requests.head(
+            download_url, headers=DOWNLOAD_HEADERS, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+        )
+        file_size = expected_size
+        if response.ok and "Content-Length" in response.headers:
+            content_length = int(response.headers["Content-Length"])
+            if file_size is None:
+                file_size = content_length
+            elif content_length != file_size:
+                raise DownloadVerificationError(
+                    "{} is {} bytes instead of {}.".format(download_url, content_length, file_size)
+                )
+        accepts_ranges = response.ok and response.headers.get("Accept-Ranges") == "bytes"
+
+        if file_size is not None and accepts_ranges:
+            try:
+                # Don't follow the same redirects for every segment.
+                _download_segments(
+                    response.url, target_file_path, file_size, num_connections, segment_size
+                )
+            except RangeRequestIgnoredError:
+                # Some servers say they support range requests but don't.
+                logger.info(
+                    "Range requests were ignored, downloading the whole file.",
+                    download_url=download_url,
+                )
+                # The whole file overwrites any segments that were
+                # recorded as finished.
+                if os.path.exists(progress_path):
+                    os.remove(progress_path)
+                _download_whole_file(download_url, target_file_path)
+        else:
+            _download_whole_file(download_url, target_file_path)
+
+        try:
+            _verify_download(part_path, file_size, expected_md5)
+        finally:
+            # Whether it's finished or has to be started over, the
+            # record of its segments isn't needed anymore.
+            if os.path.exists(progress_path):
+                os.remove(progress_path)
+
+    download()
+    os.replace(part_path, target_file_path)
+
+
+def _download_ftp_file(
+    download_url: str,
+    target_file_path: str,
+    expected_size: int = None,
+    expected_md5: str = None,
+    num_attempts: int = DOWNLOAD_ATTEMPTS,
+) -> None:
+    """Downloads the file at `download_url` to `target_file_path` over
+    FTP, retrying up to `num_attempts` times.
+
+    Retries, including the ones by later jobs, continue from the end of
+    the partially downloaded .part file. The file is only moved to
+    `target_file_path` once its size, and MD5 if `expected_md5` is set,
+    have been checked.
+    """
+    part_path, _ = _get_part_paths(target_file_path)
+    parsed_url = urlparse(download_url)
+
+    @retry(
+        stop_max_attempt_number=num_attempts,
+        wait_exponential_multiplier=1000,
+        wait_exponential_max=120000,
+        retry_on_exception=_should_retry_download,
+    )
+    def download():
+        ftp = FTP(parsed_url.hostname, timeout=DOWNLOAD_TIMEOUT)
+        try:
+            ftp.login()
+            ftp.voidcmd("TYPE I")
+            file_size = expected_size
+            if file_size is None:
+                try:
+                    file_size = ftp.size(parsed_url.path)
+                except ftplib.error_perm:
+                    # Not every server supports SIZE.
+                    pass
+
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            if file_size is not None and offset > file_size:
+                offset = 0
+
+            with open(part_path, "ab" if offset else "wb") as part_file:
+                ftp.retrbinary(
+                    "RETR " + parsed_url.path,
+                    part_file.write,
+                    blocksize=CHUNK_SIZE,
+                    rest=offset or None,
+                )
+        finally:
+            ftp.close()
+
+        _verify_download(part_path, file_size, expected_md5)
+
+    download()
+    os.replace(part_path, target_file_path)
+
+
 def _download_file_ftp(
-    download_url: str, downloader_job: DownloaderJob, target_file_path: str
+    download_url: str,
+    downloader_job: DownloaderJob,
+    target_file_path: str,
+    expected_size: int = None,
+    expected_md5: str = None,
 ) -> bool:
-    """ Download a file to a location using FTP via urllib. """
+    """ Download a file to a location using FTP, or HTTP if that's what the URL is for. """
+    if urlparse(download_url).scheme in ["http", "https"]:
+        return _download_file_http(
+            download_url, downloader_job, target_file_path, expected_size, expected_md5
+        )
+
     try:
         logger.debug(
             "Downloading file from %s to %s via FTP.",
@@ -69,14 +471,7 @@ def _download_file_ftp(
             downloader_job=downloader_job.id,
         )
 
-        # Ancient unresolved bug. WTF python: https://bugs.python.org/issue27973
-        urllib.request.urlcleanup()
-
-        with closing(urllib.request.urlopen(download_url)) as request:
-            with open(target_file_path, "wb") as target_file:
-                shutil.copyfileobj(request, target_file, CHUNK_SIZE)
-
-        urllib.request.urlcleanup()
+        _download_ftp_file(download_url, target_file_path, expected_size, expected_md5)
     except Exception:
         logger.exception(
             "Exception caught while downloading file from the URL via FTP: %s",
@@ -92,7 +487,11 @@ def _download_file_ftp(
 
 
 def _download_file_http(
-    download_url: str, downloader_job: DownloaderJob, target_file_path: str
+    download_url: str,
+    downloader_job: DownloaderJob,
+    target_file_path: str,
+    expected_size: int = None,
+    expected_md5: str = None,
 ) -> bool:
     try:
         logger.debug(
@@ -102,7 +501,7 @@ def _download_file_http(
             downloader_job=downloader_job.id,
         )
         # This function will try to recover if the download fails
-        download_file(download_url, target_file_path)
+        _download_http_file(download_url, target_file_path, expected_size, expected_md5)
     except Exception as e:
         logger.exception(
             "Exception caught while downloading file.", downloader_job=downloader_job.id
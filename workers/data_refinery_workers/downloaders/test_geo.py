@@ -1,7 +1,12 @@
+import gzip
+import io
 import os
+import shutil
+import tarfile
+import tempfile
 from unittest.mock import patch
 
-from django.test import TestCase, tag
+from django.test import SimpleTestCase, TestCase, tag
 
 from data_refinery_common.models import (
     DownloaderJob,
@@ -58,7 +63,8 @@ class DownloadGeoTestCase(TestCase):
         self.assertTrue(
             os.path.isfile("/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tgz")
         )
-        self.assertTrue(
+        # The tarball is extracted without decompressing it to disk first.
+        self.assertFalse(
             os.path.isfile("/home/user/data_store/GSE10241/raw/GSE10241_family.xml.tar")
         )
 
@@ -256,3 +262,97 @@ class DownloadGeoTestCase(TestCase):
         # It's not necessarily that we didn't extract any files, but
         # none that were usable so it looks like none.
         self.assertEqual(dlj.failure_reason, "Failed to extract any downloaded files.")
+
+
+def get_directory_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(dir_path, filename))
+        for dir_path, _, filenames in os.walk(path)
+        for filename in filenames
+    )
+
+
+class ArchivedFileTestCase(SimpleTestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+
+        patcher = patch.object(geo, "LOCAL_ROOT_DIR", self.work_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        # Random bytes, so the compressed tarball is about as large as its contents.
+        self.members = {
+            "GSM100001.CEL.gz": gzip.compress(os.urandom(100000)),
+            "GSM100002.CEL": os.urandom(100000),
+            "GSE12345_non-normalized.txt": os.urandom(100000),
+            "GPL570-tbl-1.txt": os.urandom(100000),
+            "GSE12345_family.xml": os.urandom(100000),
+            "GSE54321_non-normalized.txt": os.urandom(100000),
+        }
+        self.needed_members = [
+            "GSM100001.CEL.gz",
+            "GSM100002.CEL",
+            "GSE12345_non-normalized.txt",
+        ]
+
+        download_dir = os.path.join(self.work_dir.name, "download")
+        os.makedirs(download_dir)
+        self.archive_path = os.path.join(download_dir, "GSE12345_RAW.tar.gz")
+        with tarfile.open(self.archive_path, "w:gz") as archive:
+            for name, data in self.members.items():
+                member = tarfile.TarInfo(name)
+                member.size = len(data)
+                archive.addfile(member, io.BytesIO(data))
+
+    @tag("downloaders")
+    def test_extract_tar_gz(self):
+        files = list(geo.ArchivedFile(self.archive_path).get_files())
+
+        raw_dir = os.path.join(self.work_dir.name, "GSE12345", "raw")
+        self.assertEqual(
+            sorted(file.file_path for file in files),
+            sorted(os.path.join(raw_dir, name.replace(".gz", "")) for name in self.members.keys()),
+        )
+        with open(os.path.join(raw_dir, "GSM100002.CEL"), "rb") as extracted_file:
+            self.assertEqual(extracted_file.read(), self.members["GSM100002.CEL"])
+        self.assertFalse(os.path.exists(self.archive_path.replace(".gz", "")))
+
+    @tag("downloaders")
+    def test_extract_tar_gz_for_experiment(self):
+        files = list(geo.ArchivedFile(self.archive_path).get_files("GSE12345"))
+
+        self.assertEqual(
+            sorted(file.filename for file in files),
+            sorted(name.replace(".gz", "") for name in self.needed_members),
+        )
+
+    @tag("downloaders")
+    def test_extract_tar_gz_disk_usage(self):
+        """Compares the bytes written by extracting the needed files from
+        the tarball directly with decompressing it to a .tar file first and
+        extracting all of it from there, like the downloader used to.
+
+        Nothing is deleted along either path, so the bytes written are
+        also the peak disk usage."""
+        old_dir = os.path.join(self.work_dir.name, "old")
+        os.makedirs(old_dir)
+        tar_path = os.path.join(old_dir, "GSE12345_RAW.tar")
+        with gzip.open(self.archive_path, "rb") as f_in, open(tar_path, "wb") as f_out:
+            shutil.copyfileobj(f_in, f_out)
+        with tarfile.TarFile(tar_path, "r") as archive:
+            archive.extractall(old_dir)
+        old_bytes_written = get_directory_size(old_dir)
+
+        # Leave the nested .gz files compressed, like the old path above.
+        with patch.object(geo.ArchivedFile, "_extract_gz", return_value=[]):
+            list(geo.ArchivedFile(self.archive_path).get_files("GSE12345"))
+        new_bytes_written = get_directory_size(os.path.join(self.work_dir.name, "GSE12345"))
+
+        self.assertEqual(
+            new_bytes_written, sum(len(self.members[name]) for name in self.needed_members)
+        )
+        self.assertEqual(
+            old_bytes_written, os.path.getsize(tar_path) + sum(map(len, self.members.values()))
+        )
+        self.assertLess(new_bytes_written, old_bytes_written / 3)
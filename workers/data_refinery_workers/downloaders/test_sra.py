@@ -1,9 +1,13 @@
 import ftplib
+import hashlib
 import os
+import tempfile
 from ftplib import FTP
-from unittest.mock import patch
+from io import StringIO
+from unittest.mock import MagicMock, patch
 
-from django.test import TestCase, tag
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, tag
 
 from data_refinery_common.models import (
     DownloaderJob,
@@ -15,6 +19,9 @@ from data_refinery_common.models import (
     SurveyJob,
 )
 from data_refinery_workers.downloaders import sra, utils
+from data_refinery_workers.downloaders.management.commands.benchmark_sra_download import (
+    LocalFileServer,
+)
 
 
 class DownloadSraTestCase(TestCase):
@@ -152,3 +159,200 @@ class DownloadSraTestCase(TestCase):
         assoc.save()
         result = sra._download_file(og.source_url, dlj, "/tmp/doomed", force_ftp=False)
         self.assertTrue(result)
+
+
+class DownloadFileTestCase(SimpleTestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+
+        self.data = os.urandom(100000)
+        self.md5 = hashlib.md5(self.data).hexdigest()
+        self.target_file_path = os.path.join(self.work_dir.name, "ERR036000_1.fastq.gz")
+        self.part_path, self.progress_path = sra._get_part_paths(self.target_file_path)
+
+    def assertDownloaded(self):
+        with open(self.target_file_path, "rb") as downloaded_file:
+            self.assertEqual(downloaded_file.read(), self.data)
+        self.assertFalse(os.path.exists(self.part_path))
+        self.assertFalse(os.path.exists(self.progress_path))
+
+    @tag("downloaders")
+    @tag("downloaders_sra")
+    def test_download_http_file(self):
+        with LocalFileServer({"/ERR036000_1.fastq.gz": self.data}) as server:
+            sra._download_http_file(
+                server.url + "/ERR036000_1.fastq.gz",
+                self.target_file_path,
+                expected_md5=self.md5,
+                num_connections=4,
+                segment_size=16384,
+                num_attempts=1,
+            )
+
+        self.assertDownloaded()
+        # A HEAD request and one for each of the 7 segments.
+        self.assertEqual(server.num_requests, 8)
+        self.assertEqual(server.bytes_sent, len(self.data))
+
+    @tag("downloaders")
+    @tag("downloaders_sra")
+    def test_resume_http_file(self):
+        # An earlier attempt finished the first three segments.
+        with open(self.part_path, "wb") as part_file:
+            part_file.write(self.data[: 3 * 16384])
+            part_file.truncate(len(self.data))
+        sra._save_finished_segments(self.progress_path, len(self.data), 16384, {0, 1, 2})
+
+        with LocalFileServer({"/ERR036000_1.fastq.gz": self.data}) as server:
+            sra._download_http_file(
+                server.url + "/ERR036000_1.fastq.gz",
+                self.target_file_path,
+                expected_md5=self.md5,
+                num_connections=4,
+                segment_size=16384,
+                num_attempts=1,
+            )
+
+        self.assertDownloaded()
+        self.assertEqual(server.bytes_sent, len(self.data) - 3 * 16384)
+
+    @tag("downloaders")
+    @tag("downloaders_sra")
+    def test_download_http_file_with_incomplete_segment(self):
+        with LocalFileServer(
+            {"/ERR036000_1.fastq.gz": self.data}, num_incomplete_responses=1
+        ) as server:
+            sra._download_http_file(
+                server.url + "/ERR036000_1.fastq.gz",
+                self.target_file_path,
+                expected_md5=self.md5,
+                num_connections=1,
+                segment_size=16384,
+                num_attempts=2,
+            )
+
+        self.assertDownloaded()
+        # The retry only downloads the segment that was cut short.
+        self.assertEqual(server.num_requests, 10)
+        self.assertEqual(server.bytes_sent, len(self.data) + 16384 // 2)
+
+    @tag("downloaders")
+    @tag("downloaders_sra")
+    def test_download_http_file_with_ignored_ranges(self):
+        with LocalFileServer({"/ERR036000_1.fastq.gz": self.data}, ignore_ranges=True) as server:
+            sra._download_http_file(
+                server.url + "/ERR036000_1.fastq.gz",
+                self.target_file_path,
+                expected_md5=self.md5,
+                num_connections=1,
+                segment_size=16384,
+                num_attempts=1,
+            )
+
+        self.assertDownloaded()
+
+    @tag("downloaders")
+    @tag("downloaders_sra")
+    def test_download_http_file_without_ranges(self):
+        with LocalFileServer({"/ERR036000_1.fastq.gz": self.data}, accept_ranges=False) as server:
+            sra._download_http_file(
+                server.url + "/ERR036000_1.fastq.gz",
+                self.target_file_path,
+                expected_md5=self.md5,
+                segment_size=16384,
+                num_attempts=1,
+            )
+
+        self.assertDownloaded()
+        self.assertEqual(server.num_requests, 2)
+
+    @tag("downloaders")
+    @tag("downloaders_sra")
+    def test_verify_http_file(self):
+        with LocalFileServer({"/ERR036000_1.fastq.gz": self.data}) as server:
+            with self.assertRaises(sra.DownloadVerificationError):
+                sra._download_http_file(
+                    server.url + "/ERR036000_1.fastq.gz",
+                    self.target_file_path,
+                    expected_md5=hashlib.md5(b"something else").hexdigest(),
+                    segment_size=16384,
+                    num_attempts=3,
+                )
+            # Mismatches aren't retried.
+            self.assertEqual(server.num_requests, 8)
+
+            with self.assertRaises(sra.DownloadVerificationError):
+                sra._download_http_file(
+                    server.url + "/ERR036000_1.fastq.gz",
+                    self.target_file_path,
+                    expected_size=len(self.data) + 1,
+                    segment_size=16384,
+                    num_attempts=1,
+                )
+
+        self.assertFalse(os.path.exists(self.target_file_path))
+        self.assertFalse(os.path.exists(self.part_path))
+        self.assertFalse(os.path.exists(self.progress_path))
+
+    @tag("downloaders")
+    @tag("downloaders_sra")
+    def test_resume_ftp_file(self):
+        # An earlier attempt got the first half of the file.
+        with open(self.part_path, "wb") as part_file:
+            part_file.write(self.data[:50000])
+
+        def retrbinary(command, callback, blocksize, rest=None):
+            callback(self.data[rest or 0 :])
+
+        ftp = MagicMock()
+        ftp.retrbinary.side_effect = retrbinary
+        with patch.object(sra, "FTP", return_value=ftp):
+            sra._download_ftp_file(
+                "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036000/ERR036000_1.fastq.gz",
+                self.target_file_path,
+                expected_size=len(self.data),
+                expected_md5=self.md5,
+                num_attempts=1,
+            )
+
+        self.assertDownloaded()
+        ftp.retrbinary.assert_called_once()
+        self.assertEqual(ftp.retrbinary.call_args[1]["rest"], 50000)
+
+    @tag("downloaders")
+    @tag("downloaders_sra")
+    def test_get_ena_file_metadata(self):
+        response = MagicMock()
+        response.text = (
+            "run_accession\tfastq_ftp\tfastq_bytes\tfastq_md5\n"
+            "ERR036000\t"
+            "ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036000/ERR036000_1.fastq.gz;"
+            "ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036000/ERR036000_2.fastq.gz\t"
+            "100;200\tabc;def\n"
+        )
+        url = "ftp://ftp.sra.ebi.ac.uk/vol1/fastq/ERR036/ERR036000/ERR036000_2.fastq.gz"
+
+        with patch.object(sra.requests, "get", return_value=response):
+            self.assertEqual(sra._get_ena_file_metadata(url), (200, "def"))
+
+        with patch.object(sra.requests, "get", side_effect=ConnectionError):
+            self.assertEqual(sra._get_ena_file_metadata(url), (None, None))
+
+    @tag("downloaders")
+    @tag("downloaders_sra")
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command(
+            "benchmark_sra_download",
+            file_size=0.5,
+            connections="1,4",
+            segment_size=0.125,
+            bandwidth=100,
+            stdout=stdout,
+        )
+
+        rows = [line.split("\t") for line in stdout.getvalue().strip().split("\n")[1:]]
+        self.assertEqual([row[0] for row in rows], ["1", "4"])
+        # A HEAD request and one for each of the 4 segments.
+        self.assertEqual([row[3] for row in rows], ["5", "5"])
@@ -28,6 +28,9 @@ S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
 logger = get_and_configure_logger(__name__)
 
+# Chip names to BrainArray ensg packages, see _create_ensg_pkg_map.
+_ensg_pkg_map = {}
+
 
 def _prepare_files(job_context: Dict) -> Dict:
     """Moves the CEL file from the raw directory to the temp directory.
@@ -63,7 +66,12 @@ def _create_ensg_pkg_map() -> Dict:
     """Reads the text file that was generated when installing ensg R
     packages, and returns a map whose keys are chip names and values are
     the corresponding BrainArray ensg package name.
+
+    The file only changes with the image, so it's read once per process.
     """
+    if _ensg_pkg_map:
+        return _ensg_pkg_map
+
     ensg_pkg_filename = "/home/user/r_ensg_probe_pkgs.txt"
     chip2pkg = dict()
     with open(ensg_pkg_filename) as file_handler:
@@ -75,6 +83,7 @@ def _create_ensg_pkg_map() -> Dict:
             pkg_name = tokens[1].split("/")[-1].split("_")[0]
             chip2pkg[tokens[0]] = pkg_name
 
+    _ensg_pkg_map.update(chip2pkg)
     return chip2pkg
 
 
@@ -2,8 +2,9 @@ import itertools
 import logging
 import os
 import shutil
+import tempfile
 import time
-from typing import Dict
+from typing import Dict, Tuple
 
 from django.conf import settings
 from django.utils import timezone
@@ -33,7 +34,11 @@ pd.set_option("mode.chained_assignment", None)
 
 S3_COMPENDIA_BUCKET_NAME = get_env_variable("S3_COMPENDIA_BUCKET_NAME", "data-refinery")
 BYTES_IN_GB = 1024 * 1024 * 1024
+# The smallest float32 difference, which IterativeSVD's convergence check also uses.
+F32PREC = np.finfo(np.float32).eps
 SMASHING_DIR = "/home/user/data_store/smashed/"
+# The number of values ChunkedIterativeSVD reads into memory at a time.
+SVD_BLOCK_SIZE = 4 * 1024 * 1024
 logger = get_and_configure_logger(__name__)
 # DEBUG #
 logger.setLevel(logging.getLevelName("DEBUG"))
@@ -119,220 +124,349 @@ def _prepare_frames(job_context: Dict) -> Dict:
     return job_context
 
 
-def _perform_imputation(job_context: Dict) -> Dict:
-    """
-
-    Take the inputs and perform the primary imputation.
-
-    Via https://github.com/AlexsLemonade/refinebio/issues/508#issuecomment-435879283:
-     - Combine all microarray samples with a full join to form a
-       microarray_expression_matrix (this may end up being a DataFrame).
-     - Combine all RNA-seq samples (lengthScaledTPM) with a full outer join
-       to form a rnaseq_expression_matrix.
-     - Calculate the sum of the lengthScaledTPM values for each row (gene) of
-       the rnaseq_expression_matrix (rnaseq_row_sums).
-     - Calculate the 10th percentile of rnaseq_row_sums
-     - Drop all rows in rnaseq_expression_matrix with a row sum < 10th percentile of
-       rnaseq_row_sums; this is now filtered_rnaseq_matrix
-     - log2(x + 1) transform filtered_rnaseq_matrix; this is now log2_rnaseq_matrix
-     - Set all zero values in log2_rnaseq_matrix to NA, but make sure to keep track of
-       where these zeroes are
-     - Perform a full outer join of microarray_expression_matrix and
-       log2_rnaseq_matrix; combined_matrix
-     - Remove genes (rows) with >30% missing values in combined_matrix
-     - Remove samples (columns) with >50% missing values in combined_matrix
-     - "Reset" zero values that were set to NA in RNA-seq samples (i.e., make these zero
-       again) in combined_matrix
-     - Transpose combined_matrix; transposed_matrix
-     - Perform imputation of missing values with IterativeSVD (rank=10) on
-       the transposed_matrix; imputed_matrix
-        -- with specified svd algorithm or skip
-     - Untranspose imputed_matrix (genes are now rows, samples are now columns)
-     - Quantile normalize imputed_matrix where genes are rows and samples are columns
+def _log2_rnaseq_matrix(rnaseq_matrix: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Drops the RNA-seq genes with a row sum below the 10th percentile
+    and log2(x + 1) transforms the rest.
 
+    Zeroes are set to NA so they aren't counted as present values when
+    the combined matrix is filtered. Returns the transformed matrix and
+    a boolean frame marking where the zeroes were, for `_restore_zeroes`.
     """
-    imputation_start = log_state("start perform imputation", job_context["job"].id)
-    job_context["time_start"] = timezone.now()
-    rnaseq_row_sums_start = log_state("start rnaseq row sums", job_context["job"].id)
-
-    # We potentially can have a microarray-only compendia but not a RNASeq-only compendia
-    log2_rnaseq_matrix = None
-    if job_context["rnaseq_matrix"] is not None:
-        # Drop any genes that are entirely NULL in the RNA-Seq matrix
-        job_context["rnaseq_matrix"] = job_context["rnaseq_matrix"].dropna(
-            axis="columns", how="all"
-        )
-
-        # Calculate the sum of the lengthScaledTPM values for each row
-        # (gene) of the rnaseq_matrix (rnaseq_row_sums)
-        rnaseq_row_sums = np.sum(job_context["rnaseq_matrix"], axis=1)
-
-        log_state("end rnaseq row sums", job_context["job"].id, rnaseq_row_sums_start)
-        rnaseq_decile_start = log_state("start rnaseq decile", job_context["job"].id)
-
-        # Calculate the 10th percentile of rnaseq_row_sums
-        rnaseq_tenth_percentile = np.percentile(rnaseq_row_sums, 10)
-
-        log_state("end rnaseq decile", job_context["job"].id, rnaseq_decile_start)
-        drop_start = log_state("drop all rows", job_context["job"].id)
-        # Drop all rows in rnaseq_matrix with a row sum < 10th
-        # percentile of rnaseq_row_sums; this is now
-        # filtered_rnaseq_matrix
-        # TODO: This is probably a better way to do this with `np.where`
-        rows_to_filter = []
-        for (x, sum_val) in rnaseq_row_sums.items():
-            if sum_val < rnaseq_tenth_percentile:
-                rows_to_filter.append(x)
+    # Drop any genes that are entirely NULL in the RNA-Seq matrix
+    rnaseq_matrix = rnaseq_matrix.dropna(axis="columns", how="all")
+
+    # Calculate the sum of the lengthScaledTPM values for each row
+    # (gene) of the rnaseq_matrix (rnaseq_row_sums)
+    rnaseq_row_sums = rnaseq_matrix.sum(axis=1)
+
+    # Drop all rows in rnaseq_matrix with a row sum < 10th percentile
+    # of rnaseq_row_sums; this is now filtered_rnaseq_matrix
+    rnaseq_tenth_percentile = np.percentile(rnaseq_row_sums, 10)
+    filtered_rnaseq_matrix = rnaseq_matrix.loc[
+        ~(rnaseq_row_sums < rnaseq_tenth_percentile).to_numpy()
+    ]
+    del rnaseq_matrix
 
-        del rnaseq_row_sums
+    # log2(x + 1) transform filtered_rnaseq_matrix; this is now log2_rnaseq_matrix
+    log2_values = np.log2(filtered_rnaseq_matrix.to_numpy() + 1)
 
-        log_state("actually calling drop()", job_context["job"].id)
+    # Set all zero values to NA, but keep track of where they were.
+    is_zero = log2_values == 0
+    log2_values[is_zero] = np.nan
 
-        filtered_rnaseq_matrix = job_context.pop("rnaseq_matrix").drop(rows_to_filter)
+    index = filtered_rnaseq_matrix.index
+    columns = filtered_rnaseq_matrix.columns
+    return (
+        pd.DataFrame(log2_values, index=index, columns=columns),
+        pd.DataFrame(is_zero, index=index, columns=columns),
+    )
 
-        del rows_to_filter
 
-        log_state("end drop all rows", job_context["job"].id, drop_start)
-        log2_start = log_state("start log2", job_context["job"].id)
+def _restore_zeroes(matrix: pd.DataFrame, zeroes: pd.DataFrame) -> pd.DataFrame:
+    """Sets the values of `matrix` that are marked in `zeroes` back to
+    zero. Genes and samples that aren't in both are left alone.
 
-        # log2(x + 1) transform filtered_rnaseq_matrix; this is now log2_rnaseq_matrix
-        filtered_rnaseq_matrix_plus_one = filtered_rnaseq_matrix + 1
-        log2_rnaseq_matrix = np.log2(filtered_rnaseq_matrix_plus_one)
-        del filtered_rnaseq_matrix_plus_one
-        del filtered_rnaseq_matrix
+    The values are changed in place one sample at a time, so nothing
+    the size of the matrix is allocated.
+    """
+    genes = matrix.index.intersection(zeroes.index)
+    matrix_rows = matrix.index.get_indexer(genes)
+    zeroes_rows = zeroes.index.get_indexer(genes)
 
-        log_state("end log2", job_context["job"].id, log2_start)
-        cache_start = log_state("start caching zeroes", job_context["job"].id)
+    for sample in matrix.columns.intersection(zeroes.columns):
+        is_zero = zeroes[sample].to_numpy()[zeroes_rows]
+        matrix.iloc[matrix_rows[is_zero], matrix.columns.get_loc(sample)] = 0
 
-        # Cache our RNA-Seq zero values
-        cached_zeroes = {}
-        for column in log2_rnaseq_matrix.columns:
-            cached_zeroes[column] = log2_rnaseq_matrix.index[
-                np.where(log2_rnaseq_matrix[column] == 0)
-            ]
+    return matrix
 
-        # Set all zero values in log2_rnaseq_matrix to NA, but make sure
-        # to keep track of where these zeroes are
-        log2_rnaseq_matrix[log2_rnaseq_matrix == 0] = np.nan
 
-        log_state("end caching zeroes", job_context["job"].id, cache_start)
+def _prepare_imputation_matrix(
+    microarray_matrix: pd.DataFrame, rnaseq_matrix: pd.DataFrame = None
+) -> Tuple[pd.DataFrame, pd.Index]:
+    """Combines the microarray and RNA-seq matrices into the matrix that
+    gets imputed, following the steps described in `_perform_imputation`
+    up to the transpose.
 
-    outer_merge_start = log_state("start outer merge", job_context["job"].id)
+    Returns the combined matrix and the accession codes of the samples
+    that were dropped for having too many missing values.
+    """
+    log2_rnaseq_matrix = None
+    rnaseq_zeroes = None
+    if rnaseq_matrix is not None:
+        log2_rnaseq_matrix, rnaseq_zeroes = _log2_rnaseq_matrix(rnaseq_matrix)
+        del rnaseq_matrix
 
     # Perform a full outer join of microarray_matrix and
     # log2_rnaseq_matrix; combined_matrix
     if log2_rnaseq_matrix is not None:
-        combined_matrix = job_context.pop("microarray_matrix").merge(
+        combined_matrix = microarray_matrix.merge(
             log2_rnaseq_matrix, how="outer", left_index=True, right_index=True
         )
     else:
-        logger.info("Building compendia with only microarray data.", job_id=job_context["job"].id)
-        combined_matrix = job_context.pop("microarray_matrix")
-
-    log_state("ran outer merge, now deleteing log2_rnaseq_matrix", job_context["job"].id)
-
+        combined_matrix = microarray_matrix
+    del microarray_matrix
     del log2_rnaseq_matrix
 
-    log_state("end outer merge", job_context["job"].id, outer_merge_start)
-    drop_na_genes_start = log_state("start drop NA genes", job_context["job"].id)
-
-    # # Visualize Prefiltered
-    # output_path = job_context['output_dir'] + "pre_filtered_" + str(time.time()) + ".png"
-    # visualized_prefilter = visualize.visualize(combined_matrix.copy(), output_path)
-
     # Remove genes (rows) with <=70% present values in combined_matrix
     thresh = combined_matrix.shape[1] * 0.7  # (Rows, Columns)
     # Everything below `thresh` is dropped
     row_filtered_matrix = combined_matrix.dropna(axis="index", thresh=thresh)
-
     del combined_matrix
-    del thresh
-
-    log_state("end drop NA genes", job_context["job"].id, drop_na_genes_start)
-    drop_na_samples_start = log_state("start drop NA samples", job_context["job"].id)
-
-    # # Visualize Row Filtered
-    # output_path = job_context['output_dir'] + "row_filtered_" + str(time.time()) + ".png"
-    # visualized_rowfilter = visualize.visualize(row_filtered_matrix.copy(), output_path)
 
     # Remove samples (columns) with <50% present values in combined_matrix
     # XXX: Find better test data for this!
     col_thresh = row_filtered_matrix.shape[0] * 0.5
-    row_col_filtered_matrix_samples = row_filtered_matrix.dropna(axis="columns", thresh=col_thresh)
-    row_col_filtered_matrix_samples_index = row_col_filtered_matrix_samples.index
-    row_col_filtered_matrix_samples_columns = row_col_filtered_matrix_samples.columns
-
-    log_state("end drop NA genes", job_context["job"].id, drop_na_samples_start)
-    replace_zeroes_start = log_state("start replace zeroes", job_context["job"].id)
-
-    for sample_accession_code in row_filtered_matrix.columns:
-        if sample_accession_code not in row_col_filtered_matrix_samples_columns:
-            sample = Sample.objects.get(accession_code=sample_accession_code)
-            sample_metadata = sample.to_metadata_dict()
-            job_context["filtered_samples"][sample_accession_code] = {
-                **sample_metadata,
-                "reason": "Sample was dropped because it had less than 50% present values.",
-                "experiment_accession_code": smashing_utils.get_experiment_accession(
-                    sample.accession_code, job_context["dataset"].data
-                ),
-            }
-
+    row_col_filtered_matrix = row_filtered_matrix.dropna(axis="columns", thresh=col_thresh)
+    dropped_sample_codes = row_filtered_matrix.columns.difference(row_col_filtered_matrix.columns)
     del row_filtered_matrix
 
-    # # Visualize Row and Column Filtered
-    # output_path = job_context['output_dir'] + "row_col_filtered_" + str(time.time()) + ".png"
-    # visualized_rowcolfilter = visualize.visualize(row_col_filtered_matrix_samples.copy(),
-    #                                               output_path)
-
     # "Reset" zero values that were set to NA in RNA-seq samples
     # (i.e., make these zero again) in combined_matrix
-    for column in cached_zeroes.keys():
-        zeroes = cached_zeroes[column]
-
-        # Skip purged columns
-        if column not in row_col_filtered_matrix_samples:
-            continue
-
-        # Place the zero
-        try:
-            # This generates a warning, so use loc[] instead
-            # row_col_filtered_matrix_samples[column].replace(zeroes, 0.0, inplace=True)
-            zeroes_list = zeroes.tolist()
-            new_index_list = row_col_filtered_matrix_samples_index.tolist()
-            new_zeroes = list(set(new_index_list) & set(zeroes_list))
-            row_col_filtered_matrix_samples[column].loc[new_zeroes] = 0.0
-        except Exception:
-            logger.warn("Error when replacing zero")
-            continue
-
-    log_state("end replace zeroes", job_context["job"].id, replace_zeroes_start)
-    transposed_zeroes_start = log_state("start replacing transposed zeroes", job_context["job"].id)
-
-    # Label our new replaced data
-    combined_matrix_zero = row_col_filtered_matrix_samples
-    del row_col_filtered_matrix_samples
-
-    transposed_matrix_with_zeros = combined_matrix_zero.T
-    del combined_matrix_zero
+    if rnaseq_zeroes is not None:
+        row_col_filtered_matrix = _restore_zeroes(row_col_filtered_matrix, rnaseq_zeroes)
 
     # Remove -inf and inf
     # This should never happen, but make sure it doesn't!
-    transposed_matrix = transposed_matrix_with_zeros.replace([np.inf, -np.inf], np.nan)
-    del transposed_matrix_with_zeros
+    row_col_filtered_matrix = row_col_filtered_matrix.replace([np.inf, -np.inf], np.nan)
+
+    return row_col_filtered_matrix, dropped_sample_codes
+
 
-    log_state("end replacing transposed zeroes", job_context["job"].id, transposed_zeroes_start)
+class ChunkedIterativeSVD:
+    """Imputes missing values the same way fancyimpute's IterativeSVD
+    does, without ever holding more than a block of the matrix in memory.
+
+    The matrix is copied into a float32 memory-mapped file and every
+    iteration streams over it in blocks of rows: a randomized truncated
+    SVD is computed with a few passes over the blocks, then each block's
+    missing values are replaced with its low rank reconstruction. Like
+    IterativeSVD the missing values start out as zero, the rank is
+    gradually increased up to `rank`, and it stops once the missing
+    values change by less than `convergence_threshold`.
+    """
+
+    def __init__(
+        self,
+        rank: int = 10,
+        convergence_threshold: float = 0.00001,
+        max_iters: int = 200,
+        gradual_rank_increase: bool = True,
+        n_oversamples: int = 10,
+        n_power_iterations: int = 5,
+        block_size: int = SVD_BLOCK_SIZE,
+        work_dir: str = None,
+        random_state: int = None,
+    ):
+        self.rank = rank
+        self.convergence_threshold = convergence_threshold
+        self.max_iters = max_iters
+        self.gradual_rank_increase = gradual_rank_increase
+        self.n_oversamples = n_oversamples
+        self.n_power_iterations = n_power_iterations
+        self.block_size = block_size
+        self.work_dir = work_dir
+        self.random = np.random.RandomState(random_state)
+
+    def _make_memmap(self, shape, dtype) -> np.memmap:
+        # The file is deleted as soon as it's closed, but the mapping
+        # keeps it around for as long as the array is used.
+        return np.memmap(
+            tempfile.TemporaryFile(dir=self.work_dir), dtype=dtype, mode="w+", shape=shape
+        )
+
+    def _get_blocks(self, num_rows: int, num_columns: int):
+        rows_per_block = max(1, self.block_size // max(num_columns, 1))
+        for start in range(0, num_rows, rows_per_block):
+            yield slice(start, min(start + rows_per_block, num_rows))
+
+    def _fit_components(self, matrix: np.ndarray, rank: int):
+        """Returns the rank `rank` truncated SVD of `matrix` as the left
+        singular vectors scaled by the singular values and the right
+        singular vectors, like sklearn's randomized_svd would."""
+        num_rows, num_columns = matrix.shape
+        blocks = list(self._get_blocks(num_rows, num_columns))
+        num_vectors = min(rank + self.n_oversamples, num_rows, num_columns)
+
+        # The blocks are multiplied in float32 so they're never upcast,
+        # but the products are accumulated in float64.
+        def multiply(right: np.ndarray) -> np.ndarray:
+            right = right.astype(np.float32)
+            product = np.empty((num_rows, right.shape[1]))
+            for block in blocks:
+                product[block] = matrix[block] @ right
+            return product
+
+        def multiply_transpose(left: np.ndarray) -> np.ndarray:
+            left = left.astype(np.float32)
+            product = np.zeros((num_columns, left.shape[1]))
+            for block in blocks:
+                product += matrix[block].T @ left[block]
+            return product
+
+        # Find an orthonormal basis for the range of the matrix with a few
+        # power iterations, orthonormalizing in between for stability.
+        basis = multiply(self.random.normal(size=(num_columns, num_vectors)))
+        for _ in range(self.n_power_iterations):
+            basis, _ = np.linalg.qr(basis)
+            column_basis, _ = np.linalg.qr(multiply_transpose(basis))
+            basis = multiply(column_basis)
+        basis, _ = np.linalg.qr(basis)
+
+        # Then take the SVD of the matrix projected onto that basis.
+        u, sigma, vt = np.linalg.svd(multiply_transpose(basis).T, full_matrices=False)
+        return (basis @ u[:, :rank]) * sigma[:rank], vt[:rank]
+
+    def copy_matrix(self, matrix) -> Tuple[np.memmap, np.memmap]:
+        """Copies `matrix` into float32 memory-mapped files, returning it
+        with its missing values set to zero and the mask of where they
+        were. Once this returns, `matrix` can be freed before `impute` is
+        called."""
+        num_rows, num_columns = matrix.shape
+        filled = self._make_memmap((num_rows, num_columns), np.float32)
+        missing_mask = self._make_memmap((num_rows, num_columns), bool)
+        for block in self._get_blocks(num_rows, num_columns):
+            values = np.asarray(matrix[block], dtype=np.float32)
+            missing_mask[block] = np.isnan(values)
+            filled[block] = np.where(missing_mask[block], 0, values)
+
+        return filled, missing_mask
+
+    def fit_transform(self, matrix) -> np.ndarray:
+        """Returns a float32 memory-mapped copy of `matrix` with its
+        missing values imputed."""
+        return self.impute(*self.copy_matrix(matrix))
+
+    def impute(self, filled: np.memmap, missing_mask: np.memmap) -> np.memmap:
+        """Imputes the missing values of a matrix copied by `copy_matrix`
+        in place and returns it."""
+        blocks = list(self._get_blocks(*filled.shape))
+        if not missing_mask.any():
+            return filled
+
+        for i in range(self.max_iters):
+            if self.gradual_rank_increase:
+                current_rank = min(2 ** i, self.rank)
+            else:
+                current_rank = self.rank
+            scaled_u, vt = self._fit_components(filled, current_rank)
+            scaled_u = scaled_u.astype(np.float32)
+            vt = vt.astype(np.float32)
+
+            squared_difference = 0.0
+            squared_old_norm = 0.0
+            for block in blocks:
+                block_missing = missing_mask[block]
+                old_values = filled[block][block_missing]
+                new_values = (scaled_u[block] @ vt)[block_missing]
+
+                squared_difference += np.sum((old_values - new_values) ** 2, dtype=np.float64)
+                squared_old_norm += np.sum(old_values ** 2, dtype=np.float64)
+
+                filled[block][block_missing] = new_values
+
+            logger.debug(
+                "Finished ChunkedIterativeSVD iteration.",
+                iteration=i,
+                rank=current_rank,
+                squared_difference=squared_difference,
+            )
+            # This is the same check that IterativeSVD does.
+            old_norm = np.sqrt(squared_old_norm)
+            difference = np.sqrt(squared_difference)
+            if old_norm > 0 and not (old_norm < F32PREC and difference > F32PREC):
+                if difference / old_norm < self.convergence_threshold:
+                    break
+
+        return filled
+
+
+def _perform_imputation(job_context: Dict) -> Dict:
+    """
+
+    Take the inputs and perform the primary imputation.
+
+    Via https://github.com/AlexsLemonade/refinebio/issues/508#issuecomment-435879283:
+     - Combine all microarray samples with a full join to form a
+       microarray_expression_matrix (this may end up being a DataFrame).
+     - Combine all RNA-seq samples (lengthScaledTPM) with a full outer join
+       to form a rnaseq_expression_matrix.
+     - Calculate the sum of the lengthScaledTPM values for each row (gene) of
+       the rnaseq_expression_matrix (rnaseq_row_sums).
+     - Calculate the 10th percentile of rnaseq_row_sums
+     - Drop all rows in rnaseq_expression_matrix with a row sum < 10th percentile of
+       rnaseq_row_sums; this is now filtered_rnaseq_matrix
+     - log2(x + 1) transform filtered_rnaseq_matrix; this is now log2_rnaseq_matrix
+     - Set all zero values in log2_rnaseq_matrix to NA, but make sure to keep track of
+       where these zeroes are
+     - Perform a full outer join of microarray_expression_matrix and
+       log2_rnaseq_matrix; combined_matrix
+     - Remove genes (rows) with >30% missing values in combined_matrix
+     - Remove samples (columns) with >50% missing values in combined_matrix
+     - "Reset" zero values that were set to NA in RNA-seq samples (i.e., make these zero
+       again) in combined_matrix
+     - Transpose combined_matrix; transposed_matrix
+     - Perform imputation of missing values with IterativeSVD (rank=10) on
+       the transposed_matrix; imputed_matrix
+        -- with specified svd algorithm or skip
+        -- or with ChunkedIterativeSVD, which keeps the matrix on disk
+     - Untranspose imputed_matrix (genes are now rows, samples are now columns)
+     - Quantile normalize imputed_matrix where genes are rows and samples are columns
+
+    """
+    imputation_start = log_state("start perform imputation", job_context["job"].id)
+    job_context["time_start"] = timezone.now()
+    prepare_start = log_state("start preparing matrix for imputation", job_context["job"].id)
+
+    # We potentially can have a microarray-only compendia but not a RNASeq-only compendia
+    if job_context["rnaseq_matrix"] is None:
+        logger.info("Building compendia with only microarray data.", job_id=job_context["job"].id)
+
+    combined_matrix, dropped_sample_codes = _prepare_imputation_matrix(
+        job_context.pop("microarray_matrix"), job_context.pop("rnaseq_matrix")
+    )
+    row_col_filtered_matrix_samples_index = combined_matrix.index
+    row_col_filtered_matrix_samples_columns = combined_matrix.columns
+
+    dropped_samples = Sample.objects.filter(accession_code__in=dropped_sample_codes)
+    for sample_accession_code, sample_metadata in Sample.get_metadata_dicts(
+        dropped_samples
+    ).items():
+        job_context["filtered_samples"][sample_accession_code] = {
+            **sample_metadata,
+            "reason": "Sample was dropped because it had less than 50% present values.",
+            "experiment_accession_code": smashing_utils.get_experiment_accession(
+                sample_accession_code, job_context["dataset"].data
+            ),
+        }
+
+    log_state("end preparing matrix for imputation", job_context["job"].id, prepare_start)
+
+    transposed_matrix = combined_matrix.T
+    del combined_matrix
 
     # Store the absolute/percentages of imputed values
-    matrix_sum = transposed_matrix.isnull().sum()
-    percent = (matrix_sum / transposed_matrix.isnull().count()).sort_values(ascending=False)
-    total_percent_imputed = sum(percent) / len(transposed_matrix.count())
+    total_percent_imputed = np.isnan(transposed_matrix.to_numpy()).mean()
     job_context["total_percent_imputed"] = total_percent_imputed
     logger.info("Total percentage of data to impute!", total_percent_imputed=total_percent_imputed)
 
     # Perform imputation of missing values with IterativeSVD (rank=10) on the
     # transposed_matrix; imputed_matrix
     svd_algorithm = job_context["dataset"].svd_algorithm
-    if svd_algorithm != "NONE":
+    if svd_algorithm == "CHUNKED":
+        svd_start = log_state("start chunked SVD", job_context["job"].id)
+
+        # The matrix is copied into memory-mapped files in the work_dir
+        # and freed before imputing, so only a block of it is ever held in
+        # memory.
+        chunked_svd = ChunkedIterativeSVD(rank=10, work_dir=job_context["work_dir"])
+        filled, missing_mask = chunked_svd.copy_matrix(transposed_matrix.values)
+        del transposed_matrix
+
+        imputed_matrix = chunked_svd.impute(filled, missing_mask)
+        del filled, missing_mask
+
+        log_state("end chunked SVD", job_context["job"].id, svd_start)
+    elif svd_algorithm != "NONE":
         svd_start = log_state("start SVD", job_context["job"].id)
 
         logger.info("IterativeSVD algorithm: %s" % svd_algorithm)
@@ -340,12 +474,13 @@ def _perform_imputation(job_context: Dict) -> Dict:
         imputed_matrix = IterativeSVD(rank=10, svd_algorithm=svd_algorithm).fit_transform(
             transposed_matrix
         )
+        del transposed_matrix
 
         log_state("end SVD", job_context["job"].id, svd_start)
     else:
         imputed_matrix = transposed_matrix
+        del transposed_matrix
         logger.info("Skipping IterativeSVD")
-    del transposed_matrix
 
     untranspose_start = log_state("start untranspose", job_context["job"].id)
 
@@ -353,10 +488,13 @@ def _perform_imputation(job_context: Dict) -> Dict:
     untransposed_imputed_matrix = imputed_matrix.T
     del imputed_matrix
 
-    # Convert back to Pandas
-    untransposed_imputed_matrix_df = pd.DataFrame.from_records(untransposed_imputed_matrix)
-    untransposed_imputed_matrix_df.index = row_col_filtered_matrix_samples_index
-    untransposed_imputed_matrix_df.columns = row_col_filtered_matrix_samples_columns
+    # Convert back to Pandas without copying the values, so that a
+    # memory-mapped matrix stays on disk.
+    untransposed_imputed_matrix_df = pd.DataFrame(
+        np.asarray(untransposed_imputed_matrix),
+        index=row_col_filtered_matrix_samples_index,
+        columns=row_col_filtered_matrix_samples_columns,
+    )
     del untransposed_imputed_matrix
     del row_col_filtered_matrix_samples_index
     del row_col_filtered_matrix_samples_columns
@@ -371,7 +509,7 @@ def _perform_imputation(job_context: Dict) -> Dict:
     quantile_start = log_state("start quantile normalize", job_context["job"].id)
 
     # Perform the Quantile Normalization
-    job_context = smashing_utils.quantile_normalize(job_context, ks_check=False)
+    job_context = smashing_utils.quantile_normalize(job_context, ks_check=False, in_place=True)
 
     log_state("end quantile normalize", job_context["job"].id, quantile_start)
 
@@ -404,10 +542,6 @@ def _create_result_objects(job_context: Dict) -> Dict:
         return utils.handle_processor_exception(job_context, processor_key, e)
     result.save()
 
-    # Write the compendia dataframe to a file
-    job_context["csv_outfile"] = job_context["output_dir"] + job_context["organism_name"] + ".tsv"
-    job_context["merged_qn"].to_csv(job_context["csv_outfile"], sep="\t", encoding="utf-8")
-
     organism_key = list(job_context["samples"].keys())[0]
     annotation = ComputationalResultAnnotation()
     annotation.result = result
@@ -425,16 +559,26 @@ def _create_result_objects(job_context: Dict) -> Dict:
     annotation.save()
 
     # Create the resulting archive
-    final_zip_base = SMASHING_DIR + str(job_context["dataset"].pk) + "_compendia"
-    # Copy LICENSE.txt and correct README.md files.
-    if job_context["dataset"].quant_sf_only:
-        readme_file = "/home/user/README_QUANT.md"
-    else:
-        readme_file = "/home/user/README_NORMALIZED.md"
+    archive_path = SMASHING_DIR + str(job_context["dataset"].pk) + "_compendia.zip"
+    with smashing_utils.ArchiveWriter(archive_path, job_context["output_dir"]) as archive:
+        # Stream the compendia dataframe straight into the archive
+        outfiles = smashing_utils.write_matrix(
+            job_context["merged_qn"],
+            job_context["output_dir"] + job_context["organism_name"],
+            job_context["dataset"].file_format,
+            archive,
+        )
+        job_context["csv_outfile"] = outfiles[0]
 
-    shutil.copy(readme_file, job_context["output_dir"] + "/README.md")
-    shutil.copy("/home/user/LICENSE_DATASET.txt", job_context["output_dir"] + "/LICENSE.TXT")
-    archive_path = shutil.make_archive(final_zip_base, "zip", job_context["output_dir"])
+        # Copy LICENSE.txt and correct README.md files.
+        if job_context["dataset"].quant_sf_only:
+            readme_file = "/home/user/README_QUANT.md"
+        else:
+            readme_file = "/home/user/README_NORMALIZED.md"
+
+        shutil.copy(readme_file, job_context["output_dir"] + "/README.md")
+        shutil.copy("/home/user/LICENSE_DATASET.txt", job_context["output_dir"] + "/LICENSE.TXT")
+        archive.write_directory()
 
     archive_computed_file = ComputedFile()
     archive_computed_file.absolute_file_path = archive_path
@@ -501,6 +645,9 @@ def _create_result_objects(job_context: Dict) -> Dict:
     job_context["result"] = result
     job_context["success"] = True
 
+    # The job won't be retried, so the matrices it cached aren't needed.
+    smashing_utils.remove_cached_matrices(job_context["work_dir"])
+
     log_state("end create result object", job_context["job"].id, result_start)
 
     # TEMPORARY for iterating on compendia more quickly.
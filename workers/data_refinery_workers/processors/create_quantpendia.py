@@ -55,21 +55,26 @@ def _download_files(job_context: Dict) -> Dict:
     job_context["time_start"] = timezone.now()
 
     num_samples = 0
-    for key, samples in job_context["samples"].items():
-        outfile_dir = job_context["output_dir"] + key + "/"
-        os.makedirs(outfile_dir, exist_ok=True)
-
-        logger.debug(
-            "Downloading quant.sf files for quantpendia.",
-            accession_code=key,
-            job_id=job_context["job_id"],
-            **get_process_stats()
-        )
-
-        # download quant.sf files directly into the dataset folder
-        num_samples += smashing_utils.sync_quant_files(
-            outfile_dir, samples, job_context["filtered_samples"]
-        )
+    # The quant.sf files are compressed into the archive as soon as they're
+    # downloaded so we don't need room for two copies of each of them.
+    with smashing_utils.ArchiveWriter(
+        _get_archive_path(job_context), job_context["output_dir"]
+    ) as archive:
+        for key, samples in job_context["samples"].items():
+            outfile_dir = job_context["output_dir"] + key + "/"
+            os.makedirs(outfile_dir, exist_ok=True)
+
+            logger.debug(
+                "Downloading quant.sf files for quantpendia.",
+                accession_code=key,
+                job_id=job_context["job_id"],
+                **get_process_stats()
+            )
+
+            # download quant.sf files directly into the dataset folder
+            num_samples += smashing_utils.sync_quant_files(
+                outfile_dir, samples, job_context["filtered_samples"], archive
+            )
 
     job_context["num_samples"] = num_samples
     job_context["time_end"] = timezone.now()
@@ -95,22 +100,30 @@ def _add_metadata(job_context: Dict) -> Dict:
     return job_context
 
 
+def _get_archive_path(job_context: Dict) -> str:
+    compendia_organism = _get_organisms(job_context["samples"]).first()
+    return job_context["job_dir"] + compendia_organism.name + "_rnaseq_compendia.zip"
+
+
 @utils.cache_keys("archive_path", work_dir_key="job_dir")
 def _make_archive(job_context: Dict):
-    compendia_organism = _get_organisms(job_context["samples"]).first()
-    final_zip_base = job_context["job_dir"] + compendia_organism.name + "_rnaseq_compendia"
+    """Adds the metadata to the archive the quant.sf files were
+    downloaded into."""
+    archive_path = _get_archive_path(job_context)
 
     logger.debug(
         "Generating archive.",
         job_id=job_context["job_id"],
-        organism_name=compendia_organism.name,
+        archive_path=archive_path,
         **get_process_stats()
     )
-    archive_path = shutil.make_archive(final_zip_base, "zip", job_context["output_dir"])
+    # Files that are already in the archive are skipped, so this can be retried.
+    with smashing_utils.ArchiveWriter(archive_path, job_context["output_dir"], "a") as archive:
+        archive.write_directory()
     logger.debug(
         "Quantpendia zip file generated.",
         job_id=job_context["job_id"],
-        organism_name=compendia_organism.name,
+        archive_path=archive_path,
         **get_process_stats()
     )
 
@@ -0,0 +1,174 @@
+import csv
+import gzip
+import os
+from collections.abc import Mapping
+from typing import Dict, Iterator, List
+
+import numpy as np
+
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_common.utils import get_env_variable
+
+logger = get_and_configure_logger(__name__)
+LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
+GENE_INDEX_DIR = "/home/user/gene_indexes/"
+# Compiled gene indices are shared by all the jobs on an instance.
+GENE_INDEX_CACHE_DIR = os.path.join(LOCAL_ROOT_DIR, "gene_index_cache")
+
+# Loaded gene indices by path, see load_gene_index.
+_gene_index_cache = {}
+
+
+class EnsemblIdMap(Mapping):
+    """A read-only map from the ids of one id type in a gene index to
+    the lists of Ensembl ids they correspond to.
+
+    It's stored the same way as in compiled gene indices: the Ensembl ids
+    of ids[i] are ensembl_ids[offsets[i] : offsets[i + 1]].
+    """
+
+    def __init__(self, ids: np.ndarray, offsets: np.ndarray, ensembl_ids: np.ndarray):
+        self._positions = dict(zip(ids.tolist(), range(len(ids))))
+        self._offsets = offsets.tolist()
+        self._ensembl_ids = ensembl_ids.tolist()
+
+    def __getitem__(self, gene_id: str) -> List[str]:
+        position = self._positions[gene_id]
+        return self._ensembl_ids[self._offsets[position] : self._offsets[position + 1]]
+
+    def __contains__(self, gene_id: object) -> bool:
+        return gene_id in self._positions
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._positions)
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+
+def _parse_gene_index(gene_index_path: str) -> Dict[str, Dict[str, List[str]]]:
+    """Parses a gene index from the identifier refinery, which maps
+    Ensembl ids to the ids of one platform in several id types, into a
+    map from each id type to a map from the ids of that type to their
+    Ensembl ids."""
+    id_columns = {}
+    with gzip.open(gene_index_path, "rt", encoding="utf-8") as gene_index_file:
+        rows = csv.reader(gene_index_file, delimiter="\t")
+        header = next(rows)
+        ensembl_column = header.index("ENSEMBL")
+        for column_name in header:
+            id_columns[column_name] = {}
+
+        for row in rows:
+            ensembl_id = row[ensembl_column]
+            if not ensembl_id:
+                continue
+
+            for column_name, gene_id in zip(header, row):
+                if not gene_id:
+                    continue
+
+                ensembl_ids = id_columns[column_name].setdefault(gene_id, [])
+                # Each pair of ids only needs to be written once.
+                if ensembl_id not in ensembl_ids:
+                    ensembl_ids.append(ensembl_id)
+
+    return id_columns
+
+
+def _compile_gene_index(id_columns: Dict[str, Dict[str, List[str]]]) -> Dict[str, np.ndarray]:
+    """Flattens a parsed gene index into the arrays of an EnsemblIdMap
+    for each id type, which np.load can read without parsing them."""
+    arrays = {}
+    for column_name, ids_to_ensembl_ids in id_columns.items():
+        lengths = [len(ensembl_ids) for ensembl_ids in ids_to_ensembl_ids.values()]
+        arrays[column_name + ".ids"] = np.array(list(ids_to_ensembl_ids.keys()), dtype=str)
+        arrays[column_name + ".offsets"] = np.concatenate([[0], np.cumsum(lengths)]).astype(
+            np.int64
+        )
+        arrays[column_name + ".ensembl_ids"] = np.array(
+            [
+                ensembl_id
+                for ensembl_ids in ids_to_ensembl_ids.values()
+                for ensembl_id in ensembl_ids
+            ],
+            dtype=str,
+        )
+
+    return arrays
+
+
+def _get_compiled_gene_index_path(gene_index_path: str) -> str:
+    """Returns where the compiled copy of the gene index is cached.
+
+    The name includes the size and modification time of the gene index so
+    that images with different versions of it don't share compiled copies.
+    """
+    stat = os.stat(gene_index_path)
+    filename = os.path.basename(gene_index_path).split(".")[0]
+    return os.path.join(
+        GENE_INDEX_CACHE_DIR, "{}_{}_{}.npz".format(filename, stat.st_size, int(stat.st_mtime)),
+    )
+
+
+def _load_compiled_gene_index(compiled_gene_index_path: str) -> Dict[str, np.ndarray]:
+    with np.load(compiled_gene_index_path, allow_pickle=False) as compiled_gene_index:
+        return {name: compiled_gene_index[name] for name in compiled_gene_index.files}
+
+
+def _save_compiled_gene_index(compiled_gene_index_path: str, arrays: Dict[str, np.ndarray]):
+    # Write to a temporary file first so that other jobs never load a
+    # partially written index.
+    os.makedirs(GENE_INDEX_CACHE_DIR, exist_ok=True)
+    temp_path = "{}.{}.tmp.npz".format(compiled_gene_index_path, os.getpid())
+    np.savez(temp_path, **arrays)
+    os.replace(temp_path, compiled_gene_index_path)
+
+
+def load_gene_index(gene_index_path: str) -> Dict[str, EnsemblIdMap]:
+    """Returns a map from each id type in the gene index at
+    `gene_index_path` to a map from the ids of that type to the Ensembl
+    ids they correspond to.
+
+    The first job to need a gene index compiles it into arrays in
+    GENE_INDEX_CACHE_DIR, so later jobs only load those. Loaded gene
+    indices are also cached for the lifetime of the process.
+    """
+    if gene_index_path in _gene_index_cache:
+        return _gene_index_cache[gene_index_path]
+
+    compiled_gene_index_path = _get_compiled_gene_index_path(gene_index_path)
+    arrays = None
+    if os.path.exists(compiled_gene_index_path):
+        try:
+            arrays = _load_compiled_gene_index(compiled_gene_index_path)
+        except Exception:
+            # don't fail if we can't load the cache
+            logger.warning(
+                "Failed to load compiled gene index.",
+                compiled_gene_index_path=compiled_gene_index_path,
+            )
+
+    if arrays is None:
+        arrays = _compile_gene_index(_parse_gene_index(gene_index_path))
+        try:
+            _save_compiled_gene_index(compiled_gene_index_path, arrays)
+        except OSError:
+            # don't fail if we can't save the cache
+            logger.warning(
+                "Failed to save compiled gene index.",
+                compiled_gene_index_path=compiled_gene_index_path,
+            )
+
+    column_names = [name[: -len(".ids")] for name in arrays if name.endswith(".ids")]
+    gene_index = {
+        column_name: EnsemblIdMap(
+            arrays[column_name + ".ids"],
+            arrays[column_name + ".offsets"],
+            arrays[column_name + ".ensembl_ids"],
+        )
+        for column_name in column_names
+    }
+
+    _gene_index_cache[gene_index_path] = gene_index
+    return gene_index
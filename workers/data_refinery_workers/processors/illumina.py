@@ -1,9 +1,11 @@
+import bisect
 import csv
 import multiprocessing
 import os
 import re
 import subprocess
-from typing import Dict
+from collections import defaultdict
+from typing import Dict, List, Set
 
 from django.utils import timezone
 
@@ -72,6 +74,112 @@ def _prepare_files(job_context: Dict) -> Dict:
     return job_context
 
 
+def _get_sample_descriptions(samples: List[Sample]) -> Dict[int, Set[str]]:
+    """Returns the first description in each of the samples' non-CCDL
+    annotations, by sample id, loading all of them in one query.
+
+    Sometimes the title might actually be in the description field.
+    Related: https://github.com/AlexsLemonade/refinebio/issues/499
+    """
+    descriptions = defaultdict(set)
+    annotations = SampleAnnotation.objects.filter(sample__in=samples, is_ccdl=False).values_list(
+        "sample_id", "data"
+    )
+    for sample_id, data in annotations:
+        try:
+            description = data.get("description", "")[0]
+        except Exception:
+            continue
+
+        # Only strings can match a header.
+        if isinstance(description, str):
+            descriptions[sample_id].add(description)
+
+    return descriptions
+
+
+def _is_expression_header(header: str) -> bool:
+    """Returns whether a column whose header contains a sample's title
+    can contain its expression values."""
+    header = header.upper()
+    return (
+        "BEAD" not in header
+        and "NARRAYS" not in header
+        and "ARRAY_STDEV" not in header
+        and "PVAL" not in header.replace(" ", "").replace("_", "")
+    )
+
+
+def _match_sample_columns(samples: List[Sample], headers: List[str]) -> Set[int]:
+    """Returns the offsets, starting at 1, of the columns that contain
+    the expression values of the samples.
+
+    A column matches a sample if its header is the sample's title or one
+    of the sample's descriptions, is RAW_VALUE, or contains the title
+    without being a BEAD, NARRAYS, ARRAY_STDEV or PVAL column. When a
+    header matches a description it's treated as the sample's real title,
+    which we will need later, both for the columns after it and when the
+    sample is saved.
+
+    The headers are indexed once, so the samples are matched without
+    rescanning them for exact matches or querying for each pair.
+    """
+    offsets_by_header = defaultdict(list)
+    for offset, header in enumerate(headers, start=1):
+        offsets_by_header[header].append(offset)
+
+    expression_headers = [
+        (offset, header.upper())
+        for offset, header in enumerate(headers, start=1)
+        if _is_expression_header(header)
+    ]
+
+    column_ids = set()
+    if samples:
+        column_ids.update(
+            offset
+            for offset, header in enumerate(headers, start=1)
+            if header.upper().replace(" ", "_") == "RAW_VALUE"
+        )
+
+    descriptions = _get_sample_descriptions(samples)
+    retitled_samples = []
+    for sample in samples:
+        description_offsets = sorted(
+            offset
+            for description in descriptions[sample.id]
+            for offset in offsets_by_header.get(description, [])
+        )
+        column_ids.update(description_offsets)
+
+        # The columns up to the first description match are matched to
+        # the sample's title and the ones after each description match
+        # are matched to that header.
+        titles = [sample.title] + [headers[offset - 1] for offset in description_offsets]
+        for title_index, title in enumerate(titles):
+            column_ids.update(
+                offset
+                for offset in offsets_by_header.get(title, [])
+                if bisect.bisect_left(description_offsets, offset) == title_index
+            )
+
+        title_uppers = [title.upper() for title in titles]
+        for offset, header in expression_headers:
+            if title_uppers[bisect.bisect_left(description_offsets, offset)] in header:
+                column_ids.add(offset)
+
+        if titles[-1] != sample.title:
+            sample.title = titles[-1]
+            # bulk_update doesn't call Sample.save, which would do this.
+            sample.last_modified = timezone.now()
+            retitled_samples.append(sample)
+
+    if retitled_samples:
+        Sample.objects.bulk_update(retitled_samples, ["title", "last_modified"])
+
+    return column_ids
+
+
 def _detect_columns(job_context: Dict) -> Dict:
     """Detect which columns match to which inputs.
 
@@ -147,49 +255,9 @@ def _detect_columns(job_context: Dict) -> Dict:
             job_context["job"].no_retry = True
             return job_context
 
-        # Then, finally, create an absolutely bonkers regular expression
-        # which will explicitly hit on any sample which contains a sample
-        # ID _and_ ignores the magical word 'BEAD', etc. Great!
-        column_ids = set()
-        for sample in job_context["samples"]:
-            for offset, header in enumerate(headers, start=1):
-
-                if sample.title == header:
-                    column_ids.add(offset)
-                    continue
-
-                # Sometimes the title might actually be in the description field.
-                # To find this, look in all the related SampleAnnotations.
-                # Since there are multiple annotations, we need to break early before continuing.
-                # Related: https://github.com/AlexsLemonade/refinebio/issues/499
-                continue_me = False
-                for annotation in sample.sampleannotation_set.filter(is_ccdl=False):
-                    try:
-                        if annotation.data.get("description", "")[0] == header:
-                            column_ids.add(offset)
-                            continue_me = True
-                            break
-                    except Exception:
-                        pass
-                if continue_me:
-                    # Treat the header as the real title, as we will need it later.
-                    sample.title = header
-                    sample.save()
-                    continue
-
-                if header.upper().replace(" ", "_") == "RAW_VALUE":
-                    column_ids.add(offset)
-                    continue
-
-                if (
-                    sample.title.upper() in header.upper()
-                    and "BEAD" not in header.upper()
-                    and "NARRAYS" not in header.upper()
-                    and "ARRAY_STDEV" not in header.upper()
-                    and "PVAL" not in header.upper().replace(" ", "").replace("_", "")
-                ):
-                    column_ids.add(offset)
-                    continue
+        # Then, finally, match each sample to the columns which contain its
+        # title _and_ don't contain the magical word 'BEAD', etc. Great!
+        column_ids = _match_sample_columns(job_context["samples"], headers)
 
         for offset, header in enumerate(headers, start=1):
             if "AVG_Signal" in header:
@@ -0,0 +1,87 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+
+import numpy as np
+
+from data_refinery_workers.processors import gene_indexes
+
+ID_TYPES = ["PROBEID", "ENTREZID", "REFSEQ", "SYMBOL", "UNIGENE"]
+
+
+def write_gene_index(path: str, num_rows: int, random: np.random.RandomState) -> None:
+    """Writes a gzipped gene index in the identifier refinery's format
+    with `num_rows` rows, where some probes map to several Ensembl ids
+    and some of the other ids are missing."""
+    with gzip.open(path, "wt") as gene_index_file:
+        gene_index_file.write("\t".join(["ENSEMBL"] + ID_TYPES) + "\n")
+        for i in range(num_rows):
+            ids = [
+                "ENSG{:011d}".format(random.randint(num_rows // 2)),
+                "{}_at".format(int(i / 1.3)),
+                str(random.randint(100000)),
+                "NM_{:06d}".format(random.randint(num_rows)),
+                "GENE{}".format(random.randint(num_rows // 2)),
+                "Hs.{}".format(random.randint(num_rows)),
+            ]
+            ids = [gene_id if random.rand() > 0.05 else "" for gene_id in ids]
+            gene_index_file.write("\t".join(ids) + "\n")
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--row-counts",
+            type=str,
+            default="20000,80000",
+            help="Comma separated numbers of rows in each synthetic gene index.",
+        )
+        parser.add_argument("--seed", type=int, default=123)
+
+    def handle(self, *args, **options):
+        """Compares the per-job cost of parsing a synthetic gene index,
+        which every NO_OP job used to do, with loading it through
+        gene_indexes.load_gene_index: compiling it for the first job,
+        loading the compiled copy in later jobs and looking it up again
+        in the same process.
+
+        The gene indices and their compiled copies are written to a
+        temporary directory."""
+        row_counts = [int(count) for count in options["row_counts"].split(",")]
+        random = np.random.RandomState(options["seed"])
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            self.stdout.write("rows\tmethod\tseconds")
+            for num_rows in row_counts:
+                gene_index_path = os.path.join(work_dir, "BENCH{}.tsv.gz".format(num_rows))
+                write_gene_index(gene_index_path, num_rows, random)
+
+                start = time.time()
+                gene_indexes._parse_gene_index(gene_index_path)
+                seconds = time.time() - start
+                self.stdout.write("{}\tparse\t{:.3f}".format(num_rows, seconds))
+
+                with patch.object(
+                    gene_indexes, "GENE_INDEX_CACHE_DIR", os.path.join(work_dir, "gene_index_cache")
+                ):
+                    # Each job runs in a new process, which starts without
+                    # any loaded gene indices.
+                    for method in ["first job", "later job", "same process"]:
+                        if method != "same process":
+                            gene_indexes._gene_index_cache.pop(gene_index_path, None)
+
+                        start = time.time()
+                        gene_indexes.load_gene_index(gene_index_path)
+                        seconds = time.time() - start
+                        self.stdout.write("{}\t{}\t{:.3f}".format(num_rows, method, seconds))
+
+                gene_indexes._gene_index_cache.pop(gene_index_path, None)
+                os.remove(gene_index_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,180 @@
+import filecmp
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+
+import numpy as np
+
+from data_refinery_workers.processors import transcriptome_index
+
+# Removes each occurrance of ; and "
+IDS_CLEANUP_TABLE = str.maketrans({";": None, '"': None})
+GENE_BIOTYPES = ["protein_coding", "lncRNA", "miRNA", "snRNA"]
+PSEUDOGENE_BIOTYPES = ["processed_pseudogene", "unprocessed_pseudogene"]
+
+
+def write_gtf(
+    path: str, num_genes: int, pseudogene_fraction: float, random: np.random.RandomState
+) -> None:
+    """Writes a GTF file in Ensembl's format with `num_genes` genes, a
+    few transcripts for each of them and a few exons for each of those."""
+    with open(path, "w") as gtf_file:
+        gtf_file.write("#!genome-build BENCH1\n#!genome-version BENCH1\n")
+        for i in range(num_genes):
+            if random.rand() < pseudogene_fraction:
+                biotype = PSEUDOGENE_BIOTYPES[random.randint(len(PSEUDOGENE_BIOTYPES))]
+            else:
+                biotype = GENE_BIOTYPES[random.randint(len(GENE_BIOTYPES))]
+
+            start = i * 10000 + 1
+            gene_attributes = (
+                'gene_id "ENSG{:011d}"; gene_version "1"; gene_name "GENE{}";'
+                ' gene_source "ensembl"; gene_biotype "{}";'
+            ).format(i, i, biotype)
+            gtf_file.write(
+                "1\tensembl\tgene\t{}\t{}\t.\t+\t.\t{}\n".format(
+                    start, start + 9000, gene_attributes
+                )
+            )
+
+            for j in range(random.randint(1, 6)):
+                transcript_attributes = (
+                    '{} transcript_id "ENST{:011d}"; transcript_version "1";'
+                    ' transcript_source "havana"; transcript_biotype "{}";'
+                ).format(gene_attributes, i * 10 + j, biotype)
+                gtf_file.write(
+                    "1\thavana\ttranscript\t{}\t{}\t.\t+\t.\t{}\n".format(
+                        start, start + 9000, transcript_attributes
+                    )
+                )
+                for k in range(random.randint(1, 10)):
+                    gtf_file.write(
+                        '1\thavana\texon\t{}\t{}\t.\t+\t.\t{} exon_number "{}";\n'.format(
+                            start + k * 900, start + k * 900 + 500, transcript_attributes, k + 1
+                        )
+                    )
+
+
+def filter_gtf_by_line(
+    gtf_file_path: str, filtered_gtf_path: str, genes_to_transcripts_path: str
+) -> None:
+    """Filters the GTF file the way _process_gtf used to, one line at a time."""
+    with open(gtf_file_path, "r") as input_gtf, open(filtered_gtf_path, "w") as filtered_gtf, open(
+        genes_to_transcripts_path, "w"
+    ) as genes_to_transcripts:
+        for line in input_gtf:
+            if "pseudogene" in line:
+                continue
+
+            filtered_gtf.write(line)
+            tab_split_line = line.split("\t")
+
+            if len(tab_split_line) < 2:
+                continue
+
+            if tab_split_line[2] == "transcript":
+                ids_column = tab_split_line[-1].translate(IDS_CLEANUP_TABLE)
+                split_ids_column = ids_column.split(" ")
+
+                gene_id = split_ids_column[split_ids_column.index("gene_id") + 1]
+                transcript_id = split_ids_column[split_ids_column.index("transcript_id") + 1]
+
+                genes_to_transcripts.write("{}\t{}\n".format(gene_id, transcript_id))
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--gene-counts",
+            type=str,
+            default="10000,60000",
+            help="Comma separated numbers of genes in each synthetic GTF file.",
+        )
+        parser.add_argument(
+            "--pseudogene-fraction",
+            type=float,
+            default=0.25,
+            help="The fraction of the genes that are pseudogenes.",
+        )
+        parser.add_argument("--seed", type=int, default=123)
+
+    def handle(self, *args, **options):
+        """Compares processing synthetic GTF files one line at a time, the
+        way _process_gtf used to, with processing them a block at a time,
+        and then with building both the long and short indices' GTF files,
+        where the second one comes from the cache.
+
+        Everything is written to a temporary directory, including the cache.
+        """
+        gene_counts = [int(count) for count in options["gene_counts"].split(",")]
+        random = np.random.RandomState(options["seed"])
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            self.stdout.write("genes\tsize (MB)\tmethod\tseconds\tidentical")
+            for num_genes in gene_counts:
+                gtf_file_path = os.path.join(work_dir, "{}.gtf".format(num_genes))
+                write_gtf(gtf_file_path, num_genes, options["pseudogene_fraction"], random)
+                size = os.path.getsize(gtf_file_path) / 1024 / 1024
+
+                expected_paths = [
+                    os.path.join(work_dir, "by_line.gtf"),
+                    os.path.join(work_dir, "by_line.txt"),
+                ]
+                start = time.time()
+                filter_gtf_by_line(gtf_file_path, *expected_paths)
+                seconds = time.time() - start
+                self.stdout.write("{}\t{:.1f}\tby line\t{:.2f}\t-".format(num_genes, size, seconds))
+
+                paths = [
+                    os.path.join(work_dir, "by_block.gtf"),
+                    os.path.join(work_dir, "by_block.txt"),
+                ]
+                start = time.time()
+                transcriptome_index._filter_gtf(gtf_file_path, *paths)
+                seconds = time.time() - start
+                identical = all(
+                    filecmp.cmp(*pair, shallow=False) for pair in zip(expected_paths, paths)
+                )
+                self.stdout.write(
+                    "{}\t{:.1f}\tby block\t{:.2f}\t{}".format(num_genes, size, seconds, identical)
+                )
+
+                with patch.object(
+                    transcriptome_index, "GTF_CACHE_DIR", os.path.join(work_dir, "gtf_cache")
+                ):
+                    start = time.time()
+                    for length in ["long", "short"]:
+                        length_dir = os.path.join(work_dir, str(num_genes), length)
+                        os.makedirs(length_dir)
+                        job_context = transcriptome_index._process_gtf(
+                            {
+                                "job_id": None,
+                                "work_dir": length_dir,
+                                "output_dir": length_dir,
+                                "gtf_file_path": gtf_file_path,
+                                "cleanup_gtf": False,
+                                "organism_name": "BENCH_{}".format(num_genes),
+                                "assembly_name": "BENCH1",
+                                "assembly_version": "1",
+                            }
+                        )
+                    seconds = time.time() - start
+
+                paths = [job_context["gtf_file_path"], job_context["genes_to_transcripts_path"]]
+                identical = all(
+                    filecmp.cmp(*pair, shallow=False) for pair in zip(expected_paths, paths)
+                )
+                self.stdout.write(
+                    "{}\t{:.1f}\tlong and short\t{:.2f}\t{}".format(
+                        num_genes, size, seconds, identical
+                    )
+                )
+
+                os.remove(gtf_file_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
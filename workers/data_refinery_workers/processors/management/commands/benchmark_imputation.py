@@ -0,0 +1,105 @@
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+import numpy as np
+import pandas as pd
+import simplejson as json
+
+from data_refinery_workers.processors.management.commands.benchmark_smasher import (
+    BYTES_IN_MB,
+    PeakMemoryMonitor,
+    impute_matrix,
+)
+
+
+def make_matrix(
+    num_samples: int, num_genes: int, missing: float, random: np.random.RandomState
+) -> pd.DataFrame:
+    """Returns a float32 sample by gene matrix of rank 10 plus a little
+    noise, with `missing` of its values missing."""
+    values = random.normal(size=(num_samples, 10)).astype(np.float32) @ random.normal(
+        size=(10, num_genes)
+    ).astype(np.float32)
+    values += random.normal(scale=0.1, size=values.shape).astype(np.float32)
+    values[random.rand(num_samples, num_genes) < missing] = np.nan
+
+    return pd.DataFrame(values)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=str,
+            default="1000x5000,2000x10000,4000x20000",
+            help="Comma separated matrix sizes, as <samples>x<genes>.",
+        )
+        parser.add_argument(
+            "--svd-algorithms",
+            type=str,
+            default="ARPACK,RANDOMIZED,CHUNKED",
+            help="Comma separated SVD algorithms to compare.",
+        )
+        parser.add_argument(
+            "--missing", type=float, default=0.1, help="The fraction of values that are missing."
+        )
+        parser.add_argument("--seed", type=int, default=123)
+        parser.add_argument("--output", type=str, help="Where to also write the results as JSON.")
+
+    def handle(self, *args, **options):
+        """Compares the time and peak memory each of the SVD algorithms
+        needs to impute synthetic matrices of increasing size.
+
+        The memory columns are how much the RSS grew over the matrix that
+        was already in memory. Anonymous memory leaves out the pages of
+        memory-mapped files, which is what the CHUNKED algorithm keeps
+        the matrix in.
+        """
+        random = np.random.RandomState(options["seed"])
+        results = []
+
+        self.stdout.write(
+            "samples\tgenes\tmatrix (MB)\talgorithm\ttime (s)\tpeak RSS increase (MB)"
+            "\tpeak anonymous RSS increase (MB)"
+        )
+        for size in options["sizes"].split(","):
+            num_samples, num_genes = [int(dimension) for dimension in size.split("x")]
+            matrix = make_matrix(num_samples, num_genes, options["missing"], random)
+
+            for svd_algorithm in options["svd_algorithms"].split(","):
+                work_dir = tempfile.mkdtemp()
+                try:
+                    with PeakMemoryMonitor() as monitor:
+                        start = time.time()
+                        imputed_matrix = impute_matrix(matrix, svd_algorithm, work_dir)
+                        seconds = time.time() - start
+                    del imputed_matrix
+                finally:
+                    shutil.rmtree(work_dir, ignore_errors=True)
+
+                result = {
+                    "samples": num_samples,
+                    "genes": num_genes,
+                    "matrix_mb": matrix.values.nbytes / BYTES_IN_MB,
+                    "svd_algorithm": svd_algorithm,
+                    "seconds": seconds,
+                    "peak_rss_increase_mb": (monitor.peak_rss - monitor.start_rss) / BYTES_IN_MB,
+                    "peak_anonymous_rss_increase_mb": (
+                        monitor.peak_anonymous_rss - monitor.start_anonymous_rss
+                    )
+                    / BYTES_IN_MB,
+                }
+                results.append(result)
+                self.stdout.write(
+                    "{samples}\t{genes}\t{matrix_mb:.1f}\t{svd_algorithm}\t{seconds:.2f}"
+                    "\t{peak_rss_increase_mb:.1f}\t{peak_anonymous_rss_increase_mb:.1f}".format(
+                        **result
+                    )
+                )
+
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                json.dump(results, output_file, indent=2)
@@ -0,0 +1,116 @@
+import gzip
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import List
+
+from django.core.management.base import BaseCommand
+
+import numpy as np
+
+from data_refinery_common.models import ProcessorJob
+from data_refinery_workers.processors import salmon
+
+
+def write_fastq(
+    path: str, num_reads: int, mean_read_length: float, random: np.random.RandomState
+) -> None:
+    """Writes a gzipped FASTQ file of `num_reads` random reads whose
+    lengths vary a little around `mean_read_length`, like trimmed reads."""
+    read_lengths = np.clip(random.normal(mean_read_length, 5, size=num_reads).astype(int), 1, None)
+    bases = np.frombuffer(b"ACGT", dtype=np.uint8)
+    with gzip.open(path, "wb", compresslevel=1) as fastq_file:
+        sequence = random.choice(bases, size=read_lengths.max()).tobytes()
+        for i, read_length in enumerate(read_lengths):
+            read = sequence[:read_length]
+            fastq_file.write(b"@READ%d\n%s\n+\n%s\n" % (i, read, b"I" * read_length))
+
+
+def determine_index_length_with_zcat(input_file_paths: List[str]) -> float:
+    """Averages the read lengths the way _determine_index_length used to,
+    by reading every line that zcat outputs."""
+    total_base_pairs = 0
+    number_of_reads = 0
+    counter = 1
+    for input_file_path in input_file_paths:
+        with subprocess.Popen(
+            ["zcat", input_file_path], stdout=subprocess.PIPE, universal_newlines=True
+        ) as process:
+            for line in process.stdout:
+                if counter % 4 == 2:
+                    total_base_pairs += len(line.replace("\n", ""))
+                    number_of_reads += 1
+                counter += 1
+
+    return total_base_pairs / number_of_reads
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--read-counts",
+            type=str,
+            default="100000,1000000,5000000",
+            help="Comma separated numbers of reads in each synthetic FASTQ file.",
+        )
+        parser.add_argument(
+            "--read-lengths",
+            type=str,
+            default="50,75,100",
+            help="Comma separated mean read lengths to try for each number of reads.",
+        )
+        parser.add_argument("--seed", type=int, default=123)
+
+    def handle(self, *args, **options):
+        """Compares averaging the read lengths of every read in a FASTQ
+        file with zcat with the sampling estimate _determine_index_length
+        uses, on synthetic gzipped FASTQ files.
+
+        Files whose reads are around the threshold between the short and
+        long indices make the estimate fall back to reading every read."""
+        read_counts = [int(count) for count in options["read_counts"].split(",")]
+        read_lengths = [float(length) for length in options["read_lengths"].split(",")]
+        random = np.random.RandomState(options["seed"])
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            self.stdout.write("reads\tmean length\tmethod\tseconds\tindex_length_raw\tindex_length")
+            for num_reads in read_counts:
+                for mean_read_length in read_lengths:
+                    input_file_path = os.path.join(
+                        work_dir, "{}_{}.fastq.gz".format(num_reads, mean_read_length)
+                    )
+                    write_fastq(input_file_path, num_reads, mean_read_length, random)
+
+                    start = time.time()
+                    index_length_raw = determine_index_length_with_zcat([input_file_path])
+                    seconds = time.time() - start
+                    index_length = (
+                        "long" if index_length_raw > salmon.INDEX_LENGTH_THRESHOLD else "short"
+                    )
+                    self.stdout.write(
+                        "{}\t{}\tzcat\t{:.2f}\t{:.2f}\t{}".format(
+                            num_reads, mean_read_length, seconds, index_length_raw, index_length
+                        )
+                    )
+
+                    start = time.time()
+                    job_context = salmon._determine_index_length(
+                        {"input_file_path": input_file_path, "job": ProcessorJob()}
+                    )
+                    seconds = time.time() - start
+                    self.stdout.write(
+                        "{}\t{}\tsampled\t{:.2f}\t{:.2f}\t{}".format(
+                            num_reads,
+                            mean_read_length,
+                            seconds,
+                            job_context["index_length_raw"],
+                            job_context["index_length"],
+                        )
+                    )
+
+                    os.remove(input_file_path)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
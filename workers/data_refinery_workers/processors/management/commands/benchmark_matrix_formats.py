@@ -0,0 +1,59 @@
+import os
+import shutil
+import tempfile
+import time
+
+from django.core.management.base import BaseCommand
+
+import numpy as np
+import pandas as pd
+
+from data_refinery_common.models import Dataset
+from data_refinery_workers.processors import smashing_utils
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--genes", type=int, default=20000)
+        parser.add_argument("--samples", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        """Compares the time it takes to write and load a synthetic gene by
+        sample matrix, and the size of the files, in each of the formats a
+        Dataset can be written in."""
+        random = np.random.RandomState(123)
+        matrix = pd.DataFrame(
+            random.lognormal(size=(options["genes"], options["samples"])).astype(np.float32),
+            index=pd.Index(["ENSG{:011d}".format(i) for i in range(options["genes"])], name="Gene"),
+            columns=["SAMPLE{}".format(i) for i in range(options["samples"])],
+        )
+
+        output_dir = tempfile.mkdtemp()
+        try:
+            self.stdout.write("format\twrite (s)\tsize (MB)\tload (s)\tmapped load (s)")
+            for file_format, _ in Dataset.FILE_FORMAT_CHOICES:
+                path_prefix = os.path.join(output_dir, file_format)
+
+                start = time.time()
+                outfiles = smashing_utils.write_matrix(matrix, path_prefix, file_format)
+                write_time = time.time() - start
+
+                size = sum(os.path.getsize(outfile) for outfile in outfiles) / (1024 * 1024)
+
+                start = time.time()
+                smashing_utils.read_matrix(path_prefix, file_format)
+                load_time = time.time() - start
+
+                mapped_load_time = "-"
+                if file_format == "NPY":
+                    start = time.time()
+                    smashing_utils.read_matrix(path_prefix, file_format, mmap_mode="r")
+                    mapped_load_time = "{:.2f}".format(time.time() - start)
+
+                self.stdout.write(
+                    "{}\t{:.2f}\t{:.1f}\t{:.2f}\t{}".format(
+                        file_format, write_time, size, load_time, mapped_load_time
+                    )
+                )
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
@@ -0,0 +1,135 @@
+import os
+import shutil
+import tempfile
+import time
+from typing import List
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+
+import numpy as np
+import pandas as pd
+
+from data_refinery_common.models import ComputedFile
+from data_refinery_workers.processors import qn_reference, smashing_utils
+from data_refinery_workers.processors.management.commands.benchmark_smasher import (
+    add_gene_id_noise,
+    make_gene_ids,
+)
+
+
+def write_platform_files(
+    output_dir: str, num_genes: int, num_samples: int, random: np.random.RandomState
+) -> List[ComputedFile]:
+    """Writes a processed file for each of `num_samples` synthetic
+    samples from the same microarray platform, so they all list the
+    same genes in the same order, along with a few duplicated genes and
+    Affymetrix control probes."""
+    gene_ids = make_gene_ids(num_genes)
+    gene_ids += list(random.choice(gene_ids, size=num_genes // 100))
+    index = pd.Index(
+        add_gene_id_noise(gene_ids, random) + ["AFFX-BioB-{}_at".format(i) for i in range(20)],
+        name="Gene",
+    )
+
+    computed_files = []
+    for i in range(num_samples):
+        sample_accession_code = "SAMPLE{:06d}".format(i)
+        path = os.path.join(output_dir, sample_accession_code + ".tsv")
+        frame = pd.DataFrame(
+            {sample_accession_code: random.normal(8, 2, size=len(index)).astype(np.float32)},
+            index=index,
+        )
+        frame.to_csv(path, sep="\t")
+
+        computed_files.append(
+            ComputedFile(filename=os.path.basename(path), absolute_file_path=path)
+        )
+
+    return computed_files
+
+
+def build_target_with_frames(computed_files: List[ComputedFile], genes: List[str]) -> np.ndarray:
+    """Builds the target the way _build_qn_target used to, by loading
+    each file as a DataFrame and adding its sorted values to a frame."""
+    geneset = set(genes)
+    sum_frame = pd.DataFrame({"sum": [0 for gene in genes]}, index=genes)
+    num_valid_inputs = 0
+    for computed_file in computed_files:
+        input_frame = smashing_utils._load_and_sanitize_file(computed_file.absolute_file_path)
+        if set(input_frame.index.values) != geneset:
+            continue
+        if input_frame.isnull().sum(axis=0)[0] != 0:
+            continue
+
+        sample_name = list(input_frame.columns.values)[0]
+        expressions = input_frame.sort_values(sample_name)
+        sum_frame["sum"] = sum_frame["sum"] + expressions[sample_name].values
+        num_valid_inputs = num_valid_inputs + 1
+
+    return (sum_frame["sum"] / num_valid_inputs).values
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--genes", type=int, default=20000)
+        parser.add_argument("--samples", type=int, default=1000)
+        parser.add_argument(
+            "--processes",
+            type=str,
+            default="1,{}".format(smashing_utils.MULTIPROCESSING_MAX_THREAD_COUNT),
+            help="Comma separated numbers of processes to build the target with.",
+        )
+        parser.add_argument("--seed", type=int, default=123)
+
+    def handle(self, *args, **options):
+        """Compares building a QN target from synthetic sample files the
+        way _build_qn_target used to, one DataFrame at a time, with the
+        QNTargetBuilder it uses now, with each of the numbers of processes.
+
+        The files are written to a temporary directory and nothing is
+        read from or written to the database or S3.
+        """
+        process_counts = [int(count) for count in options["processes"].split(",")]
+        random = np.random.RandomState(options["seed"])
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            computed_files = write_platform_files(
+                work_dir, options["genes"], options["samples"], random
+            )
+            job_context = {
+                "input_files": {"ALL": [(computed_file, None) for computed_file in computed_files]},
+                "target_file": os.path.join(work_dir, "target.tsv"),
+            }
+
+            self.stdout.write("method\tprocesses\tseconds\tsamples/s\tmax difference")
+
+            genes = list(
+                smashing_utils._load_and_sanitize_file(computed_files[0].absolute_file_path).index
+            )
+            start = time.time()
+            expected_target = build_target_with_frames(computed_files, genes)
+            seconds = time.time() - start
+            self.stdout.write(
+                "frames\t1\t{:.2f}\t{:.1f}\t-".format(seconds, len(computed_files) / seconds)
+            )
+
+            for num_processes in process_counts:
+                with patch.object(
+                    smashing_utils, "MULTIPROCESSING_MAX_THREAD_COUNT", num_processes
+                ):
+                    start = time.time()
+                    qn_reference._build_qn_target(job_context)
+                    seconds = time.time() - start
+
+                max_difference = np.abs(
+                    job_context["sum_frame"]["sum"].values - expected_target
+                ).max()
+                self.stdout.write(
+                    "builder\t{}\t{:.2f}\t{:.1f}\t{:.2g}".format(
+                        num_processes, seconds, len(computed_files) / seconds, max_difference
+                    )
+                )
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
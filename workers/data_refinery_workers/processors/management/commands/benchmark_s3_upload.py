@@ -0,0 +1,114 @@
+import os
+import shutil
+import tempfile
+import time
+from unittest.mock import patch
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.test import override_settings
+
+import boto3
+from moto import mock_s3
+
+from data_refinery_common.models import ComputationalResult, ComputedFile
+from data_refinery_common.models.computed_file import S3_UPLOAD_MAX_WORKERS
+
+BENCHMARK_BUCKET = "benchmark-bucket"
+
+
+def make_computed_files(work_dir: str, result: ComputationalResult, num_files: int, size: int):
+    computed_files = []
+    for i in range(num_files):
+        filename = "benchmark_{}.tsv".format(i)
+        absolute_file_path = os.path.join(work_dir, filename)
+        with open(absolute_file_path, "wb") as benchmark_file:
+            benchmark_file.write(os.urandom(size))
+
+        computed_file = ComputedFile(
+            filename=filename,
+            absolute_file_path=absolute_file_path,
+            size_in_bytes=size,
+            sha1="",
+            result=result,
+        )
+        computed_file.save()
+        computed_files.append(computed_file)
+
+    return computed_files
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--file-counts",
+            type=str,
+            default="1,10,50",
+            help="Comma separated numbers of files to upload in each round.",
+        )
+        parser.add_argument(
+            "--file-size", type=int, default=1024 * 1024, help="The size of each file in bytes."
+        )
+        parser.add_argument(
+            "--latency",
+            type=float,
+            default=0.05,
+            help="Seconds added to every S3 request to stand in for the network.",
+        )
+        parser.add_argument("--max-workers", type=int, default=S3_UPLOAD_MAX_WORKERS)
+
+    def handle(self, *args, **options):
+        """Compares uploading computed files one at a time with
+        ComputedFile.bulk_sync_to_s3, using moto as a local S3.
+
+        Everything written to the database is rolled back afterwards."""
+        file_counts = [int(count) for count in options["file_counts"].split(",")]
+
+        def add_latency(**kwargs):
+            time.sleep(options["latency"])
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            with mock_s3(), override_settings(RUNNING_IN_CLOUD=True), transaction.atomic():
+                # The module-level client was created before moto was
+                # started, so it has to be swapped for one that moto handles.
+                s3 = boto3.client("s3", region_name="us-east-1")
+                s3.create_bucket(Bucket=BENCHMARK_BUCKET)
+                s3.meta.events.register("before-sign.s3", add_latency)
+
+                with patch("data_refinery_common.models.computed_file.S3", s3):
+                    result = ComputationalResult.objects.create()
+
+                    self.stdout.write("files\tserial (s)\tbulk (s)\tspeedup")
+                    for num_files in file_counts:
+                        computed_files = make_computed_files(
+                            work_dir, result, num_files, options["file_size"]
+                        )
+
+                        start = time.time()
+                        for computed_file in computed_files:
+                            computed_file.sync_to_s3(
+                                BENCHMARK_BUCKET, "serial_" + computed_file.filename
+                            )
+                        serial_time = time.time() - start
+
+                        start = time.time()
+                        ComputedFile.bulk_sync_to_s3(
+                            [
+                                (computed_file, "bulk_" + computed_file.filename)
+                                for computed_file in computed_files
+                            ],
+                            BENCHMARK_BUCKET,
+                            max_workers=options["max_workers"],
+                        )
+                        bulk_time = time.time() - start
+
+                        self.stdout.write(
+                            "{}\t{:.2f}\t{:.2f}\t{:.1f}x".format(
+                                num_files, serial_time, bulk_time, serial_time / bulk_time
+                            )
+                        )
+
+                transaction.set_rollback(True)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
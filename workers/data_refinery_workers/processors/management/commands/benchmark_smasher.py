@@ -0,0 +1,343 @@
+import os
+import platform
+import shutil
+import tempfile
+import threading
+import time
+from typing import Callable, Dict, List
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+import numpy as np
+import pandas as pd
+import psutil
+import simplejson as json
+from fancyimpute import IterativeSVD
+
+from data_refinery_common.models import Dataset, ProcessorJob
+from data_refinery_workers.processors import create_compendia, smasher, smashing_utils
+
+BYTES_IN_MB = 1024 * 1024
+
+STAGES = [
+    "load_and_sanitize",
+    "build_matrix",
+    "join",
+    "quantile_normalize",
+    "scale",
+    "prepare_imputation",
+    "impute",
+    "write_tsv",
+    "write_npy",
+]
+
+
+class PeakMemoryMonitor:
+    """Polls the RSS of this process in a background thread and keeps
+    track of the highest value seen while it's running.
+
+    The peak of the anonymous memory, which leaves out pages of
+    memory-mapped files that the kernel can write back and drop when it
+    needs to, is tracked separately.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.process = psutil.Process(os.getpid())
+        self.start_rss = 0
+        self.start_anonymous_rss = 0
+        self.peak_rss = 0
+        self.peak_anonymous_rss = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _update(self):
+        memory_info = self.process.memory_info()
+        self.peak_rss = max(self.peak_rss, memory_info.rss)
+        # `shared` is only reported on Linux.
+        anonymous_rss = memory_info.rss - getattr(memory_info, "shared", 0)
+        self.peak_anonymous_rss = max(self.peak_anonymous_rss, anonymous_rss)
+
+    def _poll(self):
+        while not self._stop.is_set():
+            self._update()
+            self._stop.wait(self.interval)
+
+    def __enter__(self):
+        memory_info = self.process.memory_info()
+        self.start_rss = memory_info.rss
+        self.start_anonymous_rss = memory_info.rss - getattr(memory_info, "shared", 0)
+        self._update()
+        self._thread = threading.Thread(target=self._poll, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop.set()
+        self._thread.join()
+        self._update()
+
+
+def make_gene_ids(num_genes: int) -> List[str]:
+    return ["ENSG{:011d}".format(i) for i in range(num_genes)]
+
+
+def add_gene_id_noise(gene_ids: List[str], random: np.random.RandomState) -> List[str]:
+    """Decorates gene identifiers the way processed files from the
+    different platforms do, so that _load_and_sanitize_file has to strip
+    them back off: Brainarray's `_at` suffixes and version suffixes."""
+    noisy_gene_ids = []
+    for gene_id, noise in zip(gene_ids, random.randint(0, 4, size=len(gene_ids))):
+        if noise == 1:
+            gene_id += "_at"
+        elif noise == 2:
+            gene_id += ".{}".format(random.randint(1, 20))
+        noisy_gene_ids.append(gene_id)
+
+    return noisy_gene_ids
+
+
+def write_computed_files(
+    output_dir: str,
+    num_genes: int,
+    num_samples: int,
+    gene_presence: float,
+    random: np.random.RandomState,
+) -> List[Dict]:
+    """Writes a processed file for each of `num_samples` synthetic
+    samples, the first half of them microarray and the rest RNA-seq.
+
+    Each file has its genes in a random order, with a few duplicated
+    genes and a handful of Affymetrix control probes.
+    """
+    gene_ids = np.array(make_gene_ids(num_genes))
+    control_probes = ["AFFX-BioB-{}_at".format(i) for i in range(20)]
+
+    computed_files = []
+    for i in range(num_samples):
+        technology = "MICROARRAY" if i < num_samples / 2 else "RNA-SEQ"
+        # The first 80% of the genes are in every file, like the genes
+        # every platform measures, the rest are only in some of them.
+        is_present = random.rand(num_genes) < gene_presence
+        is_present[: int(num_genes * 0.8)] = True
+        sample_gene_ids = gene_ids[is_present]
+        sample_gene_ids = np.concatenate(
+            [sample_gene_ids, random.choice(sample_gene_ids, size=len(sample_gene_ids) // 100)]
+        )
+        random.shuffle(sample_gene_ids)
+        index = add_gene_id_noise(list(sample_gene_ids), random) + control_probes
+
+        if technology == "MICROARRAY":
+            # Already log2 scaled, so it's below the smasher's threshold of 100.
+            values = random.normal(8, 2, size=len(index))
+        else:
+            # lengthScaledTPM values, with plenty of zeroes.
+            values = random.lognormal(1, 2, size=len(index))
+            values[random.rand(len(index)) < 0.2] = 0
+
+        sample_accession_code = "SAMPLE{:06d}".format(i)
+        path = os.path.join(output_dir, sample_accession_code + ".tsv")
+        frame = pd.DataFrame(
+            {sample_accession_code: values.astype(np.float32)}, index=pd.Index(index, name="Gene"),
+        )
+        frame.to_csv(path, sep="\t")
+
+        computed_files.append(
+            {
+                "path": path,
+                "sample_accession_code": sample_accession_code,
+                "technology": technology,
+            }
+        )
+
+    return computed_files
+
+
+def impute_matrix(matrix: pd.DataFrame, svd_algorithm: str, work_dir: str) -> np.ndarray:
+    """Imputes `matrix` the way _perform_imputation does with `svd_algorithm`."""
+    if svd_algorithm == "CHUNKED":
+        return create_compendia.ChunkedIterativeSVD(rank=10, work_dir=work_dir).fit_transform(
+            matrix.values
+        )
+
+    return IterativeSVD(rank=10, svd_algorithm=svd_algorithm.lower(), verbose=False).fit_transform(
+        matrix
+    )
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument("--genes", type=int, default=20000)
+        parser.add_argument("--samples", type=int, default=200)
+        parser.add_argument(
+            "--gene-presence",
+            type=float,
+            default=0.9,
+            help="The fraction of the less common genes in each sample's file.",
+        )
+        parser.add_argument(
+            "--stages",
+            type=str,
+            default=",".join(STAGES),
+            help="Comma separated stages to run, out of: " + ", ".join(STAGES),
+        )
+        parser.add_argument(
+            "--svd-algorithm", type=str, default="ARPACK", help="The algorithm to impute with."
+        )
+        parser.add_argument("--seed", type=int, default=123)
+        parser.add_argument(
+            "--output", type=str, help="Where to write the JSON results, instead of stdout."
+        )
+
+    def run_stage(self, name: str, stage: Callable, *args, required: bool = False):
+        """Runs `stage` if it was selected and records how long it took
+        and how much memory it needed. Stages whose output is `required`
+        by a later stage are run even if they weren't selected, but their
+        results aren't recorded. Returns whatever `stage` returned."""
+        if name not in self.stages:
+            return stage(*args) if required else None
+
+        with PeakMemoryMonitor() as monitor:
+            start = time.time()
+            output = stage(*args)
+            seconds = time.time() - start
+
+        self.results["stages"][name] = {
+            "seconds": seconds,
+            "peak_rss_mb": monitor.peak_rss / BYTES_IN_MB,
+            "rss_increase_mb": (monitor.peak_rss - monitor.start_rss) / BYTES_IN_MB,
+            "peak_anonymous_rss_mb": monitor.peak_anonymous_rss / BYTES_IN_MB,
+        }
+        self.stderr.write("{}: {:.2f}s".format(name, seconds))
+
+        return output
+
+    def handle(self, *args, **options):
+        """Runs each stage of the smasher and create_compendia processors
+        on synthetic samples and reports the time and peak RSS of each.
+
+        Nothing is read from or written to the database or S3: the stages
+        are run on files in a temporary directory, with unsaved model
+        instances standing in for the job and dataset. The results are
+        written as JSON so they can be compared across commits.
+        """
+        self.stages = options["stages"].split(",")
+        unknown_stages = set(self.stages) - set(STAGES)
+        if unknown_stages:
+            raise CommandError("Unknown stages: " + ", ".join(sorted(unknown_stages)))
+
+        self.results = {
+            "created_at": timezone.now().isoformat(),
+            "parameters": {
+                "genes": options["genes"],
+                "samples": options["samples"],
+                "gene_presence": options["gene_presence"],
+                "svd_algorithm": options["svd_algorithm"],
+                "seed": options["seed"],
+            },
+            "environment": {
+                "python": platform.python_version(),
+                "numpy": np.__version__,
+                "pandas": pd.__version__,
+                "cpu_count": psutil.cpu_count(),
+            },
+            "stages": {},
+        }
+
+        random = np.random.RandomState(options["seed"])
+        job_context = {
+            "job": ProcessorJob(),
+            "dataset": Dataset(aggregate_by="SPECIES", svd_algorithm=options["svd_algorithm"]),
+            "unsmashable_files": [],
+        }
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            computed_files = write_computed_files(
+                work_dir, options["genes"], options["samples"], options["gene_presence"], random
+            )
+            self.results["parameters"]["input_size_mb"] = (
+                sum(os.path.getsize(computed_file["path"]) for computed_file in computed_files)
+                / BYTES_IN_MB
+            )
+
+            def load_and_sanitize():
+                frames = []
+                for computed_file in computed_files:
+                    frame = smashing_utils._load_and_sanitize_file(computed_file["path"])
+                    frame.columns = [computed_file["sample_accession_code"]]
+                    frames.append(frame)
+                return frames
+
+            frames = self.run_stage("load_and_sanitize", load_and_sanitize, required=True)
+
+            def build_matrix():
+                builder = smashing_utils.SampleMatrixBuilder()
+                for computed_file, frame in zip(computed_files, frames):
+                    builder.add_frame(frame, computed_file["technology"])
+                return builder.build(presence_threshold=0.5)
+
+            matrices = self.run_stage(
+                "build_matrix",
+                build_matrix,
+                required=bool({"prepare_imputation", "impute"} & set(self.stages)),
+            )
+
+            job_context["all_frames"] = frames
+            merged = self.run_stage("join", smasher._join_frames, job_context, required=True)
+            # Free the frames so they don't count towards the later stages.
+            del job_context["all_frames"]
+            frames = None
+
+            # A stand-in for the organism's QN target.
+            target = np.nanmean(np.sort(merged.to_numpy(), axis=0), axis=1)
+            normalized = self.run_stage(
+                "quantile_normalize", smashing_utils._quantile_normalize_matrix, target, merged
+            )
+            if normalized is not None:
+                merged = normalized
+                del normalized
+
+            def scale():
+                transposed = merged.transpose()
+                scaler = smasher.SCALERS["MINMAX"](copy=True)
+                scaler.fit(transposed)
+                return pd.DataFrame(
+                    scaler.transform(transposed), index=transposed.index, columns=transposed.columns
+                ).transpose()
+
+            self.run_stage("scale", scale)
+
+            def prepare_imputation():
+                return create_compendia._prepare_imputation_matrix(
+                    matrices["MICROARRAY"], matrices["RNA-SEQ"]
+                )[0]
+
+            combined_matrix = self.run_stage(
+                "prepare_imputation", prepare_imputation, required="impute" in self.stages
+            )
+            matrices = None
+
+            def impute():
+                return impute_matrix(combined_matrix.T, options["svd_algorithm"], work_dir)
+
+            self.run_stage("impute", impute)
+            combined_matrix = None
+
+            for file_format, _ in Dataset.FILE_FORMAT_CHOICES:
+                self.run_stage(
+                    "write_" + file_format.lower(),
+                    smashing_utils.write_matrix,
+                    merged,
+                    os.path.join(work_dir, "output_" + file_format),
+                    file_format,
+                )
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        if options["output"]:
+            with open(options["output"], "w") as output_file:
+                json.dump(self.results, output_file, indent=2)
+        else:
+            self.stdout.write(json.dumps(self.results, indent=2))
@@ -0,0 +1,141 @@
+import os
+import shutil
+import tempfile
+import time
+from typing import List
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+import numpy as np
+import pandas as pd
+
+from data_refinery_common.models import (
+    ComputationalResult,
+    ComputedFile,
+    Sample,
+    SampleComputedFileAssociation,
+    SampleResultAssociation,
+)
+from data_refinery_workers.processors import salmon
+
+TPM_FILENAME = "gene_lengthScaledTPM.tsv"
+
+
+def make_rds_file(work_dir: str, result: ComputationalResult) -> ComputedFile:
+    rds_file_path = os.path.join(work_dir, "txi_out.RDS")
+    with open(rds_file_path, "wb") as rds_file:
+        rds_file.write(os.urandom(1024))
+
+    rds_file = ComputedFile(
+        absolute_file_path=rds_file_path, filename="txi_out.RDS", result=result, is_public=True
+    )
+    rds_file.calculate_sha1()
+    rds_file.calculate_size()
+    rds_file.save()
+
+    return rds_file
+
+
+def create_files_serially(
+    work_dir: str,
+    data: pd.DataFrame,
+    tpm_filename: str,
+    result: ComputationalResult,
+    rds_file: ComputedFile,
+) -> List[ComputedFile]:
+    """Registers the tximport result the way _run_tximport_for_experiment
+    used to, one sample and one file at a time."""
+    individual_files = []
+    for frame in np.split(data, len(data.columns), axis=1):
+        sample_file_name = frame.columns.values[0] + "_" + tpm_filename
+        frame_path = os.path.join(work_dir, sample_file_name)
+        frame.to_csv(frame_path, sep="\t", encoding="utf-8")
+
+        sample_accession_code = frame.columns.values[0].replace("_output", "")
+        sample = Sample.objects.get(accession_code=sample_accession_code)
+
+        computed_file = ComputedFile()
+        computed_file.absolute_file_path = frame_path
+        computed_file.filename = sample_file_name
+        computed_file.result = result
+        computed_file.is_smashable = True
+        computed_file.is_qc = False
+        computed_file.is_public = True
+        computed_file.calculate_sha1()
+        computed_file.calculate_size()
+        computed_file.save()
+
+        SampleResultAssociation.objects.get_or_create(sample=sample, result=result)
+        SampleComputedFileAssociation.objects.get_or_create(sample=sample, computed_file=rds_file)
+        SampleComputedFileAssociation.objects.get_or_create(
+            sample=sample, computed_file=computed_file
+        )
+        individual_files.append(computed_file)
+
+    return individual_files
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sample-counts",
+            type=str,
+            default="10,100,1000",
+            help="Comma separated numbers of samples in each experiment.",
+        )
+        parser.add_argument("--genes", type=int, default=20000)
+
+    def handle(self, *args, **options):
+        """Compares registering the results of a tximport run one sample
+        at a time with salmon._create_tximport_result_files, on
+        synthetic experiments in the local database.
+
+        Everything written to the database is rolled back afterwards."""
+        sample_counts = [int(count) for count in options["sample_counts"].split(",")]
+        random = np.random.RandomState(123)
+
+        work_dir = tempfile.mkdtemp()
+        try:
+            with transaction.atomic():
+                self.stdout.write("samples\tmethod\tseconds\tqueries")
+                for num_samples in sample_counts:
+                    accession_codes = [
+                        "BENCH{}-{}".format(num_samples, i) for i in range(num_samples)
+                    ]
+                    Sample.objects.bulk_create(
+                        [
+                            Sample(accession_code=accession_code, technology="RNA-SEQ")
+                            for accession_code in accession_codes
+                        ]
+                    )
+                    data = pd.DataFrame(
+                        random.lognormal(size=(options["genes"], num_samples)),
+                        index=pd.Index(
+                            ["ENSG{:011d}".format(i) for i in range(options["genes"])], name="Gene"
+                        ),
+                        columns=[accession_code + "_output" for accession_code in accession_codes],
+                    )
+
+                    for method, create_files in [
+                        ("serial", create_files_serially),
+                        ("bulk", salmon._create_tximport_result_files),
+                    ]:
+                        method_dir = os.path.join(work_dir, "{}_{}".format(method, num_samples))
+                        os.makedirs(method_dir)
+                        result = ComputationalResult.objects.create()
+                        rds_file = make_rds_file(method_dir, result)
+
+                        with CaptureQueriesContext(connection) as queries:
+                            start = time.time()
+                            create_files(method_dir, data, TPM_FILENAME, result, rds_file)
+                            seconds = time.time() - start
+
+                        self.stdout.write(
+                            "{}\t{}\t{:.2f}\t{}".format(num_samples, method, seconds, len(queries))
+                        )
+
+                transaction.set_rollback(True)
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
@@ -0,0 +1,49 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand
+
+from data_refinery_common.enums import ProcessorEnum
+from data_refinery_common.logging import get_and_configure_logger
+from data_refinery_workers.processors import utils
+
+logger = get_and_configure_logger(__name__)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--processor",
+            type=str,
+            action="append",
+            help=(
+                "The processor whose runtime environment should be refreshed. "
+                "Must be enumerated in data_refinery_common.enums.ProcessorEnum. "
+                "Can be repeated. Defaults to every processor."
+            ),
+        )
+
+    def handle(self, *args, **options):
+        """Recomputes the cached runtime environments used by utils.find_processor."""
+        processors = options["processor"] or list(ProcessorEnum.__members__)
+
+        failed = False
+        for processor in processors:
+            if not ProcessorEnum.has_key(processor):
+                logger.error("Unknown processor.", processor=processor)
+                failed = True
+                continue
+
+            processor_info = ProcessorEnum[processor].value
+            yml_path = os.path.join(utils.DIRNAME, processor_info["yml_file"])
+            try:
+                utils.get_cached_runtime_env(yml_path, processor_info["docker_img"], refresh=True)
+                logger.info("Refreshed runtime environment.", processor=processor)
+            except Exception:
+                # The packages of most processors aren't installed in
+                # every image, so this is expected when refreshing all of them.
+                logger.exception("Failed to refresh runtime environment.", processor=processor)
+                failed = True
+
+        if failed and options["processor"]:
+            sys.exit(1)
@@ -1,7 +1,8 @@
 import csv
 import os
+import shutil
 import subprocess
-from typing import Dict
+from typing import Dict, Iterator, List, Mapping, Optional
 
 from data_refinery_common.enums import PipelineEnum
 from data_refinery_common.logging import get_and_configure_logger
@@ -14,11 +15,14 @@ from data_refinery_common.models import (
     SampleResultAssociation,
 )
 from data_refinery_common.utils import get_env_variable, get_internal_microarray_accession
-from data_refinery_workers.processors import utils
+from data_refinery_workers.processors import gene_indexes, utils
 
 logger = get_and_configure_logger(__name__)
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
 S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
+# The share of a file's ids that have to be in a column of its gene index
+# for us to convert them with it.
+MIN_ID_OVERLAP = 0.5
 
 
 def _prepare_files(job_context: Dict) -> Dict:
@@ -73,31 +77,22 @@ def _prepare_files(job_context: Dict) -> Dict:
 
         # We want to make sure that all of our columns for conversion and smashing
         # use the same column name for gene identifiers for later lookup. ID_REF
-        # is the most common, so we use that.
+        # is the most common, so we use that. The Affymetrix files aren't
+        # rewritten here, _convert_affy_genes writes their header along with
+        # the converted ids.
+        job_context["header"] = row
+        job_context["has_header"] = True
         if "ID_REF" not in joined and not job_context["is_illumina"]:
+            job_context["header"] = ["ID_REF", "VALUE"]
             try:
                 float(row[1])
-                # Okay, there's no header so can just prepend to the file.
-                with open(job_context["input_file_path"], "r", encoding="utf-8") as f:
-                    all_content = f.read()
-
-                job_context["input_file_path"] = (
-                    job_context["work_dir"] + original_file.filename + ".fixed"
-                )
-                with open(job_context["input_file_path"], "w+", encoding="utf-8") as f:
-                    f.seek(0, 0)
-                    f.write("ID_REF\tVALUE" + "\n" + all_content)
+                # Okay, there's no header so the first line is data.
+                job_context["has_header"] = False
             except ValueError:
-                # There is already a header row. Let's replace it with ID_Ref
-                with open(job_context["input_file_path"], "r", encoding="utf-8") as f:
-                    all_content = f.read()
-
-                job_context["input_file_path"] = (
-                    job_context["work_dir"] + original_file.filename + ".fixed"
-                )
-                with open(job_context["input_file_path"], "w+", encoding="utf-8") as f:
-                    f.seek(0, 0)
-                    f.write("ID_REF\tVALUE" + "\n" + ("\n".join(all_content[1:])))
+                # There is already a header row. Let's replace its first
+                # column with ID_REF, keeping the rest so it's as wide as the
+                # rows.
+                job_context["header"] = ["ID_REF"] + row[1:]
             except Exception as e:
                 logger.exception(
                     "Unable to read input file or header row.",
@@ -124,21 +119,11 @@ def _prepare_files(job_context: Dict) -> Dict:
                         job_context["job"].no_retry = True
                         return job_context
 
-                    # Okay, there's no header so can just prepend to the file.
-                    with open(job_context["input_file_path"], "r", encoding="utf-8") as f:
-                        all_content = f.read()
-
-                    job_context["input_file_path"] = (
-                        job_context["work_dir"] + original_file.filename + ".fixed"
-                    )
-                    with open(job_context["input_file_path"], "w+", encoding="utf-8") as f:
-                        f.seek(0, 0)
-                        if len(row) == 2:
-                            f.write("Reporter Identifier\tVALUE" + "\n" + all_content)
-                        elif len(row) == 3:
-                            f.write(
-                                "Reporter Identifier\tVALUE\tDetection Pval" + "\n" + all_content
-                            )
+                    # Okay, there's no header so can just prepend one to the file.
+                    header = ["Reporter Identifier", "VALUE", "Detection Pval"][: len(row)]
+                    fixed_file_path = job_context["work_dir"] + original_file.filename + ".fixed"
+                    _write_with_header(job_context["input_file_path"], fixed_file_path, header)
+                    job_context["input_file_path"] = fixed_file_path
 
                     job_context["column_name"] = "Reporter Identifier"
                 except ValueError:
@@ -166,6 +151,82 @@ def _prepare_files(job_context: Dict) -> Dict:
     return job_context
 
 
+def _write_with_header(input_file_path: str, output_file_path: str, header: List[str]) -> None:
+    """Writes `header` followed by the contents of the input file to
+    `output_file_path`, copying the input in buffered chunks rather than
+    reading all of it into memory."""
+    with open(input_file_path, "r", encoding="utf-8") as input_file, open(
+        output_file_path, "w", encoding="utf-8"
+    ) as output_file:
+        output_file.write("\t".join(header) + "\n")
+        shutil.copyfileobj(input_file, output_file)
+
+
+def _read_rows(input_file_path: str, has_header: bool) -> Iterator[List[str]]:
+    """Yields the rows of a tab separated file one at a time, without
+    its header row if `has_header`."""
+    with open(input_file_path, "r", encoding="utf-8") as input_file:
+        rows = csv.reader(input_file, delimiter="\t")
+        if has_header:
+            next(rows, None)
+
+        for row in rows:
+            if row:
+                yield row
+
+
+def _detect_id_column(
+    input_file_path: str, has_header: bool, id_columns: Dict[str, Mapping[str, List[str]]]
+) -> Optional[str]:
+    """Returns the gene index column with the largest share of the
+    distinct ids in the input file's first column, or None if none of
+    them has at least MIN_ID_OVERLAP of them.
+
+    Only the ids themselves are kept, so memory use depends on the size
+    of the gene index rather than the input file."""
+    num_rows = 0
+    found_ids = {column_name: set() for column_name in id_columns}
+    for row in _read_rows(input_file_path, has_header):
+        num_rows += 1
+        gene_id = row[0].strip()
+        for column_name, ids_to_ensembl_ids in id_columns.items():
+            if gene_id in ids_to_ensembl_ids:
+                found_ids[column_name].add(gene_id)
+
+    if num_rows == 0:
+        return None
+
+    best_column = max(found_ids, key=lambda column_name: len(found_ids[column_name]))
+    if len(found_ids[best_column]) / num_rows < MIN_ID_OVERLAP:
+        return None
+
+    return best_column
+
+
+def _convert_ids(
+    input_file_path: str,
+    output_file_path: str,
+    header: List[str],
+    has_header: bool,
+    ids_to_ensembl_ids: Mapping[str, List[str]],
+) -> None:
+    """Writes the rows of the input file to `output_file_path` with the
+    ids in their first column replaced by the Ensembl ids they
+    correspond to, under `header` with its first column renamed to
+    ENSEMBL.
+
+    Rows whose ids have no Ensembl id are dropped and rows whose ids
+    have several are written once for each of them. The duplicates get
+    squished together at smash-time so that we can provide options on
+    the squish method."""
+    with open(output_file_path, "w", encoding="utf-8") as output_file:
+        output_file.write("\t".join(["ENSEMBL"] + header[1:]) + "\n")
+        for row in _read_rows(input_file_path, has_header):
+            values = "\t".join(row[1:])
+            for ensembl_id in ids_to_ensembl_ids.get(row[0].strip(), []):
+                output_file.write(ensembl_id + "\t" + values + "\n")
+
+
 def _convert_genes(job_context: Dict) -> Dict:
     """ Dispatches to the appropriate gene converter"""
 
@@ -189,7 +250,7 @@ def _convert_affy_genes(job_context: Dict) -> Dict:
         job_context["job"].no_retry = True
         return job_context
 
-    gene_index_path = "/home/user/gene_indexes/" + job_context["internal_accession"] + ".tsv.gz"
+    gene_index_path = gene_indexes.GENE_INDEX_DIR + job_context["internal_accession"] + ".tsv.gz"
     if not os.path.exists(gene_index_path):
         logger.error(
             "Missing gene index file for platform!",
@@ -203,37 +264,25 @@ def _convert_affy_genes(job_context: Dict) -> Dict:
         job_context["success"] = False
         return job_context
 
-    job_context["script_name"] = "gene_convert.R"
     try:
-        subprocess.check_output(
-            [
-                "/usr/bin/Rscript",
-                "--vanilla",  # Shut up Rscript
-                "/home/user/data_refinery_workers/processors/" + job_context["script_name"],
-                "--geneIndexPath",
-                gene_index_path,
-                "--inputFile",
-                job_context["input_file_path"],
-                "--outputFile",
-                job_context["output_file_path"],
-            ],
-            stderr=subprocess.PIPE,
+        id_columns = gene_indexes.load_gene_index(gene_index_path)
+        id_column = _detect_id_column(
+            job_context["input_file_path"], job_context["has_header"], id_columns
         )
-    except subprocess.CalledProcessError as e:
-        error_template = "Status code {0} from {1}: {2}"
-        error_message = error_template.format(e.returncode, job_context["script_name"], e.stderr)
-        logger.error(error_message, job_context=job_context)
-        job_context["job"].failure_reason = error_message
+    except Exception as e:
+        logger.exception(
+            "Could not read input file or gene index.",
+            input_file_path=job_context["input_file_path"],
+            gene_index_path=gene_index_path,
+        )
+        job_context["job"].failure_reason = str(e)
         job_context["success"] = False
         job_context["job"].no_retry = True
         return job_context
-    except Exception as e:
-        error_template = (
-            "Encountered error in R code while running {0}"
-            " pipeline during processing of {1}: {2}"
-        )
-        error_message = error_template.format(
-            job_context["script_name"], job_context["input_file_path"], str(e)
+
+    if not id_column:
+        error_message = "Not enough overlapping ids detected in {} for {}".format(
+            job_context["input_file_path"], job_context["internal_accession"]
         )
         logger.error(error_message, job_context=job_context)
         job_context["job"].failure_reason = error_message
@@ -241,6 +290,23 @@ def _convert_affy_genes(job_context: Dict) -> Dict:
         job_context["job"].no_retry = True
         return job_context
 
+    job_context["script_name"] = "no_op._convert_ids"
+    try:
+        _convert_ids(
+            job_context["input_file_path"],
+            job_context["output_file_path"],
+            job_context["header"],
+            job_context["has_header"],
+            id_columns[id_column],
+        )
+    except Exception as e:
+        logger.exception(
+            "Could not write converted file.", output_file_path=job_context["output_file_path"]
+        )
+        job_context["job"].failure_reason = str(e)
+        job_context["success"] = False
+        return job_context
+
     # Quality control!
     # Related: https://github.com/AlexsLemonade/refinebio/issues/614
     # Related: GSM102671
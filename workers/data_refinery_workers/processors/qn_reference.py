@@ -1,9 +1,12 @@
+import math
 import subprocess
 import time
-from typing import Dict
+from multiprocessing import Pool
+from typing import Dict, List, Tuple
 
 from django.utils import timezone
 
+import numpy as np
 import pandas as pd
 
 from data_refinery_common.enums import PipelineEnum
@@ -15,7 +18,6 @@ from data_refinery_common.models import (
     Experiment,
     Pipeline,
 )
-from data_refinery_common.utils import queryset_iterator
 from data_refinery_workers.processors import smashing_utils, utils
 
 logger = get_and_configure_logger(__name__)
@@ -35,81 +37,172 @@ def _prepare_input(job_context: Dict) -> Dict:
     return job_context
 
 
-def _build_qn_target(job_context: Dict) -> Dict:
-    """ Iteratively creates a QN target file, method described here:
-    https://github.com/AlexsLemonade/refinebio/pull/1013
-    """
-    job_context["time_start"] = timezone.now()
-
-    # Get the gene list from the first input
-    (computed_file, _) = job_context["input_files"]["ALL"][0]
-    computed_file_path = computed_file.get_synced_file_path()
-    geneset_target_frame = smashing_utils._load_and_sanitize_file(computed_file_path)
+class QNTargetBuilder:
+    """Sums the sorted expression values of samples that all have the
+    same genes, one computed file at a time.
 
-    # Get the geneset
-    geneset = set(geneset_target_frame.index.values)
-
-    # Sequentially build the target
-    sum_frame_input = {"index": list(geneset), "sum": [0 for value in geneset]}
-    sum_frame = pd.DataFrame(data=sum_frame_input)
-    sum_frame = sum_frame.set_index("index")
+    Each file is parsed straight into a float64 vector instead of being
+    kept around as a DataFrame, and the genes are checked against the
+    target by their position in `genes`. Files from the same platform
+    list their genes the same way, so the work of sanitizing their
+    identifiers and finding those positions is only redone when that
+    changes.
+    """
 
-    # Read and sum all of the inputs
-    num_valid_inputs = 0
-    for file, sample in job_context["input_files"]["ALL"]:
+    def __init__(self, genes: List[str]):
+        self.genes = pd.Index(genes)
+        self.sum = np.zeros(len(genes), dtype=np.float64)
+        self.num_valid_inputs = 0
+        self._layout = None
+        self._is_gene = None
+        self._gene_ids = None
+        self._positions = None
+
+    def _update_layout(self, layout: pd.Index) -> None:
+        if self._layout is not None and self._layout.equals(layout):
+            return
+
+        gene_ids, is_gene = smashing_utils._sanitize_gene_ids(layout)
+        self._layout = layout
+        self._is_gene = is_gene
+        self._gene_ids = gene_ids[is_gene]
+        # -1 for the genes that aren't in the target.
+        self._positions = self.genes.get_indexer(self._gene_ids)
+
+    def read_file(self, computed_file_path: str) -> Tuple[np.ndarray, np.ndarray]:
+        """Reads the expression values of a computed file as float64,
+        leaving out any Affymetrix control probes, along with the
+        position of each of their genes in `genes`."""
+        data = smashing_utils._read_computed_file(computed_file_path)
+        self._update_layout(data.index)
+        values = data.iloc[:, 0].to_numpy(dtype=np.float64)
+
+        return values[self._is_gene], self._positions
+
+    def add_file(self, computed_file: ComputedFile) -> bool:
+        """Adds the sorted expression values of `computed_file` to the sum.
+
+        Files that can't be loaded, don't have the same genes or have NA
+        values are skipped. Returns whether the file was added.
+        """
         try:
-            input_filepath = file.get_synced_file_path()
-            input_frame = smashing_utils._load_and_sanitize_file(input_filepath)
+            input_filepath = computed_file.get_synced_file_path()
+            values, positions = self.read_file(input_filepath)
         except Exception:
             logger.warn(
                 "No file loaded for input file",
                 exc_info=1,
-                bad_file=file,
-                num_valid_inputs_so_far=num_valid_inputs,
+                bad_file=computed_file,
+                num_valid_inputs_so_far=self.num_valid_inputs,
             )
-            continue
+            return False
 
         # If this input doesn't have the same geneset, we don't want it!
-        if set(input_frame.index.values) != geneset:
+        counts = np.bincount(positions[positions != -1], minlength=len(self.genes))
+        if (positions == -1).any() or not counts.all():
+            input_geneset = set(self._gene_ids)
             logger.warn(
                 "Input frame doesn't match target geneset, skipping!",
-                bad_file=file,
-                target_geneset_len=len(geneset),
-                bad_geneset_len=len(input_frame.index.values),
-                geneset_difference=list(geneset ^ set(input_frame.index.values))[:3],
-                num_valid_inputs_so_far=num_valid_inputs,
+                bad_file=computed_file,
+                target_geneset_len=len(self.genes),
+                bad_geneset_len=len(input_geneset),
+                geneset_difference=list(set(self.genes) ^ input_geneset)[:3],
+                num_valid_inputs_so_far=self.num_valid_inputs,
             )
-            continue
+            return False
+
+        # Average any duplicated genes like squish_duplicates does: NA
+        # values are left out, so a gene is only NA if all of its are.
+        expressions = values
+        if len(values) != len(self.genes):
+            is_present = ~np.isnan(values)
+            present_counts = np.bincount(positions[is_present], minlength=len(self.genes))
+            sums = np.bincount(
+                positions[is_present], weights=values[is_present], minlength=len(self.genes)
+            )
+            with np.errstate(invalid="ignore"):
+                expressions = sums / present_counts
 
         # We don't want to build QNs that have Nulls in them, so
         # filter out any samples that still have null genes at this
         # point.
-        num_nulls = input_frame.isnull().sum(axis=0)[0]
+        num_nulls = np.isnan(expressions).sum()
         if num_nulls != 0:
             logger.warn(
                 "Input frame contains NA values, skipping!",
-                bad_file=file,
+                bad_file=computed_file,
                 number_of_NAs=num_nulls,
-                num_valid_inputs_so_far=num_valid_inputs,
+                num_valid_inputs_so_far=self.num_valid_inputs,
             )
-            continue
+            return False
+
+        # The order of the genes doesn't matter once the values are sorted.
+        expressions.sort()
+        self.sum += expressions
+        self.num_valid_inputs += 1
+
+        return True
+
+    def merge(self, partial_sum: np.ndarray, num_valid_inputs: int) -> None:
+        """Adds the sum that another builder with the same genes made."""
+        self.sum += partial_sum
+        self.num_valid_inputs += num_valid_inputs
+
 
-        # Sort the input
-        sample_name = list(input_frame.columns.values)[0]
-        expressions = input_frame.sort_values(sample_name)
+def _build_partial_qn_target(
+    genes: List[str], computed_files: List[ComputedFile]
+) -> Tuple[np.ndarray, int]:
+    """Sums the sorted expression values of some of the inputs in a pool worker."""
+    builder = QNTargetBuilder(genes)
+    for computed_file in computed_files:
+        builder.add_file(computed_file)
 
-        # Add the sorted input to the sum frame
-        sum_frame["sum"] = sum_frame["sum"] + expressions[sample_name].values
+    return builder.sum, builder.num_valid_inputs
 
-        # We'll divide by this later
-        num_valid_inputs = num_valid_inputs + 1
+
+def _build_qn_target(job_context: Dict) -> Dict:
+    """ Iteratively creates a QN target file, method described here:
+    https://github.com/AlexsLemonade/refinebio/pull/1013
+
+    The inputs are split between a pool of processes when there's more
+    than one to use, and the sums each of them make are added up at the end.
+    """
+    job_context["time_start"] = timezone.now()
+
+    # Get the gene list from the first input
+    (computed_file, _) = job_context["input_files"]["ALL"][0]
+    computed_file_path = computed_file.get_synced_file_path()
+    geneset_target_frame = smashing_utils._load_and_sanitize_file(computed_file_path)
+
+    # Get the geneset
+    geneset = set(geneset_target_frame.index.values)
+    genes = list(geneset)
+
+    # Read and sum all of the inputs
+    computed_files = [file for file, _ in job_context["input_files"]["ALL"]]
+    builder = QNTargetBuilder(genes)
+    num_processes = min(smashing_utils.MULTIPROCESSING_MAX_THREAD_COUNT, len(computed_files))
+    if num_processes > 1:
+        chunk_size = math.ceil(len(computed_files) / num_processes)
+        chunks = [
+            (genes, computed_files[i : i + chunk_size])
+            for i in range(0, len(computed_files), chunk_size)
+        ]
+        with Pool(processes=num_processes) as pool:
+            for partial_sum, num_valid_inputs in pool.starmap(_build_partial_qn_target, chunks):
+                builder.merge(partial_sum, num_valid_inputs)
+    else:
+        for file in computed_files:
+            builder.add_file(file)
 
     # Divide our summation by the number of inputs and save the resulting object and metadata
-    sum_frame["sum"] = sum_frame["sum"] / num_valid_inputs
+    sum_frame = pd.DataFrame(
+        {"sum": builder.sum / builder.num_valid_inputs}, index=pd.Index(genes, name="index")
+    )
     job_context["time_end"] = timezone.now()
     job_context["sum_frame"] = sum_frame
-    job_context["num_valid_inputs"] = num_valid_inputs
-    job_context["geneset"] = list(geneset)
+    job_context["num_valid_inputs"] = builder.num_valid_inputs
+    job_context["geneset"] = genes
 
     # Write the file
     sum_frame.to_csv(
@@ -208,9 +301,7 @@ def _update_caches(job_context: Dict) -> Dict:
         organism.save()
 
     unique_experiments = Experiment.objects.all().filter(organism=organism).distinct()
-
-    for experiment in queryset_iterator(unique_experiments):
-        experiment.update_num_samples()
+    Experiment.bulk_update_num_samples(unique_experiments)
 
     return job_context
 
@@ -1,20 +1,26 @@
+import gzip
+import itertools
 import json
+import math
+import multiprocessing
 import os
 import re
 import shutil
 import subprocess
 import tarfile
-from typing import Dict, List
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
 from django.conf import settings
 from django.db import transaction
 from django.utils import timezone
 
 import boto3
-import numpy as np
 import pandas as pd
 import untangle
 from botocore.client import Config
+from retrying import retry
 
 from data_refinery_common.enums import PipelineEnum
 from data_refinery_common.logging import get_and_configure_logger
@@ -34,7 +40,7 @@ from data_refinery_common.rna_seq import (
     get_quant_results_for_experiment,
     should_run_tximport,
 )
-from data_refinery_common.utils import get_env_variable
+from data_refinery_common.utils import calculate_sha1, get_env_variable
 from data_refinery_workers.processors import utils
 
 # We have to set the signature_version to v4 since us-east-1 buckets require
@@ -44,6 +50,26 @@ logger = get_and_configure_logger(__name__)
 JOB_DIR_PREFIX = "processor_job_"
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
 S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
+MULTIPROCESSING_MAX_THREAD_COUNT = max(1, math.floor(multiprocessing.cpu_count() / 2) - 1)
+
+# The index length is estimated from the first this many reads of each
+# FASTQ file, unless the estimate's confidence interval, this many
+# standard errors wide on each side, includes the threshold between the
+# short and long indices. Then all of the reads are used.
+INDEX_LENGTH_SAMPLE_READS = 100000
+INDEX_LENGTH_CONFIDENCE_Z = 3
+INDEX_LENGTH_THRESHOLD = 75
+
+# tximport's quant.sf files are downloaded this many at a time, and each
+# download is retried this many times.
+QUANT_FILE_DOWNLOAD_MAX_WORKERS = int(get_env_variable("QUANT_FILE_DOWNLOAD_MAX_WORKERS", "8"))
+QUANT_FILE_DOWNLOAD_ATTEMPTS = 3
+# Downloaded quant.sf files are cached here by their sha1, and the least
+# recently used ones are deleted once they take up more than this.
+QUANT_FILE_CACHE_DIR = os.path.join(LOCAL_ROOT_DIR, "quant_files")
+QUANT_FILE_CACHE_MAX_BYTES = int(
+    get_env_variable("QUANT_FILE_CACHE_MAX_BYTES", str(20 * 1024 * 1024 * 1024))
+)
 
 
 def _set_job_prefix(job_context: Dict) -> Dict:
@@ -253,6 +279,35 @@ def _determine_index_length_sra(job_context: Dict) -> Dict:
     return job_context
 
 
+def _get_read_length_stats(
+    input_file_path: str, max_reads: Optional[int] = None
+) -> Tuple[int, int, int, bool]:
+    """Reads the first `max_reads` reads of a FASTQ file, or all of them
+    if it's None. Returns how many reads there were, the sum of their
+    lengths and the sum of their squared lengths, and whether the whole
+    file was read."""
+    number_of_reads = 0
+    total_base_pairs = 0
+    total_squared_base_pairs = 0
+
+    open_fastq = gzip.open if input_file_path.endswith(".gz") else open
+    with open_fastq(input_file_path, "rb") as fastq_file:
+        # In the FASTQ file format, there are 4 lines for each
+        # read. Three of these contain metadata about the
+        # read. The string representing the read itself is found
+        # on the second line of each quartet.
+        for line in itertools.islice(fastq_file, 1, None, 4):
+            if number_of_reads == max_reads:
+                return number_of_reads, total_base_pairs, total_squared_base_pairs, False
+
+            read_length = len(line.rstrip(b"\r\n"))
+            number_of_reads += 1
+            total_base_pairs += read_length
+            total_squared_base_pairs += read_length * read_length
+
+    return number_of_reads, total_base_pairs, total_squared_base_pairs, True
+
+
 def _determine_index_length(job_context: Dict) -> Dict:
     """Determines whether to use the long or short salmon index.
 
@@ -260,49 +315,47 @@ def _determine_index_length(job_context: Dict) -> Dict:
     'short' if the short index is appropriate or 'long' if the long
     index is appropriate. For more information on index length see the
     _create_index function of the transcriptome_index processor.
+
+    The average read length is estimated from the first reads of the
+    input files, and only if that's too close to the threshold to tell
+    which index to use are the whole files read.
     """
 
     if job_context.get("sra_input_file_path", None):
         return _determine_index_length_sra(job_context)
 
     logger.debug("Determining index length..")
-    total_base_pairs = 0
-    number_of_reads = 0
-    counter = 1
-
-    if ".gz" == job_context["input_file_path"][-3:]:
-        cat = "zcat"
-    else:
-        cat = "cat"
-    # zcat unzips the file provided and dumps the output to STDOUT.
-    # It is installed by default in Debian so it should be included
-    # in every docker image already.
-    with subprocess.Popen(
-        [cat, job_context["input_file_path"]], stdout=subprocess.PIPE, universal_newlines=True
-    ) as process:
-        for line in process.stdout:
-            # In the FASTQ file format, there are 4 lines for each
-            # read. Three of these contain metadata about the
-            # read. The string representing the read itself is found
-            # on the second line of each quartet.
-            if counter % 4 == 2:
-                total_base_pairs += len(line.replace("\n", ""))
-                number_of_reads += 1
-            counter += 1
-
+    input_file_paths = [job_context["input_file_path"]]
     if "input_file_path_2" in job_context:
-        if ".gz" == job_context["input_file_path_2"][-3:]:
-            cat = "zcat"
-        else:
-            cat = "cat"
-        with subprocess.Popen(
-            [cat, job_context["input_file_path_2"]], stdout=subprocess.PIPE, universal_newlines=True
-        ) as process:
-            for line in process.stdout:
-                if counter % 4 == 2:
-                    total_base_pairs += len(line.replace("\n", ""))
-                    number_of_reads += 1
-                counter += 1
+        input_file_paths.append(job_context["input_file_path_2"])
+
+    max_reads = INDEX_LENGTH_SAMPLE_READS
+    while True:
+        read_length_stats = [
+            _get_read_length_stats(input_file_path, max_reads)
+            for input_file_path in input_file_paths
+        ]
+        number_of_reads = sum(stats[0] for stats in read_length_stats)
+        total_base_pairs = sum(stats[1] for stats in read_length_stats)
+        total_squared_base_pairs = sum(stats[2] for stats in read_length_stats)
+        read_whole_files = all(stats[3] for stats in read_length_stats)
+
+        if number_of_reads == 0 or read_whole_files:
+            break
+
+        mean_read_length = total_base_pairs / number_of_reads
+        variance = max(0, total_squared_base_pairs / number_of_reads - mean_read_length ** 2)
+        margin = INDEX_LENGTH_CONFIDENCE_Z * math.sqrt(variance / number_of_reads)
+        if abs(mean_read_length - INDEX_LENGTH_THRESHOLD) >= margin:
+            break
+
+        logger.debug(
+            "Estimated read length is too close to the threshold, reading all of the reads.",
+            mean_read_length=mean_read_length,
+            margin=margin,
+            job_id=job_context["job"].id,
+        )
+        max_reads = None
 
     if number_of_reads == 0:
         logger.error(
@@ -321,7 +374,7 @@ def _determine_index_length(job_context: Dict) -> Dict:
     # Put the raw index length into the job context in a new field for regression testing purposes
     job_context["index_length_raw"] = index_length_raw
 
-    if index_length_raw > 75:
+    if index_length_raw > INDEX_LENGTH_THRESHOLD:
         job_context["index_length"] = "long"
     else:
         job_context["index_length"] = "short"
@@ -454,6 +507,191 @@ def _find_or_download_index(job_context: Dict) -> Dict:
     return job_context
 
 
+def _get_quant_file_cache_path(quant_file: ComputedFile) -> str:
+    return os.path.join(QUANT_FILE_CACHE_DIR, quant_file.sha1 + "_quant.sf")
+
+
+def _fetch_quant_file(
+    quant_file: ComputedFile, quant_work_path: str, num_attempts: int = QUANT_FILE_DOWNLOAD_ATTEMPTS
+) -> str:
+    """Puts a copy of `quant_file` at `quant_work_path` and returns its path.
+
+    The file is taken from the cache if it's there. Otherwise it's
+    downloaded, retrying up to `num_attempts` times, and added to the
+    cache once its sha1 has been checked.
+    """
+    cache_path = _get_quant_file_cache_path(quant_file)
+    if quant_file.sha1 and os.path.exists(cache_path):
+        try:
+            utils.link_or_copy(cache_path, quant_work_path)
+            # Mark it as recently used so it's one of the last to be evicted.
+            os.utime(cache_path)
+            return quant_work_path
+        except OSError:
+            logger.warning("Failed to use cached quant.sf file.", cache_path=cache_path)
+
+    @retry(stop_max_attempt_number=num_attempts, wait_exponential_multiplier=1000)
+    def download_quant_file() -> str:
+        quant_file_path = quant_file.get_synced_file_path(path=quant_work_path)
+        if not quant_file_path:
+            # Don't let the next attempt mistake a bad download for the file.
+            if os.path.exists(quant_work_path):
+                os.remove(quant_work_path)
+            raise utils.ProcessorJobError(
+                "Failed to download quant.sf file for tximport",
+                success=False,
+                computed_file_id=quant_file.pk,
+            )
+        return quant_file_path
+
+    quant_file_path = download_quant_file()
+
+    if quant_file.sha1 and calculate_sha1(quant_file_path) == quant_file.sha1:
+        try:
+            os.makedirs(QUANT_FILE_CACHE_DIR, exist_ok=True)
+            # Write to a temporary file first so that concurrent jobs
+            # never read a partially written cache.
+            temp_path = "{}.{}.{}.tmp".format(cache_path, os.getpid(), threading.get_ident())
+            utils.link_or_copy(quant_file_path, temp_path)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # don't fail if we can't save the cache
+            logger.warning("Failed to cache quant.sf file.", cache_path=cache_path)
+
+    return quant_file_path
+
+
+def _evict_quant_file_cache(max_bytes: int = QUANT_FILE_CACHE_MAX_BYTES) -> None:
+    """Deletes the least recently used quant.sf files from the cache
+    until it takes up no more than `max_bytes`."""
+    try:
+        cached_files = []
+        for entry in os.scandir(QUANT_FILE_CACHE_DIR):
+            entry_stat = entry.stat()
+            cached_files.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+    except OSError:
+        return
+
+    cache_size = sum(size for _, size, _ in cached_files)
+    for _, size, path in sorted(cached_files):
+        if cache_size <= max_bytes:
+            break
+
+        try:
+            os.remove(path)
+        except OSError:
+            # Another job may have evicted it first.
+            pass
+        cache_size -= size
+
+
+def _prefetch_quant_files(
+    work_dir: str,
+    quant_files: List[ComputedFile],
+    max_workers: int = QUANT_FILE_DOWNLOAD_MAX_WORKERS,
+) -> List[str]:
+    """Downloads the quant.sf files tximport needs concurrently, taking
+    the ones that were already downloaded by an earlier job from the
+    cache. Returns their paths, in the same order as `quant_files`."""
+    quant_work_paths = []
+    for quant_file in quant_files:
+        # We create a directory in the work directory for each (quant.sf) file, as
+        # tximport assigns column names based on the parent directory name,
+        # and we need those names so that we can reassociate withe samples later.
+        # ex., a file with absolute_file_path: /processor_job_1/SRR123_output/quant.sf
+        # downloads to: /processor_job_2/SRR123_output/quant.sf
+        # So the result file has frame "SRR123_output", which we can associate with sample SRR123
+        sample_output = work_dir + str(quant_file.absolute_file_path.split("/")[-2]) + "/"
+        os.makedirs(sample_output, exist_ok=True)
+        quant_work_paths.append(sample_output + quant_file.filename)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        quant_file_paths = list(executor.map(_fetch_quant_file, quant_files, quant_work_paths))
+
+    _evict_quant_file_cache()
+
+    return quant_file_paths
+
+
+def _write_sample_tpm_file(work_dir: str, tpm_filename: str, column: pd.Series) -> ComputedFile:
+    """Writes one sample's column of the tximport result to its own TPM
+    file and returns an unsaved ComputedFile for it."""
+    sample_file_name = column.name + "_" + tpm_filename
+    frame_path = os.path.join(work_dir, sample_file_name)
+    column.to_frame().to_csv(frame_path, sep="\t", encoding="utf-8")
+
+    computed_file = ComputedFile()
+    computed_file.absolute_file_path = frame_path
+    computed_file.filename = sample_file_name
+    computed_file.is_smashable = True
+    computed_file.is_qc = False
+    computed_file.is_public = True
+    computed_file.calculate_sha1()
+    computed_file.calculate_size()
+
+    return computed_file
+
+
+def _create_tximport_result_files(
+    work_dir: str,
+    data: pd.DataFrame,
+    tpm_filename: str,
+    result: ComputationalResult,
+    rds_file: ComputedFile,
+) -> Tuple[List[Sample], List[ComputedFile]]:
+    """Writes a TPM file for each sample in the tximport result and
+    associates it, the RDS file and the result with the sample.
+
+    The samples are looked up with one query, the files are written by a
+    pool of threads and the ComputedFiles and associations are created
+    with bulk_create, so the number of queries doesn't grow with the
+    number of samples. Returns the samples and their TPM files, in the
+    order of the columns of `data`.
+    """
+    # The frame column header is based off of the path, which includes _output.
+    sample_accession_codes = [column.replace("_output", "") for column in data.columns]
+    samples_by_accession_code = Sample.objects.in_bulk(
+        sample_accession_codes, field_name="accession_code"
+    )
+    missing_accession_codes = set(sample_accession_codes) - samples_by_accession_code.keys()
+    if missing_accession_codes:
+        raise utils.ProcessorJobError(
+            "Couldn't find the samples for some of the tximport results",
+            success=False,
+            sample_accession_codes=sorted(missing_accession_codes),
+        )
+    samples = [samples_by_accession_code[code] for code in sample_accession_codes]
+
+    with ThreadPoolExecutor(max_workers=MULTIPROCESSING_MAX_THREAD_COUNT) as executor:
+        individual_files = list(
+            executor.map(
+                lambda column: _write_sample_tpm_file(work_dir, tpm_filename, data[column]),
+                data.columns,
+            )
+        )
+
+    for computed_file in individual_files:
+        computed_file.result = result
+
+    with transaction.atomic():
+        ComputedFile.objects.bulk_create(individual_files)
+        SampleResultAssociation.objects.bulk_create(
+            [SampleResultAssociation(sample=sample, result=result) for sample in samples],
+            ignore_conflicts=True,
+        )
+        # Associate each sample with the RDS file and its TPM file.
+        SampleComputedFileAssociation.objects.bulk_create(
+            [
+                SampleComputedFileAssociation(sample=sample, computed_file=computed_file)
+                for sample, tpm_file in zip(samples, individual_files)
+                for computed_file in [rds_file, tpm_file]
+            ],
+            ignore_conflicts=True,
+        )
+
+    return samples, individual_files
+
+
 def _run_tximport_for_experiment(
     job_context: Dict, experiment: Experiment, quant_files: List[ComputedFile]
 ) -> Dict:
@@ -465,19 +703,7 @@ def _run_tximport_for_experiment(
     tximport_path_list_file = job_context["work_dir"] + "tximport_inputs.txt"
     quant_file_paths = {}
     with open(tximport_path_list_file, "w") as input_list:
-        for quant_file in quant_files:
-            # We create a directory in the work directory for each (quant.sf) file, as
-            # tximport assigns column names based on the parent directory name,
-            # and we need those names so that we can reassociate withe samples later.
-            # ex., a file with absolute_file_path: /processor_job_1/SRR123_output/quant.sf
-            # downloads to: /processor_job_2/SRR123_output/quant.sf
-            # So the result file has frame "SRR123_output", which we can associate with sample SRR123
-            sample_output = (
-                job_context["work_dir"] + str(quant_file.absolute_file_path.split("/")[-2]) + "/"
-            )
-            os.makedirs(sample_output, exist_ok=True)
-            quant_work_path = sample_output + quant_file.filename
-            quant_file_path = quant_file.get_synced_file_path(path=quant_work_path)
+        for quant_file_path in _prefetch_quant_files(job_context["work_dir"], quant_files):
             input_list.write(quant_file_path + "\n")
             quant_file_paths[quant_file_path] = os.stat(quant_file_path).st_size
 
@@ -557,43 +783,12 @@ def _run_tximport_for_experiment(
 
     # Split the tximport result into smashable subfiles
     data = pd.read_csv(tpm_file_path, sep="\t", header=0, index_col=0)
-    individual_files = []
-    frames = np.split(data, len(data.columns), axis=1)
-    for frame in frames:
-        # Create sample-specific TPM file.
-        sample_file_name = frame.columns.values[0] + "_" + tpm_filename
-        frame_path = os.path.join(job_context["work_dir"], sample_file_name)
-        frame.to_csv(frame_path, sep="\t", encoding="utf-8")
-
-        # The frame column header is based off of the path, which includes _output.
-        sample_accession_code = frame.columns.values[0].replace("_output", "")
-        sample = Sample.objects.get(accession_code=sample_accession_code)
-
-        computed_file = ComputedFile()
-        computed_file.absolute_file_path = frame_path
-        computed_file.filename = sample_file_name
-        computed_file.result = result
-        computed_file.is_smashable = True
-        computed_file.is_qc = False
-        computed_file.is_public = True
-        computed_file.calculate_sha1()
-        computed_file.calculate_size()
-        computed_file.save()
-        job_context["computed_files"].append(computed_file)
-        job_context["smashable_files"].append(computed_file)
-
-        SampleResultAssociation.objects.get_or_create(sample=sample, result=result)
-
-        # Create association with the RDS file.
-        SampleComputedFileAssociation.objects.get_or_create(sample=sample, computed_file=rds_file)
-
-        # Create association with TPM file.
-        SampleComputedFileAssociation.objects.get_or_create(
-            sample=sample, computed_file=computed_file
-        )
-
-        individual_files.append(computed_file)
-        job_context["samples"].append(sample)
+    samples, individual_files = _create_tximport_result_files(
+        job_context["work_dir"], data, tpm_filename, result, rds_file
+    )
+    job_context["computed_files"].extend(individual_files)
+    job_context["smashable_files"].extend(individual_files)
+    job_context["samples"].extend(samples)
 
     # Salmon-processed samples aren't marked as is_processed
     # until they are fully tximported, this value sets that
@@ -2,7 +2,6 @@
 
 import logging
 import os
-import shutil
 import time
 from datetime import timedelta
 from pathlib import Path
@@ -13,6 +12,7 @@ from django.conf import settings
 from django.utils import timezone
 
 import boto3
+import numpy as np
 import pandas as pd
 import psutil
 import requests
@@ -64,50 +64,48 @@ def log_state(message, job_id, start_time=False):
             return time.time()
 
 
-def _inner_join(job_context: Dict) -> pd.DataFrame:
-    """Performs an inner join across the all_frames key of job_context.
+def _join_frames(job_context: Dict, how: str = "inner") -> pd.DataFrame:
+    """Joins the frames in the all_frames key of job_context on their
+    indices, skipping duplicates. `how` can be "inner" or "outer" and
+    means the same thing it does to `pandas.merge`.
 
     Returns a dataframe, not the job_context.
 
-    TODO: This function should be mostly unnecessary now because we
-    pretty much do this in the smashing utils but I don't want to rip
-    it out right now .
+    Only the indices are joined one frame at a time, to find out which
+    frames get skipped and which genes end up in the result. Then the
+    values of every frame are copied into a single preallocated matrix,
+    so the time and memory needed grow linearly with the number of
+    frames. The result is the same as merging the frames one after
+    another.
     """
-    # Merge all of the frames we've gathered into a single big frame, skipping duplicates.
     # TODO: If the very first frame is the wrong platform, are we boned?
-    merged = job_context["all_frames"][0]
-    i = 1
-
-    old_len_merged = len(merged)
-    merged_backup = merged
-
-    while i < len(job_context["all_frames"]):
-        frame = job_context["all_frames"][i]
-        i = i + 1
+    first_frame = job_context["all_frames"][0]
+    joined_frames = [first_frame]
+    joined_columns = set(first_frame.columns)
+    joined_index = first_frame.index
 
+    for i, frame in enumerate(job_context["all_frames"][1:], start=2):
         if i % 1000 == 0:
             logger.info("Smashing keyframe", i=i, job_id=job_context["job"].id)
 
         # I'm not sure where these are sneaking in from, but we don't want them.
         # Related: https://github.com/AlexsLemonade/refinebio/issues/390
-        breaker = False
-        for column in frame.columns:
-            if column in merged.columns:
-                breaker = True
-
-        if breaker:
+        repeated_columns = [column for column in frame.columns if column in joined_columns]
+        if repeated_columns:
             logger.warning(
                 "Column repeated for smash job!",
                 dataset_id=job_context["dataset"].id,
                 job_id=job_context["job"].id,
-                column=column,
+                column=repeated_columns[0],
             )
             continue
 
-        # This is the inner join, the main "Smash" operation
-        merged = merged.merge(frame, how="inner", left_index=True, right_index=True)
+        # This is the join, the main "Smash" operation. Index.join is
+        # what pandas.merge uses, so the genes come out in the same order.
+        new_index = joined_index.join(frame.index, how=how)
 
-        new_len_merged = len(merged)
+        old_len_merged = len(joined_index)
+        new_len_merged = len(new_index)
         if new_len_merged < old_len_merged:
             logger.warning(
                 "Dropped rows while smashing!",
@@ -124,18 +122,43 @@ def _inner_join(job_context: Dict) -> pd.DataFrame:
                 new_len_merged=new_len_merged,
                 bad_frame_number=i,
             )
-            merged = merged_backup
-            new_len_merged = len(merged)
             try:
                 job_context["unsmashable_files"].append(frame.columns[0])
             except Exception:
                 # Something is really, really wrong with this frame.
                 pass
+            continue
+
+        joined_frames.append(frame)
+        joined_columns.update(frame.columns)
+        joined_index = new_index
 
-        old_len_merged = len(merged)
-        merged_backup = merged
+    columns = [column for frame in joined_frames for column in frame.columns]
+    dtype = np.result_type(*{dtype for frame in joined_frames for dtype in frame.dtypes})
+    matrix = np.full((len(joined_index), len(columns)), np.nan, dtype=dtype)
 
-    return merged
+    column_start = 0
+    for frame in joined_frames:
+        column_end = column_start + len(frame.columns)
+        # The row of each of the joined genes in this frame, or -1 if it's missing.
+        frame_rows = frame.index.get_indexer(joined_index)
+        present = frame_rows >= 0
+        matrix[present, column_start:column_end] = frame.values[frame_rows[present]]
+        column_start = column_end
+
+    return pd.DataFrame(matrix, index=joined_index, columns=columns)
+
+
+def _inner_join(job_context: Dict) -> pd.DataFrame:
+    """Performs an inner join across the all_frames key of job_context.
+
+    Returns a dataframe, not the job_context.
+
+    TODO: This function should be mostly unnecessary now because we
+    pretty much do this in the smashing utils but I don't want to rip
+    it out right now .
+    """
+    return _join_frames(job_context, how="inner")
 
 
 def process_frames_for_key(key: str, input_files: List[ComputedFile], job_context: Dict) -> Dict:
@@ -200,7 +223,7 @@ def _smash_key(job_context: Dict, key: str, input_files: List[ComputedFile]) ->
         os.makedirs(outfile_dir, exist_ok=True)
         samples = [sample for (_, sample) in input_files]
         job_context["num_samples"] += smashing_utils.sync_quant_files(
-            outfile_dir, samples, job_context["filtered_samples"]
+            outfile_dir, samples, job_context["filtered_samples"], job_context.get("archive")
         )
         # we ONLY want to give quant sf files to the user if that's what they requested
         return job_context
@@ -260,9 +283,13 @@ def _smash_key(job_context: Dict, key: str, input_files: List[ComputedFile]) ->
 
     outfile_dir = job_context["output_dir"] + key + "/"
     os.makedirs(outfile_dir, exist_ok=True)
-    outfile = outfile_dir + key + ".tsv"
-    job_context["smash_outfile"] = outfile
-    untransposed.to_csv(outfile, sep="\t", encoding="utf-8")
+    outfiles = smashing_utils.write_matrix(
+        untransposed,
+        outfile_dir + key,
+        job_context["dataset"].file_format,
+        job_context.get("archive"),
+    )
+    job_context["smash_outfile"] = outfiles[0]
 
     log_state("end _smash_key for {}".format(key), job_context["job"].id, start_smash)
 
@@ -283,28 +310,41 @@ def _smash_all(job_context: Dict) -> Dict:
         job_id=job_context["job"].id,
     )
 
+    # The expression matrices and quant.sf files are compressed into the
+    # zip as they're produced, so they don't need a second copy on disk.
+    job_context["output_file"] = (
+        "/home/user/data_store/smashed/" + str(job_context["dataset"].pk) + ".zip"
+    )
     try:
-        # Once again, `key` is either a species name or an experiment accession
-        for key, input_files in job_context.pop("input_files").items():
-            job_context = _smash_key(job_context, key, input_files)
-    except Exception as e:
-        raise utils.ProcessorJobError(
-            "Could not smash dataset: " + str(e),
-            success=False,
-            dataset_id=job_context["dataset"].id,
-            num_input_files=job_context["num_input_files"],
+        archive = smashing_utils.ArchiveWriter(
+            job_context["output_file"], job_context["output_dir"]
         )
-
-    smashing_utils.write_non_data_files(job_context)
-
-    # Finally, compress all files into a zip
-    final_zip_base = "/home/user/data_store/smashed/" + str(job_context["dataset"].pk)
-    try:
-        shutil.make_archive(final_zip_base, "zip", job_context["output_dir"])
     except OSError:
         raise utils.ProcessorJobError("Smash Error while generating zip file", success=False)
 
-    job_context["output_file"] = final_zip_base + ".zip"
+    with archive:
+        job_context["archive"] = archive
+        try:
+            # Once again, `key` is either a species name or an experiment accession
+            for key, input_files in job_context.pop("input_files").items():
+                job_context = _smash_key(job_context, key, input_files)
+        except Exception as e:
+            raise utils.ProcessorJobError(
+                "Could not smash dataset: " + str(e),
+                success=False,
+                dataset_id=job_context["dataset"].id,
+                num_input_files=job_context["num_input_files"],
+            )
+        finally:
+            job_context.pop("archive")
+
+        smashing_utils.write_non_data_files(job_context)
+
+        # Finally, add the metadata and everything else to the zip
+        try:
+            archive.write_directory()
+        except OSError:
+            raise utils.ProcessorJobError("Smash Error while generating zip file", success=False)
 
     job_context["dataset"].success = True
     job_context["dataset"].save()
@@ -1,28 +1,31 @@
 # -*- coding: utf-8 -*-
 
 import csv
+import io
+import itertools
 import logging
 import math
 import multiprocessing
 import os
 import shutil
 import time
+import zipfile
+import zlib
 from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Tuple
 
+from django.conf import settings
 from django.utils import timezone
 
 import numpy as np
 import pandas as pd
 import psutil
-import rpy2.robjects as ro
 import simplejson as json
-from rpy2.robjects import pandas2ri, r as rlang
-from rpy2.robjects.packages import importr
+from scipy import stats
 
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.models import ComputedFile, Sample
+from data_refinery_common.models import ComputedFile, Organism, Sample
 from data_refinery_common.utils import get_env_variable
 from data_refinery_workers.processors import utils
 
@@ -38,7 +41,11 @@ BODY_ERROR_HTML = (
     .replace("\n", "")
 )
 BYTES_IN_GB = 1024 * 1024 * 1024
-QN_CHUNK_SIZE = 10000
+# The zlib compression level of the archives we build, from 0 (fastest) to 9 (smallest).
+ARCHIVE_COMPRESSION_LEVEL = int(get_env_variable("ARCHIVE_COMPRESSION_LEVEL", "6"))
+# The number of values quantile normalized at a time.
+QN_BLOCK_SIZE = 4 * 1024 * 1024
+QN_TARGET_CACHE_DIR = os.path.join(utils.LOCAL_ROOT_DIR, "qn_targets")
 logger = get_and_configure_logger(__name__)
 ### DEBUG ###
 logger.setLevel(logging.getLevelName("DEBUG"))
@@ -67,28 +74,35 @@ def prepare_files(job_context: Dict) -> Dict:
 
     # `key` can either be the species name or experiment accession.
     for key, samples in job_context["samples"].items():
+        samples = list(samples)
+        if job_context["dataset"].quant_sf_only:
+            # For quant.sf only jobs, just check that they have a quant.sf file
+            latest_files = Sample.get_most_recent_quant_sf_files(samples)
+        else:
+            latest_files = Sample.get_most_recent_smashable_result_files(samples)
+
         smashable_files = []
         seen_files = set()
+        unsmashable_samples = []
         for sample in samples:
-            if job_context["dataset"].quant_sf_only:
-                # For quant.sf only jobs, just check that they have a quant.sf file
-                smashable_file = sample.get_most_recent_quant_sf_file()
-            else:
-                smashable_file = sample.get_most_recent_smashable_result_file()
-
+            smashable_file = latest_files.get(sample.id)
             if smashable_file is not None and smashable_file not in seen_files:
-                smashable_files = smashable_files + [(smashable_file, sample)]
+                smashable_files.append((smashable_file, sample))
                 seen_files.add(smashable_file)
                 found_files = True
             else:
-                sample_metadata = sample.to_metadata_dict()
-                job_context["filtered_samples"][sample.accession_code] = {
-                    **sample_metadata,
-                    "reason": "This sample did not have a processed file associated with it in our database.",
-                    "experiment_accession_code": get_experiment_accession(
-                        sample.accession_code, job_context["dataset"].data
-                    ),
-                }
+                unsmashable_samples.append(sample)
+
+        for accession_code, sample_metadata in Sample.get_metadata_dicts(
+            unsmashable_samples
+        ).items():
+            job_context["filtered_samples"][accession_code] = {
+                **sample_metadata,
+                "reason": "This sample did not have a processed file associated with it in our database.",
+                "experiment_accession_code": get_experiment_accession(
+                    accession_code, job_context["dataset"].data
+                ),
+            }
 
         job_context["input_files"][key] = smashable_files
 
@@ -115,8 +129,8 @@ def prepare_files(job_context: Dict) -> Dict:
     return job_context
 
 
-def _load_and_sanitize_file(computed_file_path) -> pd.DataFrame:
-    """ Read and sanitize a computed file """
+def _read_computed_file(computed_file_path) -> pd.DataFrame:
+    """ Read a computed file without sanitizing its gene identifiers """
 
     data = pd.read_csv(
         computed_file_path,
@@ -131,17 +145,27 @@ def _load_and_sanitize_file(computed_file_path) -> pd.DataFrame:
     data.columns = data.columns.str.strip()
     data = data.dropna(axis="columns", how="all")
 
+    return data
+
+
+def _sanitize_gene_ids(gene_ids: pd.Index) -> Tuple[pd.Index, np.ndarray]:
+    """ Strip the probe and version suffixes off of a computed file's gene identifiers.
+
+    Also returns a mask of the identifiers that aren't Affymetrix control
+    probes, which are the rows that should be kept.
+    """
+
     # Make sure the index type is correct
-    data.index = data.index.map(str)
+    gene_ids = gene_ids.map(str)
 
     # Ensure that we don't have any dangling Brainarray-generated probe symbols.
     # BA likes to leave '_at', signifying probe identifiers,
     # on their converted, non-probe identifiers. It makes no sense.
     # So, we chop them off and don't worry about it.
-    data.index = data.index.str.replace("_at", "")
+    gene_ids = gene_ids.str.replace("_at", "")
 
     # Remove any lingering Affymetrix control probes ("AFFX-")
-    data = data[~data.index.str.contains("AFFX-")]
+    is_gene = ~gene_ids.str.contains("AFFX-")
 
     # If there are any _versioned_ gene identifiers, remove that
     # version information. We're using the latest brainarray for everything anyway.
@@ -155,7 +179,19 @@ def _load_and_sanitize_file(computed_file_path) -> pd.DataFrame:
     #       fgenesh2_kg.7__3016__AT5G35080.1 (via http://plants.ensembl.org/Arabidopsis_lyrata/ \
     #       Gene/Summary?g=fgenesh2_kg.7__3016__AT5G35080.1;r=7:17949732-17952000;t=fgenesh2_kg. \
     #       7__3016__AT5G35080.1;db=core)
-    data.index = data.index.str.replace(r"(\.[^.]*)$", "")
+    gene_ids = gene_ids.str.replace(r"(\.[^.]*)$", "")
+
+    return gene_ids, is_gene
+
+
+def _load_and_sanitize_file(computed_file_path) -> pd.DataFrame:
+    """ Read and sanitize a computed file """
+
+    data = _read_computed_file(computed_file_path)
+
+    gene_ids, is_gene = _sanitize_gene_ids(data.index)
+    data.index = gene_ids
+    data = data[is_gene]
 
     data = utils.squish_duplicates(data)
 
@@ -241,90 +277,233 @@ def process_frame(work_dir, computed_file, sample_accession_code, aggregate_by)
     return data
 
 
-def load_first_pass_data_if_cached(work_dir: str):
-    path = os.path.join(work_dir, "first_pass.csv")
+MATRIX_CACHE_DIR = "matrix_cache"
+
+
+class SampleMatrixBuilder:
+    """Builds the per-technology gene x sample matrices in a single pass.
+
+    Each sample frame is read exactly once. Its gene identifiers are
+    mapped onto a growing row index and its values are stored
+    column-wise, so we never need to know the full set of genes up
+    front. The >50% presence filter is applied once all of the
+    samples have been added.
+    """
+
+    TECHNOLOGIES = ("MICROARRAY", "RNA-SEQ")
+
+    def __init__(self):
+        self.gene_positions = {}
+        self._gene_counts = np.zeros(1024, dtype=np.int64)
+        self._columns = {technology: [] for technology in self.TECHNOLOGIES}
+
+    @property
+    def num_samples(self) -> int:
+        return sum(len(columns) for columns in self._columns.values())
+
+    def add_frame(self, frame_data: pd.DataFrame, technology: str) -> None:
+        """Adds a single-column frame whose index is made up of gene identifiers."""
+        positions = self.gene_positions
+        # int32 halves the size of the buffered row indices, and there
+        # are far fewer genes than that can count.
+        rows = np.fromiter(
+            (positions.setdefault(gene_id, len(positions)) for gene_id in frame_data.index),
+            dtype=np.int32,
+            count=len(frame_data.index),
+        )
+
+        if len(positions) > len(self._gene_counts):
+            new_size = max(len(positions), 2 * len(self._gene_counts))
+            grown = np.zeros(new_size, dtype=np.int64)
+            grown[: len(self._gene_counts)] = self._gene_counts
+            self._gene_counts = grown
+
+        # Frames have had their duplicate genes squished, so each row
+        # only appears once and a fancy-indexed increment is safe.
+        self._gene_counts[rows] += 1
+
+        if technology in self._columns:
+            values = frame_data.iloc[:, 0].to_numpy(dtype=np.float32)
+            self._columns[technology].append((frame_data.columns[0], rows, values))
+
+    def get_gene_identifiers(self, presence_threshold=0.5) -> List[str]:
+        """Returns the sorted gene identifiers present in more than
+        `presence_threshold` of the samples."""
+        minimum_count = self.num_samples * presence_threshold
+        counts = self._gene_counts
+        return sorted(
+            gene_id for gene_id, row in self.gene_positions.items() if counts[row] > minimum_count
+        )
+
+    def build(self, presence_threshold=0.5) -> Dict[str, pd.DataFrame]:
+        """Returns a dict mapping each technology to its float32 matrix.
+
+        The buffered columns are released as they are copied into the
+        matrices, so peak memory stays close to the size of the output.
+        """
+        gene_ids = self.get_gene_identifiers(presence_threshold)
+
+        # Map each buffered row onto its row in the output, or -1 if
+        # the gene was filtered out.
+        new_rows = np.full(len(self.gene_positions), -1, dtype=np.int32)
+        new_rows[[self.gene_positions[gene_id] for gene_id in gene_ids]] = np.arange(len(gene_ids))
+        self.gene_positions = {}
+
+        matrices = {}
+        for technology in self.TECHNOLOGIES:
+            columns = sorted(self._columns[technology], key=lambda column: column[0])
+            column_names = [column[0] for column in columns]
+            self._columns[technology] = []
+
+            matrix = np.full((len(gene_ids), len(columns)), np.nan, dtype=np.float32)
+            for index in range(len(columns)):
+                _, rows, values = columns[index]
+                # Drop the buffers as soon as they've been copied.
+                columns[index] = None
+
+                target_rows = new_rows[rows]
+                kept = target_rows >= 0
+                matrix[target_rows[kept], index] = values[kept]
+                del rows, values, target_rows, kept
+
+            matrices[technology] = pd.DataFrame(matrix, index=gene_ids, columns=column_names)
+
+        return matrices
+
+
+def _get_matrix_cache_dir(work_dir: str, key: str) -> str:
+    return os.path.join(work_dir, MATRIX_CACHE_DIR, key)
+
+
+def load_cached_matrices(work_dir: str, key: str, computed_file_ids: List[int]):
+    """Loads the matrices built by a previous job for `key`.
+
+    Returns None if there is no cache or if it was built from a
+    different set of computed files.
+    """
+    cache_dir = _get_matrix_cache_dir(work_dir, key)
     try:
-        with open(path, newline="") as csvfile:
-            reader = csv.reader(csvfile)
-            gene_ids = next(reader)
-            microarray_columns = next(reader)
-            rnaseq_columns = next(reader)
-            return {
-                "gene_ids": gene_ids,
-                "microarray_columns": microarray_columns,
-                "rnaseq_columns": rnaseq_columns,
-            }
-    # If the file doesn't exist then the gene ids aren't cached. Any
+        with open(os.path.join(cache_dir, "index.json")) as index_file:
+            index = json.load(index_file)
+
+        if index["computed_file_ids"] != computed_file_ids:
+            return None
+
+        return {
+            "microarray_matrix": pd.DataFrame(
+                np.load(os.path.join(cache_dir, "microarray.npy")),
+                index=index["gene_ids"],
+                columns=index["microarray_columns"],
+            ),
+            "rnaseq_matrix": pd.DataFrame(
+                np.load(os.path.join(cache_dir, "rnaseq.npy")),
+                index=index["gene_ids"],
+                columns=index["rnaseq_columns"],
+            ),
+            "skipped_files": index["skipped_files"],
+        }
+    # If the files don't exist then the matrices aren't cached. Any
     # other exception should be handled and higher in the stack.
     except FileNotFoundError:
         return None
 
 
-def cache_first_pass(
-    job_context: Dict, gene_ids: List[str], microarray_columns: List[str], rnaseq_columns: List[str]
+def cache_matrices(
+    job_context: Dict, key: str, computed_file_ids: List[int], skipped_files: Dict[str, str]
 ):
+    """Caches the built matrices for `key` so a retried job can skip
+    reading the sample files again."""
     try:
-        path = os.path.join(job_context["work_dir"], "first_pass.csv")
-        logger.info(
-            "Caching gene_ids, microarray_columns, and rnaseq_columns to %s",
-            path,
-            job_id=job_context["job"].id,
-        )
-        with open(path, "w", newline="") as csvfile:
-            writer = csv.writer(csvfile)
-            writer.writerow(gene_ids)
-            writer.writerow(microarray_columns)
-            writer.writerow(rnaseq_columns)
+        cache_dir = _get_matrix_cache_dir(job_context["work_dir"], key)
+        logger.info("Caching matrices to %s", cache_dir, job_id=job_context["job"].id)
+        os.makedirs(cache_dir, exist_ok=True)
+
+        microarray_matrix = job_context["microarray_matrix"]
+        rnaseq_matrix = job_context["rnaseq_matrix"]
+        np.save(os.path.join(cache_dir, "microarray.npy"), microarray_matrix.to_numpy())
+        np.save(os.path.join(cache_dir, "rnaseq.npy"), rnaseq_matrix.to_numpy())
+
+        # Write the index last so a partially written cache is never used.
+        with open(os.path.join(cache_dir, "index.json"), "w") as index_file:
+            json.dump(
+                {
+                    "computed_file_ids": computed_file_ids,
+                    "gene_ids": list(microarray_matrix.index),
+                    "microarray_columns": list(microarray_matrix.columns),
+                    "rnaseq_columns": list(rnaseq_matrix.columns),
+                    "skipped_files": skipped_files,
+                },
+                index_file,
+            )
     # Nothing in the above try should raise an exception, but if it
-    # does don't waste the work we did in the first pass.
+    # does don't waste the work we did building the matrices.
     except Exception:
-        logger.exception(
-            "Error writing gene identifiers to CSV file.", job_id=job_context["job"].id
-        )
+        logger.exception("Error caching matrices.", job_id=job_context["job"].id)
+
+
+def remove_cached_matrices(work_dir: str) -> None:
+    """Removes the matrices cached by cache_matrices, which are only
+    needed until the job that built them succeeds."""
+    shutil.rmtree(os.path.join(work_dir, MATRIX_CACHE_DIR), ignore_errors=True)
+
+
+def _filter_unsmashable_sample(job_context: Dict, sample: Sample, filename: str) -> None:
+    job_context["unsmashable_files"].append(filename)
+    sample_metadata = sample.to_metadata_dict()
+    job_context["filtered_samples"][sample.accession_code] = {
+        **sample_metadata,
+        "reason": "The file associated with this sample did not pass the QC checks we apply before aggregating.",
+        "filename": filename,
+        "experiment_accession_code": get_experiment_accession(
+            sample.accession_code, job_context["dataset"].data
+        ),
+    }
 
 
 def process_frames_for_key(
     key: str, input_files: List[Tuple[ComputedFile, Sample]], job_context: Dict
 ) -> Dict:
-    """Download, read, and chunk processed sample files from s3.
+    """Download, read, and build matrices from processed sample files from s3.
 
     `key` is the species or experiment whose samples are contained in `input_files`.
 
+    Each file is only read once: its data is added to a
+    SampleMatrixBuilder and the matrices are built after the last file
+    has been read. Mouse matrices are cached in the work_dir so that a
+    retried job with the same input files can skip this step, until
+    the job succeeds and remove_cached_matrices is called.
+
     Will add to job_context the keys 'microarray_matrix' and
     'rnaseq_matrix' with pandas dataframes containing all of the
-    samples' data. Also adds the key 'unsmashable_files' containing a
+    samples' data. Also adds to the key 'unsmashable_files' the
     list of paths that were determined to be unsmashable.
     """
-
-    start_gene_ids = log_state(
-        "Collecting all gene identifiers for key {}".format(key), job_context["job"].id
+    start_build_matrix = log_state(
+        "Building the full matrices for key {}".format(key), job_context["job"].id
     )
 
-    # Build up a list of gene identifiers because these will be the
-    # rows of our matrices, and we want to preallocate them so we need
-    # to know them all.
-    ## We may have built this list in a previous job, check to see if it's cached:
-    cached_data = load_first_pass_data_if_cached(job_context["work_dir"])
-    first_pass_was_cached = False
+    computed_file_ids = [computed_file.id for computed_file, _ in input_files]
+    cached_data = load_cached_matrices(job_context["work_dir"], key, computed_file_ids)
 
     if cached_data:
         logger.info(
-            (
-                "The data from the first pass was cached, so we're using "
-                "that and skipping the first pass."
-            ),
+            "The matrices were cached, so we're using them and skipping reading the files.",
             job_id=job_context["job"].id,
         )
-        first_pass_was_cached = True
-        all_gene_identifiers = cached_data["gene_ids"]
-        microarray_columns = cached_data["microarray_columns"]
-        rnaseq_columns = cached_data["rnaseq_columns"]
+        job_context["microarray_matrix"] = cached_data["microarray_matrix"]
+        job_context["rnaseq_matrix"] = cached_data["rnaseq_matrix"]
+
+        skipped_files = cached_data["skipped_files"]
+        for _, sample in input_files:
+            if sample.accession_code in skipped_files:
+                _filter_unsmashable_sample(
+                    job_context, sample, skipped_files[sample.accession_code]
+                )
     else:
-        gene_identifier_counts = {}
-        microarray_columns = []
-        rnaseq_columns = []
+        builder = SampleMatrixBuilder()
+        skipped_files = {}
         for index, (computed_file, sample) in enumerate(input_files):
-            log_state("1st processing frame {}".format(index), job_context["job"].id)
+            log_state("processing frame {}".format(index), job_context["job"].id)
             frame_data = process_frame(
                 job_context["work_dir"],
                 computed_file,
@@ -340,32 +519,11 @@ def process_frames_for_key(
                     dataset_id=job_context["dataset"].id,
                     job_id=job_context["job"].id,
                 )
-
-                sample_metadata = sample.to_metadata_dict()
-                job_context["filtered_samples"][sample.accession_code] = {
-                    **sample_metadata,
-                    "reason": "The file associated with this sample did not pass the QC checks we apply before aggregating.",
-                    "filename": computed_file.filename,
-                    "experiment_accession_code": get_experiment_accession(
-                        sample.accession_code, job_context["dataset"].data
-                    ),
-                }
+                skipped_files[sample.accession_code] = computed_file.filename
+                _filter_unsmashable_sample(job_context, sample, computed_file.filename)
                 continue
 
-            # Count how many frames are in each tech so we can preallocate
-            # the matrices in both directions.
-            for gene_id in frame_data.index:
-                if gene_id in gene_identifier_counts:
-                    gene_identifier_counts[gene_id] += 1
-                else:
-                    gene_identifier_counts[gene_id] = 1
-
-            # Each dataframe should only have 1 column, but it's
-            # returned as a list so use extend.
-            if sample.technology == "MICROARRAY":
-                microarray_columns.extend(frame_data.columns)
-            elif sample.technology == "RNA-SEQ":
-                rnaseq_columns.extend(frame_data.columns)
+            builder.add_frame(frame_data, sample.technology)
 
         # We only want to use gene identifiers which are present
         # in >50% of the samples. We're doing this because a large
@@ -373,80 +531,30 @@ def process_frames_for_key(
         # number of experiments have leaked through. We wouldn't
         # necessarily want to do this if we'd mapped all the data
         # to ENSEMBL identifiers successfully.
-        total_samples = len(microarray_columns) + len(rnaseq_columns)
-        all_gene_identifiers = [
-            gene_id
-            for gene_id in gene_identifier_counts
-            if gene_identifier_counts[gene_id] > (total_samples * 0.5)
-        ]
-        all_gene_identifiers.sort()
-
-        del gene_identifier_counts
-
-        log_template = (
-            "Collected {0} gene identifiers for {1} across"
-            " {2} micrarry samples and {3} RNA-Seq samples."
-        )
-        log_state(
-            log_template.format(
-                len(all_gene_identifiers), key, len(microarray_columns), len(rnaseq_columns)
-            ),
-            job_context["job"].id,
-            start_gene_ids,
-        )
-
-    # Temporarily only cache mouse compendia because it may not succeed.
-    if not first_pass_was_cached and key == "MUS_MUSCULUS":
-        cache_first_pass(job_context, all_gene_identifiers, microarray_columns, rnaseq_columns)
+        matrices = builder.build(presence_threshold=0.5)
+        del builder
 
-    start_build_matrix = log_state("Beginning to build the full matrices.", job_context["job"].id)
+        job_context["microarray_matrix"] = matrices["MICROARRAY"]
+        job_context["rnaseq_matrix"] = matrices["RNA-SEQ"]
 
-    # Sort the columns so that the matrices are in predictable orders.
-    microarray_columns.sort()
-    rnaseq_columns.sort()
+        # Temporarily only cache mouse compendia because it may not succeed.
+        if key == "MUS_MUSCULUS":
+            cache_matrices(job_context, key, computed_file_ids, skipped_files)
 
-    # Preallocate the matrices to be the exact size we will need. This
-    # should prevent any operations from happening while we build it
-    # up, so the only RAM used will be needed.
-    job_context["microarray_matrix"] = pd.DataFrame(
-        data=None, index=all_gene_identifiers, columns=microarray_columns, dtype=np.float32
+    log_template = (
+        "Collected {0} gene identifiers for {1} across"
+        " {2} micrarry samples and {3} RNA-Seq samples."
     )
-    job_context["rnaseq_matrix"] = pd.DataFrame(
-        data=None, index=all_gene_identifiers, columns=rnaseq_columns, dtype=np.float32
+    logger.info(
+        log_template.format(
+            len(job_context["microarray_matrix"].index),
+            key,
+            len(job_context["microarray_matrix"].columns),
+            len(job_context["rnaseq_matrix"].columns),
+        ),
+        job_id=job_context["job"].id,
     )
 
-    for index, (computed_file, sample) in enumerate(input_files):
-        log_state("2nd processing frame {}".format(index), job_context["job"].id)
-        frame_data = process_frame(
-            job_context["work_dir"],
-            computed_file,
-            sample.accession_code,
-            job_context["dataset"].aggregate_by,
-        )
-
-        if frame_data is None:
-            job_context["unsmashable_files"].append(computed_file.filename)
-            sample_metadata = sample.to_metadata_dict()
-            job_context["filtered_samples"][sample.accession_code] = {
-                **sample_metadata,
-                "reason": "The file associated with this sample did not contain a vector that fit the expected dimensions of the matrix.",
-                "filename": computed_file.filename,
-                "experiment_accession_code": get_experiment_accession(
-                    sample.accession_code, job_context["dataset"].data
-                ),
-            }
-            continue
-
-        frame_data = frame_data.reindex(all_gene_identifiers)
-
-        # The dataframe for each sample will only have one column
-        # whose header will be the accession code.
-        column = frame_data.columns[0]
-        if sample.technology == "MICROARRAY":
-            job_context["microarray_matrix"][column] = frame_data.values
-        elif sample.technology == "RNA-SEQ":
-            job_context["rnaseq_matrix"][column] = frame_data.values
-
     job_context["num_samples"] = 0
     if job_context["microarray_matrix"] is not None:
         job_context["num_samples"] += len(job_context["microarray_matrix"].columns)
@@ -460,101 +568,111 @@ def process_frames_for_key(
     return job_context
 
 
-# Modified from: http://yaoyao.codes/pandas/2018/01/23/pandas-split-a-dataframe-into-chunks
-def _index_marks(num_columns, chunk_size):
-    return range(chunk_size, math.ceil(num_columns / chunk_size) * chunk_size, chunk_size)
+def _get_average_ranks(sorted_block: np.ndarray) -> np.ndarray:
+    """Returns the 1-indexed rank of every value in a column-sorted block.
 
+    Tied values are all given the average of their ranks, the same way
+    R's `rank` and preprocessCore's `get_ranks` do.
+    """
+    num_rows = sorted_block.shape[0]
+    positions = np.arange(num_rows).reshape(-1, 1)
 
-def _split_dataframe_columns(dataframe, chunk_size):
-    indices = _index_marks(dataframe.shape[1], chunk_size)
-    return np.split(dataframe, indices, axis=1)
+    starts_tie = np.ones(sorted_block.shape, dtype=bool)
+    starts_tie[1:] = sorted_block[1:] != sorted_block[:-1]
+    ends_tie = np.ones(sorted_block.shape, dtype=bool)
+    ends_tie[:-1] = starts_tie[1:]
 
+    # Carry the first position of each tie down and the last position up.
+    first_positions = np.where(starts_tie, positions, 0)
+    np.maximum.accumulate(first_positions, axis=0, out=first_positions)
+    last_positions = np.where(ends_tie, positions, num_rows - 1)[::-1]
+    last_positions = np.minimum.accumulate(last_positions, axis=0)[::-1]
 
-def _quantile_normalize_matrix(target_vector, original_matrix):
-    preprocessCore = importr("preprocessCore")
-    as_numeric = rlang("as.numeric")
-    data_matrix = rlang("data.matrix")
+    return (first_positions + last_positions) / 2 + 1
 
-    # Convert the smashed frames to an R numeric Matrix
-    target_vector = as_numeric(target_vector)
 
-    # Do so in chunks if the matrix is too large.
-    if original_matrix.shape[1] <= QN_CHUNK_SIZE:
-        merged_matrix = data_matrix(original_matrix)
-        normalized_matrix = preprocessCore.normalize_quantiles_use_target(
-            x=merged_matrix, target=target_vector, copy=True
-        )
-        # And finally convert back to Pandas
-        ar = np.array(normalized_matrix)
-        new_merged = pd.DataFrame(ar, columns=original_matrix.columns, index=original_matrix.index)
-    else:
-        matrix_chunks = _split_dataframe_columns(original_matrix, QN_CHUNK_SIZE)
-        for i, chunk in enumerate(matrix_chunks):
-            R_chunk = data_matrix(chunk)
-            normalized_chunk = preprocessCore.normalize_quantiles_use_target(
-                x=R_chunk, target=target_vector, copy=True
-            )
-            ar = np.array(normalized_chunk)
-            start_column = i * QN_CHUNK_SIZE
-            end_column = (i + 1) * QN_CHUNK_SIZE
-            original_matrix.iloc[:, start_column:end_column] = ar
+def _quantile_normalize_block(block: np.ndarray, sorted_target: np.ndarray) -> None:
+    """Quantile normalizes the columns of `block` to `sorted_target` in place.
 
-        new_merged = original_matrix
+    This follows preprocessCore's `normalize.quantiles.use.target`:
+    each value's average rank is mapped onto the same quantile of the
+    target, linearly interpolating between target values when the
+    quantile falls between two of them. Missing values stay missing.
+    """
+    order = np.argsort(block, axis=0, kind="mergesort")
+    sorted_block = np.take_along_axis(block, order, axis=0)
+    is_missing = np.isnan(sorted_block)
 
-    return new_merged
+    ranks = _get_average_ranks(sorted_block)
+    del sorted_block
 
+    # Position of each value's quantile in the (0-indexed) target.
+    num_present = block.shape[0] - is_missing.sum(axis=0)
+    scale = (len(sorted_target) - 1) / np.maximum(num_present - 1, 1)
+    target_positions = (ranks - 1) * scale
 
-def _test_qn(merged_matrix):
-    """ Selects a list of 100 random pairs of columns and performs the KS Test on them.
-    Returns a list of tuples with the results of the KN test (statistic, pvalue) """
-    # Verify this QN, related:
-    # https://github.com/AlexsLemonade/refinebio/issues/599#issuecomment-422132009
-    data_matrix = rlang("data.matrix")
-    as_numeric = rlang("as.numeric")
-    set_seed = rlang("set.seed")
-    combn = rlang("combn")
-    ncol = rlang("ncol")
-    ks_test = rlang("ks.test")
-    which = rlang("which")
+    normalized = np.interp(
+        target_positions.ravel(), np.arange(len(sorted_target)), sorted_target
+    ).reshape(block.shape)
+    normalized[is_missing] = np.nan
+
+    np.put_along_axis(block, order, normalized, axis=0)
+
+
+def _quantile_normalize_matrix(
+    target_vector, original_matrix: pd.DataFrame, in_place=False
+) -> pd.DataFrame:
+    """Quantile normalizes every column of `original_matrix` to `target_vector`.
 
-    merged_R_matrix = data_matrix(merged_matrix)
+    The matrix is normalized as float32 in blocks of columns so that
+    the temporary arrays stay bounded no matter how many samples there
+    are. If `in_place` is set and the matrix is already float32, its
+    values are overwritten instead of being copied.
+    """
+    target = np.asarray(target_vector, dtype=np.float64)
+    sorted_target = np.sort(target[~np.isnan(target)])
+
+    matrix = original_matrix.to_numpy(dtype=np.float32, copy=not in_place)
+    if not matrix.flags.writeable:
+        matrix = matrix.copy()
+
+    num_rows, num_columns = matrix.shape
+    columns_per_block = max(1, QN_BLOCK_SIZE // max(num_rows, 1))
+    for start_column in range(0, num_columns, columns_per_block):
+        end_column = start_column + columns_per_block
+        _quantile_normalize_block(matrix[:, start_column:end_column], sorted_target)
 
-    set_seed(123)
+    return pd.DataFrame(matrix, index=original_matrix.index, columns=original_matrix.columns)
 
-    n = ncol(merged_R_matrix)[0]
-    m = 2
+
+def _test_qn(merged_matrix, num_tests=100):
+    """ Selects a list of 100 random pairs of columns and performs the KS Test on them.
+    Returns a list of tuples with the results of the KS test (statistic, pvalue) """
+    # Verify this QN, related:
+    # https://github.com/AlexsLemonade/refinebio/issues/599#issuecomment-422132009
+    matrix = merged_matrix.to_numpy(copy=False)
+    num_columns = matrix.shape[1]
 
     # Not enough columns to perform KS test - either bad smash or single sample smash.
-    if n < m:
+    if num_columns < 2:
         return None
 
-    # This wont work with larger matricies
-    # https://github.com/AlexsLemonade/refinebio/issues/1860
-    ncolumns = ncol(merged_R_matrix)
-
-    if ncolumns[0] <= 200:
-        # Convert to NP, Shuffle, Return to R
-        combos = combn(ncolumns, 2)
-        ar = np.array(combos)
-        np.random.shuffle(np.transpose(ar))
+    random = np.random.RandomState(123)
+    if num_columns <= 2 * num_tests:
+        pairs = list(itertools.combinations(range(num_columns), 2))
+        random.shuffle(pairs)
     else:
-        indexes = [*range(ncolumns[0])]
-        np.random.shuffle(indexes)
-        ar = np.array([*zip(indexes[0:100], indexes[100:200])])
-
-    nr, nc = ar.shape
-    combos = ro.r.matrix(ar, nrow=nr, ncol=nc)
+        # Never enumerate every pair of a large matrix, just pick
+        # disjoint pairs of random columns.
+        indexes = random.permutation(num_columns)
+        pairs = zip(indexes[0:num_tests], indexes[num_tests : 2 * num_tests])
 
     result = []
-    # adapted from
-    # https://stackoverflow.com/questions/9661469/r-t-test-over-all-columns
-    # apply KS test to randomly selected pairs of columns (samples)
-    for i in range(1, min(ncol(combos)[0], 100)):
-        value1 = combos.rx(1, i)[0]
-        value2 = combos.rx(2, i)[0]
-
-        test_a = merged_R_matrix.rx(True, value1)
-        test_b = merged_R_matrix.rx(True, value2)
+    for column_a, column_b in itertools.islice(pairs, num_tests):
+        # Each test only needs the two columns, so the extra memory
+        # used stays the same no matter how large the matrix is.
+        test_a = matrix[:, column_a]
+        test_b = matrix[:, column_b]
 
         # RNA-seq has a lot of zeroes in it, which
         # breaks the ks_test. Therefore we want to
@@ -563,35 +681,75 @@ def _test_qn(merged_matrix):
         # still zeroes in there, then that's
         # probably too many zeroes so it's okay to
         # fail.
-        median_a = np.median(test_a)
-        median_b = np.median(test_b)
-
-        # `which` returns indices which are
-        # 1-indexed. Python accesses lists with
-        # zero-indexes, even if that list is
-        # actually an R vector. Therefore subtract
-        # 1 to account for the difference.
-        test_a = [test_a[i - 1] for i in which(test_a > median_a)]
-        test_b = [test_b[i - 1] for i in which(test_b > median_b)]
-
-        # The python list comprehension gives us a
-        # python list, but ks_test wants an R
-        # vector so let's go back.
-        test_a = as_numeric(test_a)
-        test_b = as_numeric(test_b)
-
-        ks_res = ks_test(test_a, test_b)
-        statistic = ks_res.rx("statistic")[0][0]
-        pvalue = ks_res.rx("p.value")[0][0]
+        test_a = test_a[test_a > np.nanmedian(test_a)]
+        test_b = test_b[test_b > np.nanmedian(test_b)]
 
+        if len(test_a) == 0 or len(test_b) == 0:
+            continue
+
+        statistic, pvalue = stats.ks_2samp(test_a, test_b)
         result.append((statistic, pvalue))
 
     return result
 
 
-def quantile_normalize(job_context: Dict, ks_check=True, ks_stat=0.001) -> Dict:
+def _get_qn_target_cache_path(organism: Organism, computed_file: ComputedFile) -> str:
+    return os.path.join(
+        QN_TARGET_CACHE_DIR,
+        organism.name,
+        "{}_{}.npy".format(computed_file.id, computed_file.sha1),
+    )
+
+
+def get_qn_target(organism: Organism) -> np.ndarray:
+    """Returns the values of the organism's QN target.
+
+    The first time a target is loaded it's downloaded from S3, parsed
+    and cached as a binary numpy file keyed by its ComputedFile's id and
+    sha1. After that it is memory-mapped from the cache, read-only. When
+    a new target is cached for an organism its old ones are deleted.
+    """
+    computed_file = organism.qn_target.computedfile_set.latest()
+    cache_path = _get_qn_target_cache_path(organism, computed_file)
+
+    try:
+        return np.load(cache_path, mmap_mode="r")
+    except FileNotFoundError:
+        pass
+    except (OSError, ValueError):
+        logger.warning("Failed to load cached QN target.", cache_path=cache_path)
+
+    qn_target_path = computed_file.sync_from_s3()
+    qn_target_frame = pd.read_csv(
+        qn_target_path, sep="\t", header=None, index_col=None, error_bad_lines=False
+    )
+    qn_target = qn_target_frame[0].to_numpy(dtype=np.float64)
+
+    try:
+        cache_dir = os.path.dirname(cache_path)
+        os.makedirs(cache_dir, exist_ok=True)
+        for cache_filename in os.listdir(cache_dir):
+            os.remove(os.path.join(cache_dir, cache_filename))
+
+        # Write to a temporary file first so that concurrent jobs
+        # never read a partially written cache.
+        temp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(temp_path, "wb") as cache_file:
+            np.save(cache_file, qn_target)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # don't fail if we can't save the cache
+        logger.warning("Failed to cache QN target.", cache_path=cache_path)
+
+    return qn_target
+
+
+def quantile_normalize(job_context: Dict, ks_check=True, ks_stat=0.001, in_place=False) -> Dict:
     """
     Apply quantile normalization.
+
+    If `in_place` is set the values of the `merged_no_qn` matrix may be
+    overwritten, so only set it if nothing else references that matrix.
     """
     # Prepare our QN target file
     organism = job_context["organism"]
@@ -604,31 +762,18 @@ def quantile_normalize(job_context: Dict, ks_check=True, ks_stat=0.001) -> Dict:
             dataset_id=job_context["dataset"].id,
         )
 
-    qn_target_path = organism.qn_target.computedfile_set.latest().sync_from_s3()
-    qn_target_frame = pd.read_csv(
-        qn_target_path, sep="\t", header=None, index_col=None, error_bad_lines=False
-    )
-
-    # Prepare our RPy2 bridge
-    pandas2ri.activate()
+    qn_target = get_qn_target(organism)
 
     # Remove un-quantiled normalized matrix from job_context
     # because we no longer need it.
     merged_no_qn = job_context.pop("merged_no_qn")
 
     # Perform the Actual QN
-    new_merged = _quantile_normalize_matrix(qn_target_frame[0], merged_no_qn)
+    new_merged = _quantile_normalize_matrix(qn_target, merged_no_qn, in_place=in_place)
 
     # And add the quantile normalized matrix to job_context.
     job_context["merged_qn"] = new_merged
 
-    # For now, don't test the QN for mouse/human. This never fails on
-    # smasher jobs and is OOM-killing our very large compendia
-    # jobs. Let's run this manually after we have a compendia job
-    # actually finish.
-    if organism.name in ["MUS_MUSCULUS", "HOMO_SAPIENS"]:
-        return job_context
-
     ks_res = _test_qn(new_merged)
     if ks_res:
         for (statistic, pvalue) in ks_res:
@@ -654,6 +799,156 @@ def quantile_normalize(job_context: Dict, ks_check=True, ks_stat=0.001) -> Dict:
     return job_context
 
 
+class ArchiveWriter:
+    """Builds a zip archive of the files under `root_dir` as they are
+    produced, instead of archiving the whole directory at the end.
+
+    Large outputs can be streamed straight into the archive with `open`, so
+    they never touch the disk, and finished files can be added with
+    `write`. Entries are named by their path relative to `root_dir`, like
+    shutil.make_archive names them. ZIP64 is always enabled, so neither
+    the archive nor its entries are limited to 2GB.
+    """
+
+    def __init__(
+        self,
+        archive_path: str,
+        root_dir: str,
+        mode: str = "w",
+        compression_level: int = ARCHIVE_COMPRESSION_LEVEL,
+    ):
+        self.archive_path = archive_path
+        self.root_dir = root_dir
+        self.compression_level = compression_level
+        self.zip_file = zipfile.ZipFile(
+            archive_path, mode, compression=zipfile.ZIP_DEFLATED, allowZip64=True
+        )
+        self.arcnames = set(self.zip_file.namelist())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self) -> None:
+        self.zip_file.close()
+
+    def _get_arcname(self, path: str) -> str:
+        return os.path.relpath(path, self.root_dir)
+
+    def _open_entry(self, zinfo_or_arcname, force_zip64: bool = False):
+        entry = self.zip_file.open(zinfo_or_arcname, "w", force_zip64=force_zip64)
+        # zipfile can't set the compression level on Python 3.6, which our
+        # images run, so swap in a compressor with our level, made the same
+        # way zipfile makes its own, before anything is written.
+        entry._compressor = zlib.compressobj(self.compression_level, zlib.DEFLATED, -15)
+        return entry
+
+    def open(self, path: str):
+        """Returns a binary file object that writes `path` into the archive."""
+        arcname = self._get_arcname(path)
+        self.arcnames.add(arcname)
+        # The size isn't known ahead of time, so make room for a big entry.
+        return self._open_entry(arcname, force_zip64=True)
+
+    def write(self, path: str, delete: bool = False) -> None:
+        """Adds the file at `path` to the archive, deleting it afterwards if
+        `delete` is set so only one copy of it is kept on disk."""
+        arcname = self._get_arcname(path)
+        # This is what ZipFile.write does, but with our compressor.
+        zinfo = zipfile.ZipInfo.from_file(path, arcname)
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+        with open(path, "rb") as input_file, self._open_entry(zinfo) as entry:
+            shutil.copyfileobj(input_file, entry, 1024 * 1024)
+        self.arcnames.add(arcname)
+
+        if delete:
+            os.remove(path)
+
+    def write_directory(self, delete: bool = False) -> None:
+        """Adds every file under `root_dir` that isn't in the archive yet."""
+        for dirpath, dirnames, filenames in os.walk(self.root_dir):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                path = os.path.join(dirpath, filename)
+                if self._get_arcname(path) not in self.arcnames and path != self.archive_path:
+                    self.write(path, delete)
+
+
+def _open_output(path: str, archive: ArchiveWriter = None):
+    if archive is None:
+        return open(path, "wb")
+
+    return archive.open(path)
+
+
+def _get_matrix_index_paths(path_prefix: str) -> Tuple[str, str]:
+    return path_prefix + "_genes.tsv", path_prefix + "_samples.tsv"
+
+
+def write_matrix(
+    matrix: pd.DataFrame, path_prefix: str, file_format: str = "TSV", archive: ArchiveWriter = None,
+) -> List[str]:
+    """Writes a gene by sample matrix in one of Dataset.FILE_FORMAT_CHOICES.
+
+    TSV writes `<path_prefix>.tsv`. NPY writes the values as a float32
+    `<path_prefix>.npy` that can be memory-mapped by `read_matrix`, and the
+    genes and samples to `<path_prefix>_genes.tsv` and
+    `<path_prefix>_samples.tsv`. If `archive` is given, the files are
+    streamed into it instead of being written to disk. Returns the paths
+    of the files written.
+    """
+    if file_format == "TSV":
+        outfiles = [path_prefix + ".tsv"]
+    elif file_format == "NPY":
+        outfiles = [path_prefix + ".npy", *_get_matrix_index_paths(path_prefix)]
+    else:
+        raise ValueError("Unknown matrix file format: {}".format(file_format))
+
+    def write_tsv(frame, path, **kwargs):
+        with io.TextIOWrapper(
+            _open_output(path, archive), encoding="utf-8", newline=""
+        ) as tsv_file:
+            frame.to_csv(tsv_file, sep="\t", **kwargs)
+
+    if file_format == "TSV":
+        write_tsv(matrix, outfiles[0])
+        return outfiles
+
+    with _open_output(outfiles[0], archive) as npy_file:
+        np.save(npy_file, matrix.to_numpy(dtype=np.float32))
+
+    write_tsv(pd.Series(matrix.index, name=matrix.index.name or "Gene"), outfiles[1], index=False)
+    write_tsv(pd.Series(matrix.columns, name="Sample"), outfiles[2], index=False)
+
+    return outfiles
+
+
+def read_matrix(path_prefix: str, file_format: str = "TSV", mmap_mode: str = None) -> pd.DataFrame:
+    """Reads a matrix written by `write_matrix`.
+
+    For NPY matrices `mmap_mode` is passed to `numpy.load`, so the values
+    can be memory-mapped instead of read into memory.
+    """
+    if file_format == "TSV":
+        return pd.read_csv(path_prefix + ".tsv", sep="\t", index_col=0)
+
+    if file_format != "NPY":
+        raise ValueError("Unknown matrix file format: {}".format(file_format))
+
+    genes_file, samples_file = _get_matrix_index_paths(path_prefix)
+    genes = pd.read_csv(genes_file, sep="\t", dtype=str, keep_default_na=False)
+    samples = pd.read_csv(samples_file, sep="\t", dtype=str, keep_default_na=False)
+
+    return pd.DataFrame(
+        np.load(path_prefix + ".npy", mmap_mode=mmap_mode),
+        index=pd.Index(genes.iloc[:, 0], name=genes.columns[0]),
+        columns=samples.iloc[:, 0].values,
+        copy=False,
+    )
+
+
 def compile_metadata(job_context: Dict) -> Dict:
     """Compiles metadata about the job.
 
@@ -679,19 +974,8 @@ def compile_metadata(job_context: Dict) -> Dict:
 
     filtered_samples = job_context["filtered_samples"]
 
-    samples = {}
-    for sample in job_context["dataset"].get_samples():
-        if sample.accession_code in filtered_samples:
-            # skip the samples that were filtered
-            continue
-        computed_file = None
-        if quant_sf_only:
-            computed_file = sample.get_most_recent_quant_sf_file()
-        else:
-            computed_file = sample.get_most_recent_smashable_result_file()
-        samples[sample.accession_code] = sample.to_metadata_dict(computed_file)
-
-    metadata["samples"] = samples
+    # skip the samples that were filtered
+    metadata["samples"] = job_context["dataset"].get_samples_metadata(exclude=filtered_samples)
     metadata["num_samples"] = len(metadata["samples"])
 
     experiments = {}
@@ -1065,10 +1349,15 @@ def download_quant_file(download_tuple: Tuple[Sample, ComputedFile, str]) -> Tup
     return (sample, None)
 
 
-def sync_quant_files(output_path, samples: List[Sample], filtered_samples: Dict):
+def sync_quant_files(
+    output_path, samples: List[Sample], filtered_samples: Dict, archive: ArchiveWriter = None
+):
     """ Takes a list of ComputedFiles and copies the ones that are quant files
     to the provided directory.  Returns the total number of samples that were
-    included, and adds those that were not included to `filtered_samples` """
+    included, and adds those that were not included to `filtered_samples`
+
+    If `archive` is given, each quant file is added to it as soon as it's
+    downloaded. """
     num_samples = 0
 
     page_size = 100
@@ -1080,9 +1369,11 @@ def sync_quant_files(output_path, samples: List[Sample], filtered_samples: Dict)
         for sample_page in (
             samples[start : start + page_size] for start in range(0, len(samples), page_size)
         ):
+            sample_page = Sample.prefetch_metadata(sample_page)
+            latest_computed_files = Sample.get_most_recent_quant_sf_files(sample_page)
             sample_and_computed_files = []
             for sample in sample_page:
-                latest_computed_file = sample.get_most_recent_quant_sf_file()
+                latest_computed_file = latest_computed_files.get(sample.id)
                 if not latest_computed_file:
                     sample_metadata = sample.to_metadata_dict()
                     filtered_samples[sample.accession_code] = {
@@ -1094,8 +1385,9 @@ def sync_quant_files(output_path, samples: List[Sample], filtered_samples: Dict)
                 sample_and_computed_files.append((sample, latest_computed_file, output_file_path))
 
             # download this set of files, this will take a few seconds that should also help the db recover
-            for sample, error_reason in executor.map(
-                download_quant_file, sample_and_computed_files
+            for (sample, error_reason), (_, _, output_file_path) in zip(
+                executor.map(download_quant_file, sample_and_computed_files),
+                sample_and_computed_files,
             ):
                 if error_reason is not None:
                     filtered_samples[sample.accession_code] = {
@@ -1104,6 +1396,10 @@ def sync_quant_files(output_path, samples: List[Sample], filtered_samples: Dict)
                     }
                     continue
 
+                if archive is not None:
+                    # Keep the local copy when testing so it can be checked.
+                    archive.write(output_file_path, delete=settings.RUNNING_IN_CLOUD)
+
                 num_samples += 1
 
     return num_samples
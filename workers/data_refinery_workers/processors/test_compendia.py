@@ -1,6 +1,14 @@
+import json
 import os
+import tempfile
+from io import StringIO
 
-from django.test import TransactionTestCase, tag
+from django.core.management import call_command
+from django.test import SimpleTestCase, TransactionTestCase, tag
+
+import numpy as np
+import pandas as pd
+from fancyimpute import IterativeSVD
 
 from data_refinery_common.enums import ProcessorPipeline
 from data_refinery_common.models import (
@@ -17,7 +25,7 @@ from data_refinery_common.models import (
     SampleComputedFileAssociation,
     SampleResultAssociation,
 )
-from data_refinery_workers.processors import create_compendia
+from data_refinery_workers.processors import create_compendia, smashing_utils
 
 
 class CompendiaTestCase(TransactionTestCase):
@@ -338,3 +346,275 @@ class CompendiaTestCase(TransactionTestCase):
 
         # It's maybe not worth asserting this until we're sure the behavior is correct
         # self.assertEqual(final_context['merged_qn'].shape, (9045, 830))
+
+
+class SampleMatrixBuilderTestCase(SimpleTestCase):
+    @tag("compendia")
+    def test_build_matrices(self):
+        builder = smashing_utils.SampleMatrixBuilder()
+        builder.add_frame(
+            pd.DataFrame({"GSM1": [1.0, 2.0, 3.0]}, index=["GENE_C", "GENE_A", "GENE_B"]),
+            "MICROARRAY",
+        )
+        builder.add_frame(pd.DataFrame({"SRR2": [4.0, 5.0]}, index=["GENE_A", "GENE_D"]), "RNA-SEQ")
+        builder.add_frame(
+            pd.DataFrame({"GSM0": [6.0, 7.0]}, index=["GENE_B", "GENE_A"]), "MICROARRAY"
+        )
+
+        matrices = builder.build()
+
+        # GENE_D is only in 1 out of 3 samples so it gets filtered out.
+        self.assertEqual(list(matrices["MICROARRAY"].index), ["GENE_A", "GENE_B"])
+        self.assertEqual(list(matrices["MICROARRAY"].columns), ["GSM0", "GSM1"])
+        self.assertEqual(list(matrices["RNA-SEQ"].columns), ["SRR2"])
+        self.assertEqual(matrices["MICROARRAY"].values.dtype, np.float32)
+
+        self.assertEqual(matrices["MICROARRAY"].loc["GENE_A", "GSM0"], 7.0)
+        self.assertEqual(matrices["MICROARRAY"].loc["GENE_B", "GSM1"], 3.0)
+        self.assertEqual(matrices["RNA-SEQ"].loc["GENE_A", "SRR2"], 4.0)
+        self.assertTrue(np.isnan(matrices["RNA-SEQ"].loc["GENE_B", "SRR2"]))
+
+    @tag("compendia")
+    def test_cache_matrices(self):
+        builder = smashing_utils.SampleMatrixBuilder()
+        builder.add_frame(
+            pd.DataFrame({"GSM1": [1.0, 2.0]}, index=["GENE_A", "GENE_B"]), "MICROARRAY"
+        )
+        builder.add_frame(pd.DataFrame({"SRR2": [3.0, 4.0]}, index=["GENE_A", "GENE_B"]), "RNA-SEQ")
+        matrices = builder.build()
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            job_context = {
+                "work_dir": work_dir,
+                "job": ProcessorJob(),
+                "microarray_matrix": matrices["MICROARRAY"],
+                "rnaseq_matrix": matrices["RNA-SEQ"],
+            }
+            smashing_utils.cache_matrices(job_context, "MUS_MUSCULUS", [1, 2], {"GSM3": "bad.tsv"})
+
+            cached_data = smashing_utils.load_cached_matrices(work_dir, "MUS_MUSCULUS", [1, 2])
+            pd.testing.assert_frame_equal(cached_data["microarray_matrix"], matrices["MICROARRAY"])
+            pd.testing.assert_frame_equal(cached_data["rnaseq_matrix"], matrices["RNA-SEQ"])
+            self.assertEqual(cached_data["skipped_files"], {"GSM3": "bad.tsv"})
+
+            # A different set of files doesn't use the cache.
+            self.assertIsNone(smashing_utils.load_cached_matrices(work_dir, "MUS_MUSCULUS", [1]))
+
+            # Once the job succeeds the cache is removed.
+            smashing_utils.remove_cached_matrices(work_dir)
+            self.assertEqual(os.listdir(work_dir), [])
+
+
+def prepare_imputation_matrix_with_loops(microarray_matrix, rnaseq_matrix):
+    """The way _perform_imputation used to prepare its matrix, one gene
+    and one sample at a time."""
+    rnaseq_matrix = rnaseq_matrix.dropna(axis="columns", how="all")
+    rnaseq_row_sums = np.sum(rnaseq_matrix, axis=1)
+    rnaseq_tenth_percentile = np.percentile(rnaseq_row_sums, 10)
+    rows_to_filter = []
+    for (x, sum_val) in rnaseq_row_sums.items():
+        if sum_val < rnaseq_tenth_percentile:
+            rows_to_filter.append(x)
+
+    log2_rnaseq_matrix = np.log2(rnaseq_matrix.drop(rows_to_filter) + 1)
+    cached_zeroes = {}
+    for column in log2_rnaseq_matrix.columns:
+        cached_zeroes[column] = log2_rnaseq_matrix.index[np.where(log2_rnaseq_matrix[column] == 0)]
+    log2_rnaseq_matrix[log2_rnaseq_matrix == 0] = np.nan
+
+    combined_matrix = microarray_matrix.merge(
+        log2_rnaseq_matrix, how="outer", left_index=True, right_index=True
+    )
+    row_filtered_matrix = combined_matrix.dropna(
+        axis="index", thresh=combined_matrix.shape[1] * 0.7
+    )
+    row_col_filtered_matrix = row_filtered_matrix.dropna(
+        axis="columns", thresh=row_filtered_matrix.shape[0] * 0.5
+    )
+    dropped_samples = row_filtered_matrix.columns.difference(row_col_filtered_matrix.columns)
+
+    for column, zeroes in cached_zeroes.items():
+        if column not in row_col_filtered_matrix:
+            continue
+        new_zeroes = list(set(row_col_filtered_matrix.index.tolist()) & set(zeroes.tolist()))
+        row_col_filtered_matrix.loc[new_zeroes, column] = 0.0
+
+    return row_col_filtered_matrix.replace([np.inf, -np.inf], np.nan), dropped_samples
+
+
+class PrepareImputationMatrixTestCase(SimpleTestCase):
+    def make_matrices(self, random, num_genes, num_microarray, num_rnaseq):
+        genes = ["ENSG{:011d}".format(i) for i in range(num_genes)]
+
+        microarray_values = random.normal(8, 2, size=(num_genes, num_microarray))
+        microarray_values[random.rand(num_genes, num_microarray) < 0.1] = np.nan
+        rnaseq_values = random.lognormal(0, 2, size=(num_genes, num_rnaseq))
+        rnaseq_values[random.rand(num_genes, num_rnaseq) < 0.1] = 0
+        rnaseq_values[random.rand(num_genes, num_rnaseq) < 0.05] = np.nan
+        # A sample that's entirely missing and one that's almost entirely missing.
+        rnaseq_values[:, 0] = np.nan
+        rnaseq_values[3:, 1] = np.nan
+
+        return (
+            pd.DataFrame(
+                microarray_values.astype(np.float32),
+                index=genes,
+                columns=["GSM{}".format(i) for i in range(num_microarray)],
+            ),
+            pd.DataFrame(
+                rnaseq_values.astype(np.float32),
+                index=genes,
+                columns=["SRR{}".format(i) for i in range(num_rnaseq)],
+            ),
+        )
+
+    @tag("compendia")
+    def test_matches_loops(self):
+        random = np.random.RandomState(123)
+        for num_genes, num_microarray, num_rnaseq in [(50, 3, 4), (500, 20, 30), (2000, 5, 60)]:
+            microarray_matrix, rnaseq_matrix = self.make_matrices(
+                random, num_genes, num_microarray, num_rnaseq
+            )
+
+            expected_matrix, expected_dropped = prepare_imputation_matrix_with_loops(
+                microarray_matrix.copy(), rnaseq_matrix.copy()
+            )
+            matrix, dropped = create_compendia._prepare_imputation_matrix(
+                microarray_matrix, rnaseq_matrix
+            )
+
+            pd.testing.assert_frame_equal(matrix, expected_matrix)
+            self.assertEqual(list(dropped), list(expected_dropped))
+            self.assertIn("SRR1", dropped)
+
+        # The zeroes were restored.
+        self.assertTrue((matrix.filter(like="SRR") == 0).any().any())
+
+    @tag("compendia")
+    def test_microarray_only(self):
+        microarray_matrix, _ = self.make_matrices(np.random.RandomState(123), 50, 3, 2)
+
+        matrix, dropped = create_compendia._prepare_imputation_matrix(microarray_matrix)
+
+        pd.testing.assert_frame_equal(
+            matrix, microarray_matrix.dropna(axis="index", thresh=3 * 0.7)
+        )
+        self.assertEqual(len(dropped), 0)
+
+
+class ChunkedIterativeSVDTestCase(SimpleTestCase):
+    def setUp(self):
+        random = np.random.RandomState(123)
+        # A rank 8 matrix with a little noise and 10% of its values missing.
+        self.matrix = random.normal(size=(300, 8)) @ random.normal(size=(8, 200)) + 5
+        self.matrix += random.normal(scale=0.01, size=self.matrix.shape)
+        self.matrix = self.matrix.astype(np.float32)
+        self.missing = random.rand(*self.matrix.shape) < 0.1
+        self.matrix[self.missing] = np.nan
+
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+
+    @tag("compendia")
+    def test_matches_iterative_svd(self):
+        expected = IterativeSVD(rank=10, svd_algorithm="arpack", verbose=False).fit_transform(
+            self.matrix
+        )
+        imputed = create_compendia.ChunkedIterativeSVD(
+            rank=10, work_dir=self.work_dir.name, random_state=123
+        ).fit_transform(self.matrix)
+
+        self.assertEqual(imputed.dtype, np.float32)
+        # The values that were there are left alone.
+        np.testing.assert_array_equal(imputed[~self.missing], self.matrix[~self.missing])
+
+        difference = np.linalg.norm(imputed[self.missing] - expected[self.missing])
+        self.assertLess(difference / np.linalg.norm(expected[self.missing]), 0.001)
+
+    @tag("compendia")
+    def test_block_size(self):
+        """The number of rows in each block doesn't change the result."""
+        imputed = create_compendia.ChunkedIterativeSVD(
+            work_dir=self.work_dir.name, random_state=123
+        ).fit_transform(self.matrix)
+        # Less than one row per block still reads a whole row at a time.
+        blocked = create_compendia.ChunkedIterativeSVD(
+            block_size=7 * 200, work_dir=self.work_dir.name, random_state=123
+        ).fit_transform(self.matrix)
+        single_rows = create_compendia.ChunkedIterativeSVD(
+            block_size=1, max_iters=3, work_dir=self.work_dir.name, random_state=123
+        ).fit_transform(self.matrix)
+
+        np.testing.assert_allclose(blocked, imputed, rtol=1e-4, atol=1e-4)
+        self.assertFalse(np.isnan(single_rows).any())
+
+    @tag("compendia")
+    def test_no_missing_values(self):
+        matrix = np.nan_to_num(self.matrix)
+        imputed = create_compendia.ChunkedIterativeSVD(work_dir=self.work_dir.name).fit_transform(
+            matrix
+        )
+
+        np.testing.assert_array_equal(imputed, matrix)
+
+    @tag("compendia")
+    def test_impute_after_freeing_matrix(self):
+        expected = create_compendia.ChunkedIterativeSVD(
+            work_dir=self.work_dir.name, random_state=123
+        ).fit_transform(self.matrix)
+
+        chunked_svd = create_compendia.ChunkedIterativeSVD(
+            work_dir=self.work_dir.name, random_state=123
+        )
+        filled, missing_mask = chunked_svd.copy_matrix(self.matrix)
+        np.testing.assert_array_equal(missing_mask, self.missing)
+        del self.matrix
+
+        np.testing.assert_array_equal(chunked_svd.impute(filled, missing_mask), expected)
+
+
+class BenchmarkSmasherTestCase(SimpleTestCase):
+    @tag("compendia")
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as output_dir:
+            output_path = os.path.join(output_dir, "benchmark.json")
+            call_command(
+                "benchmark_smasher", genes=200, samples=20, output=output_path, stderr=StringIO(),
+            )
+
+            with open(output_path) as output_file:
+                results = json.load(output_file)
+
+        self.assertEqual(results["parameters"]["samples"], 20)
+        self.assertEqual(
+            set(results["stages"].keys()),
+            {
+                "load_and_sanitize",
+                "build_matrix",
+                "join",
+                "quantile_normalize",
+                "scale",
+                "prepare_imputation",
+                "impute",
+                "write_tsv",
+                "write_npy",
+            },
+        )
+        for stage in results["stages"].values():
+            self.assertGreater(stage["seconds"], 0)
+            self.assertGreater(stage["peak_rss_mb"], 0)
+
+    @tag("compendia")
+    def test_benchmark_stages(self):
+        stdout = StringIO()
+        call_command(
+            "benchmark_smasher",
+            genes=200,
+            samples=4,
+            stages="join",
+            stdout=stdout,
+            stderr=StringIO(),
+        )
+
+        results = json.loads(stdout.getvalue())
+        self.assertEqual(list(results["stages"].keys()), ["join"])
@@ -0,0 +1,93 @@
+import gzip
+import os
+import shutil
+import tempfile
+from io import StringIO
+from unittest.mock import patch
+
+from django.core.management import call_command
+from django.test import SimpleTestCase, tag
+
+from data_refinery_workers.processors import gene_indexes
+
+
+class LoadGeneIndexTestCase(SimpleTestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.work_dir, "gene_index_cache")
+        self.gene_index_path = os.path.join(self.work_dir, "hgu133plus2.tsv.gz")
+        with gzip.open(self.gene_index_path, "wt") as gene_index_file:
+            gene_index_file.write(
+                "ENSEMBL\tPROBEID\tENTREZID\n"
+                "ENSG00000000001\t1_at\t101\n"
+                "ENSG00000000002\t2_at\t102\n"
+                "ENSG00000000003\t2_at\t103\n"
+                "ENSG00000000003\t2_at\t103\n"
+                "ENSG00000000004\t3_at\t\n"
+                "\t4_at\t104\n"
+            )
+
+        self.cache_patch = patch.object(gene_indexes, "GENE_INDEX_CACHE_DIR", self.cache_dir)
+        self.cache_patch.start()
+
+    def tearDown(self):
+        self.cache_patch.stop()
+        shutil.rmtree(self.work_dir)
+
+    def assertLoadsGeneIndex(self):
+        with patch.object(gene_indexes, "_gene_index_cache", {}):
+            gene_index = gene_indexes.load_gene_index(self.gene_index_path)
+
+            self.assertEqual(set(gene_index), {"ENSEMBL", "PROBEID", "ENTREZID"})
+            self.assertEqual(
+                dict(gene_index["PROBEID"]),
+                {
+                    "1_at": ["ENSG00000000001"],
+                    "2_at": ["ENSG00000000002", "ENSG00000000003"],
+                    "3_at": ["ENSG00000000004"],
+                },
+            )
+            self.assertEqual(gene_index["ENSEMBL"]["ENSG00000000003"], ["ENSG00000000003"])
+            self.assertEqual(
+                dict(gene_index["ENTREZID"]),
+                {
+                    "101": ["ENSG00000000001"],
+                    "102": ["ENSG00000000002"],
+                    "103": ["ENSG00000000003"],
+                },
+            )
+
+            # Later lookups in the same process don't load it again.
+            self.assertIs(gene_indexes.load_gene_index(self.gene_index_path), gene_index)
+
+    @tag("no_op")
+    def test_load_gene_index(self):
+        self.assertLoadsGeneIndex()
+        self.assertEqual(len(os.listdir(self.cache_dir)), 1)
+
+        # Later jobs load the compiled copy instead of parsing it again.
+        with patch.object(gene_indexes, "_parse_gene_index") as parse_gene_index:
+            self.assertLoadsGeneIndex()
+            parse_gene_index.assert_not_called()
+
+    @tag("no_op")
+    def test_load_gene_index_with_bad_compiled_copy(self):
+        self.assertLoadsGeneIndex()
+        compiled_gene_index_path = os.path.join(self.cache_dir, os.listdir(self.cache_dir)[0])
+        with open(compiled_gene_index_path, "wb") as compiled_gene_index_file:
+            compiled_gene_index_file.write(b"not an npz file")
+
+        self.assertLoadsGeneIndex()
+        self.assertEqual(os.listdir(self.cache_dir), [os.path.basename(compiled_gene_index_path)])
+
+    @tag("no_op")
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command("benchmark_gene_index", row_counts="200", stdout=stdout)
+
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(lines[0], "rows\tmethod\tseconds")
+        self.assertEqual(
+            [line.split("\t")[1] for line in lines[1:]],
+            ["parse", "first job", "later job", "same process"],
+        )
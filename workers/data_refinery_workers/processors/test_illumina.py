@@ -1,5 +1,6 @@
 import os
 import shutil
+import tempfile
 
 from django.test import TestCase, tag
 
@@ -167,3 +168,95 @@ class IlluminaToPCLTestCase(TestCase):
 
         # Cleanup after the job since it won't since we aren't running in cloud.
         shutil.rmtree(final_context["work_dir"], ignore_errors=True)
+
+
+class DetectColumnsTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def detect_columns(self, headers, samples, num_queries):
+        input_file_path = os.path.join(self.work_dir, "non-normalized.txt")
+        with open(input_file_path, "w") as input_file:
+            input_file.write("\t".join(headers) + "\n")
+            input_file.write("\t".join(["ILMN_1343291"] + ["1.0"] * (len(headers) - 1)) + "\n")
+
+        job_context = {
+            "input_file_path": input_file_path,
+            "samples": samples,
+            "job": ProcessorJob(),
+        }
+        with self.assertNumQueries(num_queries):
+            job_context = illumina._detect_columns(job_context)
+
+        self.assertNotIn("success", job_context)
+        self.assertEqual(job_context["probeId"], headers[0])
+        return sorted(int(column_id) for column_id in job_context["columnIds"].split(","))
+
+    def create_sample(self, title, description=None, is_ccdl=False):
+        sample = Sample.objects.create(accession_code=title, title=title)
+        if description:
+            SampleAnnotation.objects.create(
+                sample=sample, data={"description": [description]}, is_ccdl=is_ccdl
+            )
+
+        return sample
+
+    @tag("illumina")
+    def test_matching_rules(self):
+        samples = [
+            self.create_sample("Control-1"),
+            self.create_sample("Control-2"),
+            self.create_sample("GSM1000", description="Treated"),
+            self.create_sample("GSM1001", description="Unused", is_ccdl=True),
+        ]
+        headers = [
+            "ID_REF",
+            "Control-1",
+            "Detection Pval",
+            "control-2.AVG",
+            "Control-2.Detection_Pval",
+            "Control-2.BEAD_STDERR",
+            "Control-2.NARRAYS",
+            "Control-2.ARRAY_STDEV",
+            "Treated",
+            "Treated.AVG_Signal",
+            "Unused",
+            "RAW VALUE",
+        ]
+
+        self.assertEqual(self.detect_columns(headers, samples, 2), [2, 4, 9, 10, 12])
+
+        # The header that matched the description is now the sample's title.
+        retitled_sample = Sample.objects.get(accession_code="GSM1000")
+        self.assertEqual(retitled_sample.title, "Treated")
+        self.assertGreater(retitled_sample.last_modified, samples[2].created_at)
+        unchanged_sample = Sample.objects.get(accession_code="GSM1001")
+        self.assertEqual(unchanged_sample.title, "GSM1001")
+        self.assertEqual(unchanged_sample.last_modified, samples[3].last_modified)
+
+    @tag("illumina")
+    def test_description_match_changes_title_for_later_columns(self):
+        # The title only matches the columns before the description does.
+        samples = [self.create_sample("S1", description="Heart")]
+        headers = ["ID_REF", "S1.AVG", "Heart", "Heart.MEAN", "S1.MEDIAN", "Detection Pval"]
+
+        self.assertEqual(self.detect_columns(headers, samples, 2), [2, 3, 4])
+
+    @tag("illumina")
+    def test_query_count(self):
+        """The annotations of every sample are loaded in one query, no
+        matter how many samples and headers there are."""
+        samples = [
+            self.create_sample("Sample-{}".format(i), description="Sample {}".format(i))
+            for i in range(50)
+        ]
+        headers = ["PROBE_ID"]
+        for sample in samples:
+            headers += [sample.title, sample.title + ".BEAD_STDERR", "Detection Pval"]
+
+        self.assertEqual(
+            self.detect_columns(headers, samples, 1), list(range(2, len(headers) + 1, 3))
+        )
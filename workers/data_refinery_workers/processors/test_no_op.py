@@ -1,9 +1,12 @@
+import gzip
 import math
 import os
 import shutil
+import tempfile
 from pathlib import Path
+from unittest.mock import patch
 
-from django.test import TestCase, tag
+from django.test import SimpleTestCase, TestCase, tag
 
 import pandas as pd
 import scipy.stats
@@ -16,7 +19,7 @@ from data_refinery_common.models import (
     ProcessorJobOriginalFileAssociation,
     Sample,
 )
-from data_refinery_workers.processors import no_op
+from data_refinery_workers.processors import gene_indexes, no_op
 from data_refinery_workers.processors.testing_utils import assertMostlyAgrees
 
 
@@ -256,3 +259,122 @@ class NOOPTestCase(TestCase):
         final_context = no_op.no_op_processor(job.pk)
         self.assertFalse(final_context["success"])
         self.assertTrue("Tell Rich!" in final_context["job"].failure_reason)
+
+
+class ConvertIdsTestCase(SimpleTestCase):
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.gene_index_path = os.path.join(self.work_dir, "hgu133plus2.tsv.gz")
+        with gzip.open(self.gene_index_path, "wt") as gene_index_file:
+            gene_index_file.write(
+                "ENSEMBL\tPROBEID\tENTREZID\n"
+                "ENSG00000000001\t1_at\t101\n"
+                "ENSG00000000002\t2_at\t102\n"
+                "ENSG00000000003\t2_at\t103\n"
+                "ENSG00000000003\t2_at\t103\n"
+                "ENSG00000000004\t3_at\t\n"
+            )
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir)
+
+    def write_input(self, content: str) -> str:
+        input_file_path = os.path.join(self.work_dir, "GSM1234847_sample_table.txt")
+        with open(input_file_path, "w") as input_file:
+            input_file.write(content)
+
+        return input_file_path
+
+    def load_gene_index(self) -> dict:
+        with patch.object(gene_indexes, "_gene_index_cache", {}), patch.object(
+            gene_indexes, "GENE_INDEX_CACHE_DIR", os.path.join(self.work_dir, "gene_index_cache")
+        ):
+            return gene_indexes.load_gene_index(self.gene_index_path)
+
+    @tag("no_op")
+    def test_prepare_files_keeps_header_width(self):
+        input_file_path = self.write_input("Probe Set\tSignal\tDetection\n1_at\t0.5\tP\n")
+        original_file = OriginalFile(
+            filename="GSM1234847_sample_table.txt", absolute_file_path=input_file_path
+        )
+        sample = Sample(manufacturer="AFFYMETRIX", platform_accession_code="hgu133plus2")
+
+        with patch.object(no_op, "LOCAL_ROOT_DIR", self.work_dir):
+            job_context = no_op._prepare_files(
+                {
+                    "job_id": 1,
+                    "job": ProcessorJob(id=1),
+                    "original_files": [original_file],
+                    "samples": [sample],
+                }
+            )
+
+        self.assertEqual(job_context["header"], ["ID_REF", "Signal", "Detection"])
+        self.assertTrue(job_context["has_header"])
+
+    @tag("no_op")
+    def test_write_with_header(self):
+        input_file_path = self.write_input("ILMN_1343291\t14.9\t0\nILMN_1343295\t13.5\t0\n")
+        output_file_path = os.path.join(self.work_dir, "fixed.txt")
+
+        no_op._write_with_header(
+            input_file_path, output_file_path, ["Reporter Identifier", "VALUE", "Detection Pval"]
+        )
+
+        with open(output_file_path) as output_file:
+            self.assertEqual(
+                output_file.read(),
+                "Reporter Identifier\tVALUE\tDetection Pval\n"
+                "ILMN_1343291\t14.9\t0\nILMN_1343295\t13.5\t0\n",
+            )
+
+    @tag("no_op")
+    def test_convert_ids(self):
+        input_file_path = self.write_input(
+            "Probe Set\tSignal\n1_at\t0.5\n2_at\t1.5\nAFFX-BioB-3_at\t2.5\n3_at\t3.5\n"
+        )
+        output_file_path = os.path.join(self.work_dir, "gene_converted.txt")
+
+        id_columns = self.load_gene_index()
+        id_column = no_op._detect_id_column(input_file_path, True, id_columns)
+        self.assertEqual(id_column, "PROBEID")
+
+        no_op._convert_ids(
+            input_file_path, output_file_path, ["ID_REF", "VALUE"], True, id_columns[id_column]
+        )
+
+        with open(output_file_path) as output_file:
+            self.assertEqual(
+                output_file.read(),
+                "ENSEMBL\tVALUE\n"
+                "ENSG00000000001\t0.5\n"
+                "ENSG00000000002\t1.5\n"
+                "ENSG00000000003\t1.5\n"
+                "ENSG00000000004\t3.5\n",
+            )
+
+    @tag("no_op")
+    def test_convert_ids_without_header(self):
+        input_file_path = self.write_input("101\t0.5\n102\t1.5\n")
+        output_file_path = os.path.join(self.work_dir, "gene_converted.txt")
+
+        id_columns = self.load_gene_index()
+        id_column = no_op._detect_id_column(input_file_path, False, id_columns)
+        self.assertEqual(id_column, "ENTREZID")
+
+        no_op._convert_ids(
+            input_file_path, output_file_path, ["ID_REF", "VALUE"], False, id_columns[id_column]
+        )
+
+        with open(output_file_path) as output_file:
+            self.assertEqual(
+                output_file.read(), "ENSEMBL\tVALUE\nENSG00000000001\t0.5\nENSG00000000002\t1.5\n"
+            )
+
+    @tag("no_op")
+    def test_detect_id_column_not_enough_overlap(self):
+        input_file_path = self.write_input("ID_REF\tVALUE\n1_at\t0.5\n4_at\t1.5\n5_at\t2.5\n")
+
+        id_columns = self.load_gene_index()
+
+        self.assertIsNone(no_op._detect_id_column(input_file_path, True, id_columns))
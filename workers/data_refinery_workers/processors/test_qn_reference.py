@@ -1,12 +1,15 @@
 import os
 import os.path
+import tempfile
 from io import StringIO
 from typing import List
+from unittest.mock import patch
 
 from django.core.management import call_command
-from django.test import TestCase, tag
+from django.test import SimpleTestCase, TestCase, tag
 
 import numpy as np
+import pandas as pd
 
 from data_refinery_common.models import (
     ComputationalResult,
@@ -21,7 +24,7 @@ from data_refinery_common.models import (
     SampleComputedFileAssociation,
 )
 from data_refinery_common.models.organism import Organism
-from data_refinery_workers.processors import qn_reference, smasher
+from data_refinery_workers.processors import qn_reference, smasher, smashing_utils
 
 
 def prepare_experiment(ids: List[int]) -> Experiment:
@@ -251,3 +254,84 @@ class QNRefTestCase(TestCase):
         # There's not enough samples available in this scenario so we
         # shouldn't have even made a processor job.
         self.assertEqual(ProcessorJob.objects.count(), 0)
+
+
+class QNTargetBuilderTestCase(SimpleTestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+        self.random = np.random.RandomState(123)
+
+    def make_computed_file(self, index: List[str], values: np.ndarray = None) -> ComputedFile:
+        if values is None:
+            values = self.random.normal(8, 2, size=len(index))
+
+        path = os.path.join(
+            self.work_dir.name, "{}.tsv".format(len(os.listdir(self.work_dir.name)))
+        )
+        pd.DataFrame({"sample": values}, index=pd.Index(index, name="Gene")).to_csv(path, sep="\t")
+
+        return ComputedFile(filename=os.path.basename(path), absolute_file_path=path)
+
+    def build_target(self, computed_files: List[ComputedFile]) -> dict:
+        job_context = {
+            "input_files": {"ALL": [(computed_file, None) for computed_file in computed_files]},
+            "target_file": os.path.join(self.work_dir.name, "target.tsv"),
+        }
+        return qn_reference._build_qn_target(job_context)
+
+    @tag("qn")
+    def test_matches_frames(self):
+        """The target is the mean of the sorted values of the valid
+        inputs, however their genes are decorated, ordered or duplicated."""
+        genes = ["ENSG{:011d}".format(i) for i in range(50)]
+        index = [gene + "_at" for gene in genes[:25]] + [gene + ".3" for gene in genes[25:]]
+        index += ["AFFX-BioB-5_at", genes[7]]
+
+        computed_files = []
+        valid_values = []
+        for i in range(6):
+            values = self.random.normal(8, 2, size=len(index))
+            computed_files.append(self.make_computed_file(index[::-1] if i % 2 else index, values))
+            if i % 2:
+                values = values[::-1]
+            # The duplicated gene is averaged and the control probe dropped.
+            values[7] = (values[7] + values[-1]) / 2
+            valid_values.append(np.sort(values[:50]))
+
+        # A gene is missing from one and another has an extra one.
+        computed_files.append(self.make_computed_file(index[1:]))
+        computed_files.append(self.make_computed_file(index + ["ENSG99999999999"]))
+        # And this one has a missing value.
+        values = self.random.normal(8, 2, size=len(index))
+        values[3] = np.nan
+        computed_files.append(self.make_computed_file(index, values))
+        # And this one isn't there at all.
+        computed_files.append(ComputedFile(absolute_file_path="/home/user/data_store/missing.tsv"))
+
+        expected_target = np.mean(valid_values, axis=0)
+        for num_processes in [1, 3]:
+            with patch.object(smashing_utils, "MULTIPROCESSING_MAX_THREAD_COUNT", num_processes):
+                job_context = self.build_target(computed_files)
+
+            self.assertEqual(set(job_context["geneset"]), set(genes))
+            self.assertEqual(job_context["num_valid_inputs"], 6)
+            np.testing.assert_allclose(
+                job_context["sum_frame"]["sum"].values, expected_target, rtol=1e-6
+            )
+
+            target = pd.read_csv(job_context["target_file"], sep="\t", header=None)
+            np.testing.assert_allclose(target[0].values, expected_target, rtol=1e-6)
+
+    @tag("qn")
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command("benchmark_qn_target", genes=100, samples=10, processes="1,2", stdout=stdout)
+
+        lines = stdout.getvalue().strip().split("\n")
+        self.assertEqual(
+            [line.split("\t")[:2] for line in lines[1:]],
+            [["frames", "1"], ["builder", "1"], ["builder", "2"]],
+        )
+        for line in lines[2:]:
+            self.assertLess(float(line.split("\t")[-1]), 1e-6)
@@ -1,13 +1,21 @@
+import gzip
 import hashlib
 import os
 import random
 import shutil
 import subprocess
+import tempfile
+from io import StringIO
 from typing import Dict, List
+from unittest.mock import patch
 
+from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase, tag
+from django.test.utils import CaptureQueriesContext
 
 import numpy
+import pandas as pd
 import scipy.stats
 
 from data_refinery_common.enums import ProcessorEnum
@@ -30,7 +38,7 @@ from data_refinery_common.models import (
     SampleResultAssociation,
     SurveyJob,
 )
-from data_refinery_common.utils import get_env_variable
+from data_refinery_common.utils import calculate_sha1, get_env_variable
 from data_refinery_workers.processors import salmon, tximport, utils
 
 
@@ -477,6 +485,12 @@ class SalmonTestCase(TestCase):
             rds_file_path,
             "--gene2txmap",
             job2_context["genes_to_transcripts_path"],
+            # Also check that the length-scaled TPM file matches what
+            # tximport itself produces for the same quant.sf files.
+            "--file_list",
+            os.path.join(job2_context["work_dir"], "tximport_inputs.txt"),
+            "--tpm_file",
+            os.path.join(job2_context["work_dir"], "gene_lengthScaledTPM.tsv"),
         ]
 
         tximport_test_result = subprocess.run(
@@ -683,6 +697,58 @@ class DetermineIndexLengthTestCase(TestCase):
         self.assertEqual(results["index_length_raw"], 41)
         self.assertEqual(results["index_length"], "short")
 
+    def write_fastq(self, read_lengths: List[int]) -> str:
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        input_file_path = os.path.join(work_dir.name, "reads.fastq.gz")
+        with gzip.open(input_file_path, "wt") as fastq_file:
+            for i, read_length in enumerate(read_lengths):
+                fastq_file.write(
+                    "@READ{}\n{}\n+\n{}\n".format(i, "A" * read_length, "I" * read_length)
+                )
+
+        return input_file_path
+
+    @tag("salmon")
+    def test_salmon_determine_index_length_sampled(self):
+        """Only the first reads are used when they're clearly long or short."""
+        input_file_path = self.write_fastq([100] * 100 + [20] * 900)
+
+        with patch.object(salmon, "INDEX_LENGTH_SAMPLE_READS", 100):
+            results = salmon._determine_index_length(
+                {"input_file_path": input_file_path, "job": ProcessorJob()}
+            )
+
+        self.assertEqual(results["index_length_raw"], 100)
+        self.assertEqual(results["index_length"], "long")
+
+    @tag("salmon")
+    def test_salmon_determine_index_length_near_threshold(self):
+        """All of the reads are used when the first ones are too close to the threshold."""
+        read_lengths = [74, 76] * 50 + [100] * 100
+        input_file_path = self.write_fastq(read_lengths)
+
+        with patch.object(salmon, "INDEX_LENGTH_SAMPLE_READS", 100):
+            results = salmon._determine_index_length(
+                {"input_file_path": input_file_path, "job": ProcessorJob()}
+            )
+
+        self.assertEqual(results["index_length_raw"], numpy.mean(read_lengths))
+        self.assertEqual(results["index_length"], "long")
+
+    @tag("salmon")
+    def test_benchmark_index_length(self):
+        stdout = StringIO()
+        call_command(
+            "benchmark_index_length", read_counts="1000", read_lengths="50,100", stdout=stdout
+        )
+
+        rows = [line.split("\t") for line in stdout.getvalue().strip().split("\n")[1:]]
+        self.assertEqual([row[2] for row in rows], ["zcat", "sampled", "zcat", "sampled"])
+        # Files this small are read completely, so the lengths are the same.
+        self.assertEqual(rows[0][4:], rows[1][4:])
+        self.assertEqual(rows[2][4:], rows[3][4:])
+
 
 class RuntimeProcessorTest(TestCase):
     """Test the four processors hosted inside "Salmon" docker container."""
@@ -806,6 +872,191 @@ class RuntimeProcessorTest(TestCase):
         ProcessorEnum["SALMONTOOLS"].value["yml_file"] = original_yml_file
 
 
+class TximportResultFilesTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+
+    def create_result_files(self, accession_codes: List[str]):
+        data = pd.DataFrame(
+            numpy.random.RandomState(123).lognormal(size=(20, len(accession_codes))),
+            index=pd.Index(["ENSG{:011d}".format(i) for i in range(20)], name="Gene"),
+            columns=[accession_code + "_output" for accession_code in accession_codes],
+        )
+        result = ComputationalResult.objects.create()
+        rds_file = ComputedFile.objects.create(
+            filename="txi_out.RDS", size_in_bytes=1, sha1="abc", result=result
+        )
+
+        samples, individual_files = salmon._create_tximport_result_files(
+            self.work_dir.name, data, "gene_lengthScaledTPM.tsv", result, rds_file
+        )
+        return data, result, rds_file, samples, individual_files
+
+    @tag("salmon")
+    def test_create_result_files(self):
+        accession_codes = ["SRR1", "SRR2", "SRR3"]
+        for accession_code in accession_codes:
+            Sample.objects.create(accession_code=accession_code, technology="RNA-SEQ")
+        data, result, rds_file, samples, individual_files = self.create_result_files(
+            accession_codes
+        )
+
+        self.assertEqual([sample.accession_code for sample in samples], accession_codes)
+        for sample, computed_file in zip(samples, individual_files):
+            computed_file.refresh_from_db()
+            self.assertEqual(
+                computed_file.filename, sample.accession_code + "_gene_lengthScaledTPM.tsv"
+            )
+            self.assertEqual(computed_file.result, result)
+            self.assertTrue(computed_file.is_smashable)
+            self.assertEqual(
+                computed_file.size_in_bytes, os.path.getsize(computed_file.absolute_file_path)
+            )
+
+            # Each file has just its sample's column, like splitting the matrix does.
+            with open(computed_file.absolute_file_path) as tpm_file:
+                expected = data[[sample.accession_code + "_output"]].to_csv(sep="\t")
+                self.assertEqual(tpm_file.read(), expected)
+
+            self.assertEqual(set(sample.computed_files.all()), {rds_file, computed_file})
+            self.assertEqual(list(sample.results.all()), [result])
+
+    @tag("salmon")
+    def test_number_of_queries(self):
+        for i in range(1, 8):
+            Sample.objects.create(accession_code="SRR{}".format(i), technology="RNA-SEQ")
+
+        with CaptureQueriesContext(connection) as two_samples:
+            self.create_result_files(["SRR1", "SRR2"])
+        with CaptureQueriesContext(connection) as five_samples:
+            self.create_result_files(["SRR3", "SRR4", "SRR5", "SRR6", "SRR7"])
+        self.assertEqual(len(two_samples), len(five_samples))
+
+    @tag("salmon")
+    def test_missing_sample(self):
+        data = pd.DataFrame({"SRR404_output": [1.0]}, index=pd.Index(["ENSG1"], name="Gene"))
+        with self.assertRaises(utils.ProcessorJobError):
+            salmon._create_tximport_result_files(
+                self.work_dir.name, data, "gene_lengthScaledTPM.tsv", None, None
+            )
+
+    @tag("salmon")
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command("benchmark_tximport_results", sample_counts="3", genes=10, stdout=stdout)
+
+        lines = stdout.getvalue().strip().split("\n")
+        self.assertEqual(
+            [line.split("\t")[:2] for line in lines[1:]], [["3", "serial"], ["3", "bulk"]]
+        )
+        # Nothing is left behind in the database.
+        self.assertFalse(Sample.objects.filter(accession_code__startswith="BENCH").exists())
+
+
+class QuantFilePrefetchTestCase(TestCase):
+    def setUp(self):
+        self.source_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.source_dir.cleanup)
+        self.addCleanup(self.cache_dir.cleanup)
+
+        patcher = patch.object(salmon, "QUANT_FILE_CACHE_DIR", self.cache_dir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        result = ComputationalResult.objects.create()
+        self.quant_files = []
+        for accession_code in ["SRR1", "SRR2", "SRR3"]:
+            output_dir = os.path.join(self.source_dir.name, accession_code + "_output")
+            os.makedirs(output_dir)
+            absolute_file_path = os.path.join(output_dir, "quant.sf")
+            with open(absolute_file_path, "w") as quant_file:
+                quant_file.write("Name\tLength\tEffectiveLength\tTPM\tNumReads\n")
+                quant_file.write(accession_code + "\t1\t1\t1\t1\n")
+
+            self.quant_files.append(
+                ComputedFile.objects.create(
+                    filename="quant.sf",
+                    absolute_file_path=absolute_file_path,
+                    size_in_bytes=os.path.getsize(absolute_file_path),
+                    sha1=calculate_sha1(absolute_file_path),
+                    result=result,
+                )
+            )
+
+    def make_work_dir(self) -> str:
+        work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(work_dir.cleanup)
+        return work_dir.name + "/"
+
+    @tag("salmon")
+    def test_prefetch(self):
+        work_dir = self.make_work_dir()
+        quant_file_paths = salmon._prefetch_quant_files(work_dir, self.quant_files, max_workers=2)
+
+        # The paths are in the same order and keep the directories tximport names columns after.
+        self.assertEqual(
+            quant_file_paths,
+            [work_dir + code + "_output/quant.sf" for code in ["SRR1", "SRR2", "SRR3"]],
+        )
+        for quant_file, quant_file_path in zip(self.quant_files, quant_file_paths):
+            self.assertEqual(calculate_sha1(quant_file_path), quant_file.sha1)
+            self.assertTrue(os.path.exists(salmon._get_quant_file_cache_path(quant_file)))
+
+        # A later job gets them from the cache, even if they can't be downloaded anymore.
+        for quant_file in self.quant_files:
+            os.remove(quant_file.absolute_file_path)
+
+        work_dir = self.make_work_dir()
+        for quant_file, quant_file_path in zip(
+            self.quant_files, salmon._prefetch_quant_files(work_dir, self.quant_files)
+        ):
+            self.assertEqual(calculate_sha1(quant_file_path), quant_file.sha1)
+
+    @tag("salmon")
+    def test_files_with_wrong_sha1_are_not_cached(self):
+        quant_file = self.quant_files[0]
+        quant_file.sha1 = "abc"
+
+        salmon._prefetch_quant_files(self.make_work_dir(), [quant_file])
+
+        self.assertEqual(os.listdir(self.cache_dir.name), [])
+
+    @tag("salmon")
+    def test_retry(self):
+        quant_file = self.quant_files[0]
+        work_dir = self.make_work_dir()
+        os.makedirs(work_dir + "SRR1_output")
+        quant_work_path = work_dir + "SRR1_output/quant.sf"
+
+        with patch.object(
+            ComputedFile, "get_synced_file_path", side_effect=[None, quant_file.absolute_file_path]
+        ):
+            self.assertEqual(
+                salmon._fetch_quant_file(quant_file, quant_work_path),
+                quant_file.absolute_file_path,
+            )
+
+        with patch.object(ComputedFile, "get_synced_file_path", return_value=None):
+            with self.assertRaises(utils.ProcessorJobError):
+                salmon._fetch_quant_file(self.quant_files[1], quant_work_path, num_attempts=1)
+
+    @tag("salmon")
+    def test_eviction(self):
+        salmon._prefetch_quant_files(self.make_work_dir(), self.quant_files)
+        cache_paths = [salmon._get_quant_file_cache_path(qf) for qf in self.quant_files]
+        for i, cache_path in enumerate(cache_paths):
+            os.utime(cache_path, (i, i))
+
+        # Only the most recently used file fits.
+        salmon._evict_quant_file_cache(max_bytes=self.quant_files[2].size_in_bytes)
+
+        self.assertEqual(
+            [os.path.exists(cache_path) for cache_path in cache_paths], [False, False, True]
+        )
+
+
 def create_tximport_job_context(
     complete_accessions: List[str], incomplete_accessions: List[str], salmon_version="salmon 0.13.1"
 ) -> Dict:
@@ -4,15 +4,19 @@ import csv
 import json
 import os
 import sys
+import tempfile
 import zipfile
 from io import StringIO
 from unittest.mock import MagicMock, patch
 
 from django.core.management import call_command
-from django.test import TransactionTestCase, tag
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, tag
 
+import numpy as np
 import pandas as pd
 import vcr
+from rpy2.robjects import numpy2ri
+from rpy2.robjects.packages import importr
 
 from data_refinery_common.models import (
     ComputationalResult,
@@ -1879,3 +1883,360 @@ class AggregationTestCase(TransactionTestCase):
         ds = Dataset.objects.get(id=ds.id)
 
         self.assertEqual(len(final_context["final_frame"]), 4)
+
+
+class QuantileNormalizationTestCase(SimpleTestCase):
+    """Checks that our quantile normalization matches preprocessCore's."""
+
+    def _assert_matches_preprocess_core(self, matrix, target):
+        preprocessCore = importr("preprocessCore")
+        numpy2ri.activate()
+        try:
+            expected = np.array(
+                preprocessCore.normalize_quantiles_use_target(
+                    x=matrix.astype(np.float64), target=target, copy=True
+                )
+            )
+        finally:
+            numpy2ri.deactivate()
+
+        normalized = smashing_utils._quantile_normalize_matrix(target, pd.DataFrame(matrix))
+
+        self.assertEqual(normalized.values.dtype, np.float32)
+        np.testing.assert_allclose(normalized.values, expected, rtol=1e-5, equal_nan=True)
+
+    @tag("smasher")
+    def test_qn_parity(self):
+        random = np.random.RandomState(123)
+        matrix = random.lognormal(size=(500, 20)).astype(np.float32)
+        target = np.sort(random.normal(size=500))
+
+        self._assert_matches_preprocess_core(matrix, target)
+
+    @tag("smasher")
+    def test_qn_parity_ties_and_missing_values(self):
+        random = np.random.RandomState(123)
+        # Rounding makes lots of ties.
+        matrix = np.round(random.uniform(0, 5, size=(300, 15)), 1).astype(np.float32)
+        matrix[random.uniform(size=matrix.shape) < 0.1] = np.nan
+        # A target of a different length than the columns needs interpolation.
+        target = np.sort(random.normal(size=457))
+
+        self._assert_matches_preprocess_core(matrix, target)
+
+    @tag("smasher")
+    def test_qn_blocks(self):
+        random = np.random.RandomState(123)
+        matrix = random.lognormal(size=(100, 50)).astype(np.float32)
+        target = np.sort(random.normal(size=100))
+
+        expected = smashing_utils._quantile_normalize_matrix(target, pd.DataFrame(matrix))
+        with patch.object(smashing_utils, "QN_BLOCK_SIZE", 300):
+            normalized = smashing_utils._quantile_normalize_matrix(
+                target, pd.DataFrame(matrix), in_place=True
+            )
+
+        np.testing.assert_array_equal(normalized.values, expected.values)
+
+    @tag("smasher")
+    def test_ks_test(self):
+        random = np.random.RandomState(123)
+        column = np.sort(random.normal(size=1000))
+        identical = pd.DataFrame(np.tile(column.reshape(-1, 1), (1, 5)))
+
+        results = smashing_utils._test_qn(identical)
+        # All 10 pairs of the 5 columns are tested.
+        self.assertEqual(len(results), 10)
+        for statistic, pvalue in results:
+            self.assertEqual(statistic, 0.0)
+            self.assertEqual(pvalue, 1.0)
+
+        shifted = identical.copy()
+        shifted[0] = shifted[0] + 10
+        statistic, pvalue = smashing_utils._test_qn(shifted[[0, 1]])[0]
+        self.assertEqual(statistic, 1.0)
+        self.assertLess(pvalue, 0.001)
+
+        self.assertIsNone(smashing_utils._test_qn(identical[[0]]))
+
+    @tag("smasher")
+    def test_ks_test_many_columns(self):
+        matrix = pd.DataFrame(np.random.RandomState(123).normal(size=(100, 1000)))
+        self.assertEqual(len(smashing_utils._test_qn(matrix)), 100)
+
+
+class JoinFramesTestCase(SimpleTestCase):
+    """Checks that joining all the frames at once matches merging them one at a time."""
+
+    def _merge_one_at_a_time(self, frames, how):
+        merged = frames[0]
+        for frame in frames[1:]:
+            if any(column in merged.columns for column in frame.columns):
+                continue
+            joined = merged.merge(frame, how=how, left_index=True, right_index=True)
+            if len(joined) > 0:
+                merged = joined
+
+        return merged
+
+    def _make_frames(self):
+        random = np.random.RandomState(123)
+        genes = np.array(["ENSG{:05d}".format(i) for i in range(1000)])
+
+        frames = []
+        for i in range(30):
+            frame_genes = random.choice(genes, random.randint(800, 1000), replace=False)
+            frames.append(
+                pd.DataFrame(
+                    random.rand(len(frame_genes), 1).astype(np.float32),
+                    index=pd.Index(frame_genes, name="Gene"),
+                    columns=["SAMPLE_{}".format(i)],
+                )
+            )
+
+        # A duplicate column, and a frame that shares no genes with the rest.
+        frames.append(frames[3].copy())
+        frames.append(
+            pd.DataFrame(
+                [[1.0]],
+                index=pd.Index(["NOT_A_GENE"], name="Gene"),
+                columns=["BAD_SAMPLE"],
+                dtype=np.float32,
+            )
+        )
+
+        return frames
+
+    @tag("smasher")
+    def test_inner_join(self):
+        frames = self._make_frames()
+        job_context = {
+            "all_frames": frames,
+            "job": MagicMock(),
+            "dataset": MagicMock(),
+            "unsmashable_files": [],
+        }
+
+        joined = smasher._inner_join(job_context)
+
+        pd.testing.assert_frame_equal(joined, self._merge_one_at_a_time(frames, "inner"))
+        self.assertEqual(joined.values.dtype, np.float32)
+        self.assertEqual(job_context["unsmashable_files"], ["BAD_SAMPLE"])
+
+    @tag("smasher")
+    def test_outer_join(self):
+        frames = self._make_frames()
+        job_context = {
+            "all_frames": frames,
+            "job": MagicMock(),
+            "dataset": MagicMock(),
+            "unsmashable_files": [],
+        }
+
+        joined = smasher._join_frames(job_context, how="outer")
+
+        pd.testing.assert_frame_equal(joined, self._merge_one_at_a_time(frames, "outer"))
+        self.assertIn("BAD_SAMPLE", joined.columns)
+        self.assertTrue(joined.isnull().values.any())
+
+
+class MatrixFileFormatTestCase(SimpleTestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.output_dir.cleanup)
+
+        random = np.random.RandomState(123)
+        values = random.normal(size=(100, 5)).astype(np.float32)
+        values[3, 2] = np.nan
+        self.matrix = pd.DataFrame(
+            values,
+            # "NA" is a real gene symbol, so it shouldn't be read back as missing.
+            index=pd.Index(["NA"] + ["ENSG{:05d}".format(i) for i in range(99)], name="Gene"),
+            columns=["GSM{}".format(i) for i in range(5)],
+        )
+
+    @tag("smasher")
+    def test_tsv_round_trip(self):
+        # pandas reads an "NA" gene back from a TSV as missing.
+        matrix = self.matrix.iloc[1:]
+        path_prefix = os.path.join(self.output_dir.name, "GSE123")
+        outfiles = smashing_utils.write_matrix(matrix, path_prefix, "TSV")
+
+        self.assertEqual(outfiles, [path_prefix + ".tsv"])
+        pd.testing.assert_frame_equal(
+            smashing_utils.read_matrix(path_prefix, "TSV"), matrix, check_dtype=False
+        )
+
+    @tag("smasher")
+    def test_npy_round_trip(self):
+        path_prefix = os.path.join(self.output_dir.name, "GSE123")
+        outfiles = smashing_utils.write_matrix(self.matrix, path_prefix, "NPY")
+
+        self.assertEqual(
+            outfiles,
+            [path_prefix + ".npy", path_prefix + "_genes.tsv", path_prefix + "_samples.tsv"],
+        )
+        for outfile in outfiles:
+            self.assertTrue(os.path.exists(outfile))
+
+        pd.testing.assert_frame_equal(smashing_utils.read_matrix(path_prefix, "NPY"), self.matrix)
+
+        mapped = smashing_utils.read_matrix(path_prefix, "NPY", mmap_mode="r")
+        pd.testing.assert_frame_equal(mapped, self.matrix)
+
+    @tag("smasher")
+    def test_unknown_format(self):
+        with self.assertRaises(ValueError):
+            smashing_utils.write_matrix(
+                self.matrix, os.path.join(self.output_dir.name, "GSE123"), "CSV"
+            )
+
+
+class ArchiveWriterTestCase(SimpleTestCase):
+    def setUp(self):
+        self.output_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.output_dir.cleanup)
+        self.root_dir = os.path.join(self.output_dir.name, "output")
+        os.makedirs(os.path.join(self.root_dir, "GSE123"))
+        self.archive_path = os.path.join(self.output_dir.name, "output.zip")
+
+        self.matrix = pd.DataFrame(
+            [[1.0, 2.0], [3.0, 4.0]],
+            index=pd.Index(["ENSG00001", "ENSG00002"], name="Gene"),
+            columns=["GSM1", "GSM2"],
+        )
+
+    def write_file(self, path, contents):
+        with open(os.path.join(self.root_dir, path), "w") as output_file:
+            output_file.write(contents)
+
+        return os.path.join(self.root_dir, path)
+
+    @tag("smasher")
+    def test_streamed_matrix(self):
+        path_prefix = os.path.join(self.root_dir, "GSE123", "GSE123")
+        with smashing_utils.ArchiveWriter(self.archive_path, self.root_dir) as archive:
+            smashing_utils.write_matrix(self.matrix, path_prefix, "TSV", archive)
+
+        # The matrix only ends up in the archive.
+        self.assertFalse(os.path.exists(path_prefix + ".tsv"))
+        with zipfile.ZipFile(self.archive_path) as zip_file:
+            self.assertEqual(zip_file.namelist(), ["GSE123/GSE123.tsv"])
+            with zip_file.open("GSE123/GSE123.tsv") as matrix_file:
+                matrix = pd.read_csv(matrix_file, sep="\t", index_col=0)
+
+        pd.testing.assert_frame_equal(matrix, self.matrix)
+
+    @tag("smasher")
+    def test_write_directory(self):
+        quant_file = self.write_file("GSE123/SRR1_quant.sf", "quant")
+        self.write_file("metadata.json", "{}")
+
+        with smashing_utils.ArchiveWriter(self.archive_path, self.root_dir) as archive:
+            archive.write(quant_file, delete=True)
+            self.assertFalse(os.path.exists(quant_file))
+
+            self.write_file("README.md", "readme")
+            archive.write_directory()
+
+        with zipfile.ZipFile(self.archive_path) as zip_file:
+            # Every file is only added once.
+            self.assertEqual(
+                sorted(zip_file.namelist()), ["GSE123/SRR1_quant.sf", "README.md", "metadata.json"],
+            )
+            self.assertEqual(zip_file.read("GSE123/SRR1_quant.sf"), b"quant")
+
+    @tag("smasher")
+    def test_append(self):
+        quant_file = self.write_file("GSE123/SRR1_quant.sf", "quant")
+        with smashing_utils.ArchiveWriter(self.archive_path, self.root_dir) as archive:
+            archive.write(quant_file)
+
+        self.write_file("README.md", "readme")
+        # Appending twice doesn't duplicate anything, so steps can be retried.
+        for _ in range(2):
+            with smashing_utils.ArchiveWriter(self.archive_path, self.root_dir, "a") as archive:
+                archive.write_directory()
+
+        with zipfile.ZipFile(self.archive_path) as zip_file:
+            self.assertEqual(sorted(zip_file.namelist()), ["GSE123/SRR1_quant.sf", "README.md"])
+
+    @tag("smasher")
+    def test_compression_level(self):
+        quant_file = self.write_file("GSE123/SRR1_quant.sf", "ENSG00001\t1.5\n" * 10000)
+        path_prefix = os.path.join(self.root_dir, "GSE123", "GSE123")
+
+        compress_sizes = []
+        for compression_level in [0, 9]:
+            with smashing_utils.ArchiveWriter(
+                self.archive_path, self.root_dir, compression_level=compression_level
+            ) as archive:
+                archive.write(quant_file)
+                smashing_utils.write_matrix(self.matrix, path_prefix, "TSV", archive)
+
+            with zipfile.ZipFile(self.archive_path) as zip_file:
+                self.assertEqual(zip_file.read("GSE123/SRR1_quant.sf"), b"ENSG00001\t1.5\n" * 10000)
+                compress_sizes.append(zip_file.getinfo("GSE123/SRR1_quant.sf").compress_size)
+
+        # Level 0 only stores the file.
+        self.assertGreater(compress_sizes[0], 140000)
+        self.assertLess(compress_sizes[1], 1000)
+
+
+class QNTargetCacheTestCase(TestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+        patcher = patch.object(
+            smashing_utils, "QN_TARGET_CACHE_DIR", os.path.join(self.work_dir.name, "cache")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.organism = Organism.objects.create(name="DANIO_RERIO", taxonomy_id=7955)
+
+    def set_qn_target(self, values, sha1):
+        result = ComputationalResult.objects.create()
+        path = os.path.join(self.work_dir.name, sha1 + ".tsv")
+        pd.Series(values).to_csv(path, sep="\t", header=False, index=False)
+        ComputedFile.objects.create(
+            filename=sha1 + ".tsv",
+            absolute_file_path=path,
+            result=result,
+            size_in_bytes=os.path.getsize(path),
+            sha1=sha1,
+            is_qn_target=True,
+        )
+
+        self.organism.qn_target = result
+        self.organism.save()
+
+    @tag("smasher")
+    def test_cached(self):
+        self.set_qn_target([1.5, 2.5, 3.5], "aabbcc")
+
+        with patch.object(ComputedFile, "sync_from_s3", autospec=True) as sync_from_s3:
+            sync_from_s3.side_effect = lambda computed_file: computed_file.absolute_file_path
+            target = smashing_utils.get_qn_target(self.organism)
+            cached_target = smashing_utils.get_qn_target(self.organism)
+
+        # Only the first load had to download and parse the file.
+        self.assertEqual(sync_from_s3.call_count, 1)
+        np.testing.assert_array_equal(target, [1.5, 2.5, 3.5])
+        np.testing.assert_array_equal(cached_target, target)
+        self.assertIsInstance(cached_target, np.memmap)
+
+    @tag("smasher")
+    def test_new_target(self):
+        self.set_qn_target([1.5, 2.5, 3.5], "aabbcc")
+        smashing_utils.get_qn_target(self.organism)
+        cache_dir = os.path.join(smashing_utils.QN_TARGET_CACHE_DIR, "DANIO_RERIO")
+        self.assertEqual(len(os.listdir(cache_dir)), 1)
+
+        self.set_qn_target([4.5, 5.5], "ddeeff")
+        np.testing.assert_array_equal(smashing_utils.get_qn_target(self.organism), [4.5, 5.5])
+
+        # The old target was evicted.
+        cache_files = os.listdir(cache_dir)
+        self.assertEqual(len(cache_files), 1)
+        self.assertTrue(cache_files[0].endswith("_ddeeff.npy"))
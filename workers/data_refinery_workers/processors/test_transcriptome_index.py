@@ -1,8 +1,12 @@
 import os
 import shutil
+import tempfile
+from io import StringIO
 from typing import List
+from unittest.mock import patch
 
-from django.test import TestCase, tag
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, tag
 
 import pandas as pd
 
@@ -205,6 +209,130 @@ class TXTestCase(TestCase):
         self.assertTrue("LONG" in unpacked2)
 
 
+SAMPLE_GTF = (
+    "#!genome-build GRCh38.p13\n"
+    "1\tensembl\tgene\t1\t900\t.\t+\t.\t"
+    'gene_id "ENSG01"; gene_version "1"; gene_biotype "protein_coding";\n'
+    "1\tensembl\ttranscript\t1\t900\t.\t+\t.\t"
+    'gene_id "ENSG01"; gene_version "1"; transcript_id "ENST01"; gene_biotype "protein_coding";\n'
+    "1\tensembl\texon\t1\t300\t.\t+\t.\t"
+    'gene_id "ENSG01"; transcript_id "ENST01"; exon_number "1";\n'
+    "1\thavana\ttranscript\t1\t900\t.\t+\t.\t"
+    'transcript_id "ENST02"; gene_id "ENSG01"; gene_biotype "protein_coding";\n'
+    "1\thavana\tgene\t1000\t1900\t.\t-\t.\t"
+    'gene_id "ENSG02"; gene_biotype "processed_pseudogene";\n'
+    "1\thavana\ttranscript\t1000\t1900\t.\t-\t.\t"
+    'gene_id "ENSG02"; transcript_id "ENST03"; gene_biotype "processed_pseudogene";\n'
+    "1\tensembl\ttranscript\t2000\t2900\t.\t+\t.\t"
+    'gene_id "ENSG03"; ccds_transcript_id "CCDS01"; transcript_id "ENST04";'
+)
+
+
+class ProcessGTFTestCase(SimpleTestCase):
+    def setUp(self):
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+
+        patcher = patch.object(
+            transcriptome_index, "GTF_CACHE_DIR", os.path.join(self.work_dir.name, "gtf_cache")
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def process_gtf(self, length: str) -> dict:
+        """Writes SAMPLE_GTF to a work directory for `length` and processes it."""
+        work_dir = os.path.join(self.work_dir.name, length)
+        os.makedirs(os.path.join(work_dir, "index"))
+        gtf_file_path = os.path.join(work_dir, "sample.gtf")
+        with open(gtf_file_path, "w") as gtf_file:
+            gtf_file.write(SAMPLE_GTF)
+
+        return transcriptome_index._process_gtf(
+            {
+                "job_id": None,
+                "work_dir": work_dir,
+                "output_dir": os.path.join(work_dir, "index"),
+                "gtf_file_path": gtf_file_path,
+                "organism_name": "HOMO_SAPIENS",
+                "assembly_name": "GRCh38",
+                "assembly_version": "99",
+            }
+        )
+
+    @tag("transcriptome")
+    def test_process_gtf(self):
+        job_context = self.process_gtf("long")
+
+        self.assertFalse(os.path.exists(os.path.join(self.work_dir.name, "long", "sample.gtf")))
+        with open(job_context["gtf_file_path"]) as filtered_gtf:
+            filtered_lines = filtered_gtf.read().split("\n")
+        self.assertEqual(
+            filtered_lines, [line for line in SAMPLE_GTF.split("\n") if "pseudogene" not in line],
+        )
+
+        with open(job_context["genes_to_transcripts_path"]) as genes_to_transcripts:
+            self.assertEqual(
+                genes_to_transcripts.read(), "ENSG01\tENST01\nENSG01\tENST02\nENSG03\tENST04\n"
+            )
+
+    @tag("transcriptome")
+    def test_process_gtf_block_boundaries(self):
+        with patch.object(transcriptome_index, "GTF_BLOCK_SIZE", 10):
+            job_context = self.process_gtf("long")
+
+        with open(job_context["genes_to_transcripts_path"]) as genes_to_transcripts:
+            self.assertEqual(
+                genes_to_transcripts.read(), "ENSG01\tENST01\nENSG01\tENST02\nENSG03\tENST04\n"
+            )
+
+    @tag("transcriptome")
+    def test_process_gtf_cache(self):
+        long_job_context = self.process_gtf("long")
+
+        with patch.object(transcriptome_index, "_filter_gtf") as filter_gtf:
+            short_job_context = self.process_gtf("short")
+        filter_gtf.assert_not_called()
+
+        for key in ["gtf_file_path", "genes_to_transcripts_path"]:
+            self.assertIn("short", short_job_context[key])
+            with open(long_job_context[key]) as long_file, open(
+                short_job_context[key]
+            ) as short_file:
+                self.assertEqual(long_file.read(), short_file.read())
+
+    @tag("transcriptome")
+    def test_evict_gtf_cache(self):
+        cache_dir = os.path.join(self.work_dir.name, "gtf_cache")
+        for i, release in enumerate(["97", "98", "99"]):
+            release_dir = os.path.join(cache_dir, "HOMO_SAPIENS_GRCh38_" + release)
+            os.makedirs(release_dir)
+            with open(os.path.join(release_dir, "no_pseudogenes.gtf"), "w") as gtf_file:
+                gtf_file.write("x" * 100)
+            os.utime(release_dir, (i, i))
+        # Caches that are still being filled are left alone.
+        os.makedirs(os.path.join(cache_dir, "HOMO_SAPIENS_GRCh38_100.123.tmp"))
+
+        transcriptome_index._evict_gtf_cache(max_bytes=250)
+
+        self.assertEqual(
+            sorted(os.listdir(cache_dir)),
+            [
+                "HOMO_SAPIENS_GRCh38_100.123.tmp",
+                "HOMO_SAPIENS_GRCh38_98",
+                "HOMO_SAPIENS_GRCh38_99",
+            ],
+        )
+
+    @tag("transcriptome")
+    def test_benchmark(self):
+        stdout = StringIO()
+        call_command("benchmark_gtf", gene_counts="50", stdout=stdout)
+
+        rows = [line.split("\t") for line in stdout.getvalue().strip().split("\n")[1:]]
+        self.assertEqual([row[2] for row in rows], ["by line", "by block", "long and short"])
+        self.assertEqual([row[4] for row in rows], ["-", "True", "True"])
+
+
 class RuntimeProcessorTest(TestCase):
     """Test the processor hosted inside the transcriptome index docker container."""
 
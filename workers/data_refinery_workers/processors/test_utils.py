@@ -1,10 +1,17 @@
 import copy
-from unittest.mock import MagicMock
+import os
+import tempfile
+from unittest.mock import MagicMock, patch
 
-from django.test import TestCase
+from django.test import SimpleTestCase, TestCase
 from django.utils import timezone
 
+import boto3
+from moto import mock_s3
+
 from data_refinery_common.models import (
+    ComputationalResult,
+    ComputedFile,
     Organism,
     OriginalFile,
     OriginalFileSampleAssociation,
@@ -113,3 +120,124 @@ class RunPipelineTestCase(TestCase):
         processor_job.refresh_from_db()
         self.assertFalse(processor_job.success)
         self.assertIsNotNone(processor_job.end_time)
+
+
+class RuntimeEnvCacheTestCase(SimpleTestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.TemporaryDirectory()
+        self.yml_path = os.path.join(utils.DIRNAME, "no_op.yml")
+
+        patchers = [
+            patch.object(utils, "RUNTIME_ENV_CACHE_DIR", self.cache_dir.name),
+            patch.dict(utils.RUNTIME_ENVS, clear=True),
+            patch.object(utils, "get_runtime_env", return_value={"python": {"Django": "2.2"}}),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(self.cache_dir.cleanup)
+
+    def test_computed_once(self):
+        first = utils.get_cached_runtime_env(self.yml_path, "dr_no_op")
+        second = utils.get_cached_runtime_env(self.yml_path, "dr_no_op")
+
+        self.assertEqual(first, {"python": {"Django": "2.2"}})
+        self.assertEqual(first, second)
+        utils.get_runtime_env.assert_called_once_with(self.yml_path)
+
+        # A new process can read the environment back from the file.
+        utils.RUNTIME_ENVS.clear()
+        self.assertEqual(utils.get_cached_runtime_env(self.yml_path, "dr_no_op"), first)
+        utils.get_runtime_env.assert_called_once_with(self.yml_path)
+
+        # Each image gets its own environment.
+        utils.get_cached_runtime_env(self.yml_path, "dr_illumina")
+        self.assertEqual(utils.get_runtime_env.call_count, 2)
+
+    def test_refresh(self):
+        utils.get_cached_runtime_env(self.yml_path, "dr_no_op")
+
+        utils.get_runtime_env.return_value = {"python": {"Django": "3.0"}}
+        refreshed = utils.get_cached_runtime_env(self.yml_path, "dr_no_op", refresh=True)
+
+        self.assertEqual(refreshed, {"python": {"Django": "3.0"}})
+        utils.RUNTIME_ENVS.clear()
+        self.assertEqual(utils.get_cached_runtime_env(self.yml_path, "dr_no_op"), refreshed)
+        self.assertEqual(utils.get_runtime_env.call_count, 2)
+
+
+class BulkSyncToS3TestCase(TestCase):
+    def setUp(self):
+        mock = mock_s3()
+        mock.start()
+        self.addCleanup(mock.stop)
+
+        # The module-level client was created before moto was started.
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket="test-bucket")
+        patcher = patch("data_refinery_common.models.computed_file.S3", self.s3)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.work_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.work_dir.cleanup)
+        self.result = ComputationalResult.objects.create()
+
+    def make_computed_file(self, filename, save=True):
+        absolute_file_path = os.path.join(self.work_dir.name, filename)
+        with open(absolute_file_path, "w") as computed_file:
+            computed_file.write(filename)
+
+        computed_file = ComputedFile(
+            filename=filename,
+            absolute_file_path=absolute_file_path,
+            size_in_bytes=len(filename),
+            sha1="",
+            result=self.result,
+        )
+        if save:
+            computed_file.save()
+
+        return computed_file
+
+    def test_bulk_sync(self):
+        computed_files = [self.make_computed_file("file_{}.tsv".format(i)) for i in range(5)]
+        # Files that haven't been saved yet get saved, like with sync_to_s3.
+        computed_files.append(self.make_computed_file("unsaved.tsv", save=False))
+
+        with self.settings(RUNNING_IN_CLOUD=True):
+            self.assertTrue(
+                ComputedFile.bulk_sync_to_s3(
+                    [(cf, "key_" + cf.filename) for cf in computed_files],
+                    "test-bucket",
+                    max_workers=3,
+                    # Small enough that every file is uploaded in parts.
+                    multipart_threshold=1,
+                )
+            )
+
+        for computed_file in computed_files:
+            computed_file.refresh_from_db()
+            self.assertEqual(computed_file.s3_bucket, "test-bucket")
+            self.assertEqual(computed_file.s3_key, "key_" + computed_file.filename)
+
+            s3_object = self.s3.get_object(Bucket="test-bucket", Key=computed_file.s3_key)
+            self.assertEqual(s3_object["Body"].read().decode(), computed_file.filename)
+
+    def test_bulk_sync_failure(self):
+        computed_files = [self.make_computed_file("file_{}.tsv".format(i)) for i in range(3)]
+        os.remove(computed_files[1].absolute_file_path)
+
+        with self.settings(RUNNING_IN_CLOUD=True):
+            self.assertFalse(
+                ComputedFile.bulk_sync_to_s3(
+                    [(cf, "key_" + cf.filename) for cf in computed_files],
+                    "test-bucket",
+                    num_attempts=1,
+                )
+            )
+
+        for computed_file in computed_files:
+            computed_file.refresh_from_db()
+            self.assertIsNone(computed_file.s3_bucket)
+            self.assertIsNone(computed_file.s3_key)
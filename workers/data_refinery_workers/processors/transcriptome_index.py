@@ -1,9 +1,10 @@
 import gzip
 import os
+import re
 import shutil
 import subprocess
 import tarfile
-from typing import Dict
+from typing import Dict, Iterator, Optional
 
 from django.utils import timezone
 
@@ -21,14 +22,24 @@ from data_refinery_workers.processors import utils
 
 logger = get_and_configure_logger(__name__)
 JOB_DIR_PREFIX = "processor_job_"
-GENE_TO_TRANSCRIPT_TEMPLATE = "{gene_id}\t{transcript_id}\n"
-GENE_TYPE_COLUMN = 2
 S3_TRANSCRIPTOME_INDEX_BUCKET_NAME = get_env_variable_gracefully(
     "S3_TRANSCRIPTOME_INDEX_BUCKET_NAME", False
 )
 LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
-# Removes each occurrance of ; and "
-IDS_CLEANUP_TABLE = str.maketrans({";": None, '"': None})
+FILTERED_GTF_FILENAME = "no_pseudogenes.gtf"
+GENES_TO_TRANSCRIPTS_FILENAME = "genes_to_transcripts.txt"
+# The GTF file is processed in blocks of whole lines of about this many bytes.
+GTF_BLOCK_SIZE = 16 * 1024 * 1024
+# The processed GTF files only depend on the organism's Ensembl
+# release, so they're cached here for the other index length to reuse.
+# They're deleted once both lengths are built, and the least recently
+# used ones are deleted once they take up more than GTF_CACHE_MAX_BYTES.
+GTF_CACHE_DIR = os.path.join(LOCAL_ROOT_DIR, "gtf_cache")
+GTF_CACHE_MAX_BYTES = int(get_env_variable("GTF_CACHE_MAX_BYTES", str(10 * 1024 * 1024 * 1024)))
+# Matches the rest of each line whose feature column is "transcript".
+TRANSCRIPT_LINE_PATTERN = re.compile(rb"\ttranscript\t([^\n]*)")
+GENE_ID_PATTERN = re.compile(rb'\bgene_id "?([^";\s]*)')
+TRANSCRIPT_ID_PATTERN = re.compile(rb'\btranscript_id "?([^";\s]*)')
 
 
 def get_organism_name_from_path(directory_path: str) -> str:
@@ -187,6 +198,166 @@ def _extract_assembly_information(job_context: Dict) -> Dict:
     return job_context
 
 
+def _read_gtf_blocks(gtf_file, block_size: int) -> Iterator[bytes]:
+    """Yields the contents of `gtf_file`, which must be opened in binary
+    mode, in blocks of about `block_size` bytes that end at a line break."""
+    remainder = b""
+    while True:
+        block = gtf_file.read(block_size)
+        if not block:
+            if remainder:
+                yield remainder
+            return
+
+        block = remainder + block
+        block_end = block.rfind(b"\n") + 1
+        remainder = block[block_end:]
+        if block_end:
+            yield block[:block_end]
+
+
+def _remove_pseudogene_lines(block: bytes) -> bytes:
+    """Removes every line containing "pseudogene" from `block`."""
+    kept_blocks = []
+    kept_start = 0
+    pseudogene_start = block.find(b"pseudogene")
+    while pseudogene_start != -1:
+        line_start = block.rfind(b"\n", kept_start, pseudogene_start) + 1
+        line_end = block.find(b"\n", pseudogene_start)
+        line_end = len(block) if line_end == -1 else line_end + 1
+
+        kept_blocks.append(block[kept_start:line_start])
+        kept_start = line_end
+        pseudogene_start = block.find(b"pseudogene", kept_start)
+
+    kept_blocks.append(block[kept_start:])
+    return b"".join(kept_blocks)
+
+
+def _get_genes_to_transcripts(block: bytes) -> bytes:
+    """Returns a line with the gene_id and transcript_id of each transcript
+    in `block`, separated by a tab."""
+    genes_to_transcripts = []
+    for transcript_line in TRANSCRIPT_LINE_PATTERN.finditer(block):
+        columns = transcript_line.group(1).split(b"\t")
+        # The feature column is followed by the start, end, score,
+        # strand, frame and attribute columns, if it's the third one.
+        if len(columns) != 6:
+            continue
+
+        gene_id = GENE_ID_PATTERN.search(columns[-1])
+        transcript_id = TRANSCRIPT_ID_PATTERN.search(columns[-1])
+        if gene_id and transcript_id:
+            genes_to_transcripts.append(gene_id.group(1) + b"\t" + transcript_id.group(1) + b"\n")
+
+    return b"".join(genes_to_transcripts)
+
+
+def _filter_gtf(gtf_file_path: str, filtered_gtf_path: str, genes_to_transcripts_path: str) -> None:
+    """Writes a copy of the GTF file without any of its pseudogenes to
+    `filtered_gtf_path` and a tsv mapping between its gene_ids and
+    transcript_ids to `genes_to_transcripts_path`.
+
+    The file is processed a block at a time rather than a line at a
+    time, so the searching is done by bytes and regex methods instead of
+    in Python.
+    """
+    with open(gtf_file_path, "rb") as input_gtf, open(
+        filtered_gtf_path, "wb"
+    ) as filtered_gtf, open(genes_to_transcripts_path, "wb") as genes_to_transcripts:
+        for block in _read_gtf_blocks(input_gtf, GTF_BLOCK_SIZE):
+            block = _remove_pseudogene_lines(block)
+            filtered_gtf.write(block)
+            genes_to_transcripts.write(_get_genes_to_transcripts(block))
+
+
+def _get_gtf_cache_dir(job_context: Dict) -> Optional[str]:
+    """Returns the directory the processed GTF files for the organism's
+    Ensembl release are cached in, or None if the release isn't known."""
+    if not job_context.get("organism_name") or not job_context.get("assembly_version"):
+        return None
+
+    cache_name = "_".join(
+        [
+            job_context["organism_name"],
+            job_context.get("assembly_name", ""),
+            job_context["assembly_version"],
+        ]
+    )
+    return os.path.join(GTF_CACHE_DIR, cache_name)
+
+
+def _load_cached_gtf(
+    cache_dir: str, filtered_gtf_path: str, genes_to_transcripts_path: str
+) -> bool:
+    """Puts copies of the processed GTF files from `cache_dir` at the
+    given paths. Returns whether they were in the cache."""
+    if not os.path.isdir(cache_dir):
+        return False
+
+    try:
+        utils.link_or_copy(os.path.join(cache_dir, FILTERED_GTF_FILENAME), filtered_gtf_path)
+        utils.link_or_copy(
+            os.path.join(cache_dir, GENES_TO_TRANSCRIPTS_FILENAME), genes_to_transcripts_path
+        )
+        # Mark it as recently used so it's one of the last to be evicted.
+        os.utime(cache_dir)
+        return True
+    except OSError:
+        logger.warning("Failed to use cached GTF files.", cache_dir=cache_dir)
+
+    for path in [filtered_gtf_path, genes_to_transcripts_path]:
+        if os.path.exists(path):
+            os.remove(path)
+
+    return False
+
+
+def _cache_gtf(cache_dir: str, filtered_gtf_path: str, genes_to_transcripts_path: str) -> None:
+    """Adds the processed GTF files to the cache in `cache_dir`."""
+    # Fill a temporary directory first so that concurrent jobs never
+    # read a partially written cache.
+    temp_dir = "{}.{}.tmp".format(cache_dir, os.getpid())
+    try:
+        os.makedirs(temp_dir, exist_ok=True)
+        utils.link_or_copy(filtered_gtf_path, os.path.join(temp_dir, FILTERED_GTF_FILENAME))
+        utils.link_or_copy(
+            genes_to_transcripts_path, os.path.join(temp_dir, GENES_TO_TRANSCRIPTS_FILENAME)
+        )
+        os.rename(temp_dir, cache_dir)
+    except OSError:
+        # don't fail if we can't save the cache, another job may have
+        # already saved it.
+        if not os.path.isdir(cache_dir):
+            logger.warning("Failed to cache GTF files.", cache_dir=cache_dir)
+        shutil.rmtree(temp_dir, ignore_errors=True)
+
+
+def _evict_gtf_cache(max_bytes: int = GTF_CACHE_MAX_BYTES) -> None:
+    """Deletes the processed GTF files of the least recently used Ensembl
+    releases from the cache until it takes up no more than `max_bytes`."""
+    try:
+        cached_dirs = []
+        for entry in os.scandir(GTF_CACHE_DIR):
+            # Skip the caches other jobs are still filling.
+            if not entry.is_dir() or entry.name.endswith(".tmp"):
+                continue
+
+            dir_size = sum(file_entry.stat().st_size for file_entry in os.scandir(entry.path))
+            cached_dirs.append((entry.stat().st_mtime, dir_size, entry.path))
+    except OSError:
+        return
+
+    cache_size = sum(size for _, size, _ in cached_dirs)
+    for _, size, path in sorted(cached_dirs):
+        if cache_size <= max_bytes:
+            break
+
+        # Another job may have evicted it first.
+        shutil.rmtree(path, ignore_errors=True)
+        cache_size -= size
+
+
 def _process_gtf(job_context: Dict) -> Dict:
     """Reads in a .gtf file and generates two new files from it.
 
@@ -194,39 +365,27 @@ def _process_gtf(job_context: Dict) -> Dict:
     filtered out of it. The other is a tsv mapping between gene_ids
     and transcript_ids. Adds the keys "gtf_file_path" and
     "genes_to_transcripts_path" to job_context.
+
+    Both files are cached by the organism's Ensembl release, so the
+    long and short indices only have to process the .gtf file once.
     """
-    filtered_gtf_path = os.path.join(job_context["work_dir"], "no_pseudogenes.gtf")
+    filtered_gtf_path = os.path.join(job_context["work_dir"], FILTERED_GTF_FILENAME)
     # Generate "genes_to_transcripts.txt" in job_context["output_dir"]
     # so that it will be included in the computed tarball.
-    genes_to_transcripts_path = os.path.join(job_context["output_dir"], "genes_to_transcripts.txt")
-
-    with open(job_context["gtf_file_path"], "r") as input_gtf, open(
-        filtered_gtf_path, "w"
-    ) as filtered_gtf, open(genes_to_transcripts_path, "w") as genes_to_transcripts:
-        for line in input_gtf:
-            # Filter out any lines containing "pseudogene".
-            if "pseudogene" in line:
-                continue
-
-            filtered_gtf.write(line)
-            tab_split_line = line.split("\t")
-
-            # Skip header lines (they're short and contain no tabs):
-            if len(tab_split_line) < 2:
-                continue
-
-            if tab_split_line[GENE_TYPE_COLUMN] == "transcript":
-                ids_column = tab_split_line[-1].translate(IDS_CLEANUP_TABLE)
-                split_ids_column = ids_column.split(" ")
-
-                gene_id_index = split_ids_column.index("gene_id") + 1
-                gene_id = split_ids_column[gene_id_index]
-                transcript_id_index = split_ids_column.index("transcript_id") + 1
-                transcript_id = split_ids_column[transcript_id_index]
+    genes_to_transcripts_path = os.path.join(
+        job_context["output_dir"], GENES_TO_TRANSCRIPTS_FILENAME
+    )
 
-                genes_to_transcripts.write(
-                    GENE_TO_TRANSCRIPT_TEMPLATE.format(gene_id=gene_id, transcript_id=transcript_id)
-                )
+    cache_dir = _get_gtf_cache_dir(job_context)
+    if cache_dir and _load_cached_gtf(cache_dir, filtered_gtf_path, genes_to_transcripts_path):
+        logger.info(
+            "Using cached GTF files.", cache_dir=cache_dir, processor_job=job_context["job_id"]
+        )
+    else:
+        _filter_gtf(job_context["gtf_file_path"], filtered_gtf_path, genes_to_transcripts_path)
+        if cache_dir:
+            _cache_gtf(cache_dir, filtered_gtf_path, genes_to_transcripts_path)
+            _evict_gtf_cache()
 
     # Clean up the unfiltered gtf file, which we no longer need, unless explicitly told otherwise.
     # This setting is used in one of the tests where we download an unzipped gtf
@@ -467,6 +626,11 @@ def _populate_index_object(job_context: Dict) -> Dict:
     if short_indices.count() < 1 or long_indices.count() < 1:
         # utils.end_job deletes these, so remove them so it doesn't.
         job_context["original_files"] = []
+    else:
+        # Neither length needs the processed GTF files anymore.
+        cache_dir = _get_gtf_cache_dir(job_context)
+        if cache_dir:
+            shutil.rmtree(cache_dir, ignore_errors=True)
 
     return job_context
 
@@ -18,7 +18,7 @@ import yaml
 from data_refinery_common.enums import SMASHER_JOB_TYPES, ProcessorEnum, ProcessorPipeline
 from data_refinery_common.job_management import create_downloader_job
 from data_refinery_common.logging import get_and_configure_logger
-from data_refinery_common.models import Processor, ProcessorJob, Sample
+from data_refinery_common.models import ComputedFile, Experiment, Processor, ProcessorJob, Sample
 from data_refinery_common.utils import get_env_variable, get_instance_id
 
 logger = get_and_configure_logger(__name__)
@@ -26,8 +26,13 @@ logger = get_and_configure_logger(__name__)
 SYSTEM_VERSION = get_env_variable("SYSTEM_VERSION")
 S3_BUCKET_NAME = get_env_variable("S3_BUCKET_NAME", "data-refinery")
 S3_QN_TARGET_BUCKET_NAME = get_env_variable("S3_QN_TARGET_BUCKET_NAME", "data-refinery")
+LOCAL_ROOT_DIR = get_env_variable("LOCAL_ROOT_DIR", "/home/user/data_store")
+RUNTIME_ENV_CACHE_DIR = os.path.join(LOCAL_ROOT_DIR, "runtime_envs")
 DIRNAME = os.path.dirname(os.path.abspath(__file__))
 CURRENT_JOB = None
+# The runtime environments this process has already looked up, keyed
+# by their cache file path.
+RUNTIME_ENVS = {}
 
 
 def signal_handler(sig, frame):
@@ -230,20 +235,21 @@ def end_job(job_context: Dict, abort=False):
             s3_bucket = S3_BUCKET_NAME
 
         # S3-sync Computed Files
+        computed_files_and_keys = []
         for computed_file in job_context.get("computed_files", []):
             # Ensure even distribution across S3 servers
             nonce = "".join(
                 random.choice(string.ascii_lowercase + string.digits) for _ in range(24)
             )
-            result = computed_file.sync_to_s3(s3_bucket, nonce + "_" + computed_file.filename)
-
-            if result and settings.RUNNING_IN_CLOUD:
+            computed_files_and_keys.append((computed_file, nonce + "_" + computed_file.filename))
+
+        if not ComputedFile.bulk_sync_to_s3(computed_files_and_keys, s3_bucket):
+            success = False
+            job_context["success"] = False
+            job.failure_reason = "Failed to upload computed file."
+        elif settings.RUNNING_IN_CLOUD:
+            for computed_file, _ in computed_files_and_keys:
                 computed_file.delete_local_file()
-            elif not result:
-                success = False
-                job_context["success"] = False
-                job.failure_reason = "Failed to upload computed file."
-                break
 
     if not success:
         for computed_file in job_context.get("computed_files", []):
@@ -293,8 +299,7 @@ def end_job(job_context: Dict, abort=False):
                     sample.is_processed = True
                     sample.save()
 
-                for experiment in unique_experiments:
-                    experiment.update_num_samples()
+                Experiment.bulk_update_num_samples(unique_experiments)
 
     # If we are aborting, it's because we want to do something
     # different, so leave the original files so that "something
@@ -669,6 +674,60 @@ def get_runtime_env(yml_filename):
     return runtime_env
 
 
+def get_runtime_env_cache_path(yml_filename, docker_image):
+    """Returns the path of the file that caches the runtime environment
+    described by `yml_filename` for `docker_image`.
+
+    The environment can't change within an image, so the path is keyed
+    by the image and SYSTEM_VERSION.
+    """
+    yml_name = os.path.splitext(os.path.basename(yml_filename))[0]
+    cache_filename = "{}_{}_{}.json".format(docker_image, SYSTEM_VERSION, yml_name)
+    return os.path.join(RUNTIME_ENV_CACHE_DIR, cache_filename)
+
+
+def get_cached_runtime_env(yml_filename, docker_image, refresh=False):
+    """Returns the same dictionary as get_runtime_env, but only computes
+    it once per image.
+
+    The environment is kept in memory and in a file keyed by the image
+    version, so later calls, and later jobs run from the same image,
+    don't have to launch a subprocess for every package. If `refresh`
+    is set the environment is recomputed and the cache is overwritten.
+    """
+    cache_path = get_runtime_env_cache_path(yml_filename, docker_image)
+
+    if not refresh:
+        if cache_path in RUNTIME_ENVS:
+            return RUNTIME_ENVS[cache_path]
+
+        try:
+            with open(cache_path) as cache_file:
+                RUNTIME_ENVS[cache_path] = json.load(cache_file)
+                return RUNTIME_ENVS[cache_path]
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError):
+            logger.warning("Failed to load cached runtime environment.", cache_path=cache_path)
+
+    environment = get_runtime_env(yml_filename)
+    RUNTIME_ENVS[cache_path] = environment
+
+    try:
+        os.makedirs(RUNTIME_ENV_CACHE_DIR, exist_ok=True)
+        # Write to a temporary file first so that concurrent jobs
+        # never read a partially written cache.
+        temp_path = "{}.{}.tmp".format(cache_path, os.getpid())
+        with open(temp_path, "w") as cache_file:
+            json.dump(environment, cache_file)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        # don't fail if we can't save the cache
+        logger.warning("Failed to cache runtime environment.", cache_path=cache_path)
+
+    return environment
+
+
 def find_processor(enum_key):
     """Returns either a newly created Processor record, or the one in
     database that matches the current processor name, version and environment.
@@ -677,9 +736,8 @@ def find_processor(enum_key):
     name = ProcessorEnum[enum_key].value["name"]
     docker_image = ProcessorEnum[enum_key].value["docker_img"]
 
-    # In current implementation, ALWAYS get the runtime environment.
     yml_path = os.path.join(DIRNAME, ProcessorEnum[enum_key].value["yml_file"])
-    environment = get_runtime_env(yml_path)
+    environment = get_cached_runtime_env(yml_path, docker_image)
     obj, status = Processor.objects.get_or_create(
         name=name, version=SYSTEM_VERSION, docker_image=docker_image, environment=environment
     )
@@ -741,6 +799,15 @@ def cache_keys(*keys, work_dir_key="work_dir"):
     return inner
 
 
+def link_or_copy(source_path: str, destination_path: str) -> None:
+    """Hard links `source_path` to `destination_path`, or copies it if
+    that isn't possible, like when they're on different file systems."""
+    try:
+        os.link(source_path, destination_path)
+    except OSError:
+        shutil.copyfile(source_path, destination_path)
+
+
 def squish_duplicates(data: pd.DataFrame) -> pd.DataFrame:
     """Squish duplicated rows together.
     XXX/TODO: Is mean the appropriate method here?